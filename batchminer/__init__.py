@@ -1,10 +1,16 @@
-from batchminer import random, semihard, distance
+from batchminer import random, semihard, distance, npair, lifted
+from batchminer.mining_result import MiningResult
 
 BATCHMINING_METHODS = {'random':random,
                        'semihard':semihard,
                        'distance':distance,
+                       'npair':npair,
+                       'lifted':lifted,
                        }
 
+### Miners returning single (anchor, positive, negative) triplets, npair and lifted return sets of samples
+TRIPLET_MINING_METHODS = ['random', 'semihard', 'distance']
+
 def select(name, **kwargs):
     #####
     if name not in BATCHMINING_METHODS: raise NotImplementedError('Batchmining {} not available!'.format(name))
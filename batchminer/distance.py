@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from batchminer.mining_result import MiningResult, sq_pdist
 
 
 class BatchMiner():
@@ -9,61 +10,54 @@ class BatchMiner():
         self.upper_cutoff = miner_distance_upper_cutoff
         self.name         = name
 
-    def __call__(self, batch, labels, tar_labels=None, return_distances=False, distances=None):
-        if isinstance(labels, torch.Tensor): labels = labels.detach().cpu().numpy()
+    def __call__(self, batch, labels, tar_labels=None, sq_distances=None):
+        """
+        Distance-weighted sampling for all anchors at once, on the device of <batch>. Negatives are drawn with
+        probability proportional to the inverse of the distance density on the unit sphere, positives uniformly.
+
+        Args:
+            batch:        torch.Tensor: Embeddings (BS x DIM).
+            labels:       torch.Tensor/nparray: Class of each embedding (BS).
+            tar_labels:   torch.Tensor/nparray, optional: Classes of the columns of <sq_distances> if they differ from <labels>.
+            sq_distances: torch.Tensor, optional: Precomputed (BS x N) squared distances.
+        Returns:
+            MiningResult, anchors without any positive are skipped.
+        """
         bs, dim = batch.shape
-
-        if distances is None:
-            distances = self.pdist(batch.detach()).clamp(min=self.lower_cutoff)
-        sel_d = distances.shape[-1]
-
-        positives, negatives = [],[]
-        labels_visited       = []
-        anchors              = []
-
-        tar_labels = labels if tar_labels is None else tar_labels
-
-        for i in range(bs):
-            neg = tar_labels!=labels[i]; pos = tar_labels==labels[i]
-
-            anchors.append(i)
-            q_d_inv = self.inverse_sphere_distances(dim, bs, distances[i], tar_labels, labels[i])
-            negatives.append(np.random.choice(sel_d,p=q_d_inv))
-
-            if np.sum(pos)>0:
-                #Sample positives randomly
-                if np.sum(pos)>1: pos[i] = 0
-                positives.append(np.random.choice(np.where(pos)[0]))
-                #Sample negatives by distance
-
-        sampled_triplets = [[a,p,n] for a,p,n in zip(anchors, positives, negatives)]
-
-        if return_distances:
-            return sampled_triplets, distances
-        else:
-            return sampled_triplets
-
-
-    def inverse_sphere_distances(self, dim, bs, anchor_to_all_dists, labels, anchor_label):
-            dists  = anchor_to_all_dists
-
-            #negated log-distribution of distances of unit sphere in dimension <dim>
-            log_q_d_inv = ((2.0 - float(dim)) * torch.log(dists) - (float(dim-3) / 2) * torch.log(1.0 - 0.25 * (dists.pow(2))))
-            log_q_d_inv[np.where(labels==anchor_label)[0]] = 0
-
-            q_d_inv     = torch.exp(log_q_d_inv - torch.max(log_q_d_inv)) # - max(log) for stability
-            q_d_inv[np.where(labels==anchor_label)[0]] = 0
-
-            ### NOTE: Cutting of values with high distances made the results slightly worse. It can also lead to
-            # errors where there are no available negatives (for high samples_per_class cases).
-            # q_d_inv[np.where(dists.detach().cpu().numpy()>self.upper_cutoff)[0]]    = 0
-
-            q_d_inv = q_d_inv/q_d_inv.sum()
-            return q_d_inv.detach().cpu().numpy()
-
-
-    def pdist(self, A):
-        prod = torch.mm(A, A.t())
-        norm = prod.diag().unsqueeze(1).expand_as(prod)
-        res = (norm + norm.t() - 2 * prod).clamp(min = 0)
-        return res.sqrt()
+        labels     = torch.as_tensor(labels, device=batch.device).view(-1)
+        tar_labels = labels if tar_labels is None else torch.as_tensor(tar_labels, device=batch.device).view(-1)
+
+        if sq_distances is None:
+            sq_distances = sq_pdist(batch)
+        distances = sq_distances.detach().sqrt().clamp(min=self.lower_cutoff)
+        same = labels.view(-1, 1) == tar_labels.view(1, -1)
+
+        ### Negatives: one draw from the row-normalized q(d)^-1 of all anchors
+        q_d_inv = self.inverse_sphere_distances(dim, distances, same)
+        no_neg  = ~(~same).any(dim=1)
+        if no_neg.any():
+            q_d_inv[no_neg] = 1.
+        negatives = torch.multinomial(q_d_inv, 1).view(-1)
+
+        ### Positives: uniform over same-class entries, excluding the anchor itself if it has other positives
+        pos = same.clone()
+        if tar_labels is labels:
+            pos[torch.arange(bs, device=batch.device), torch.arange(bs, device=batch.device)] = pos.sum(dim=1) <= 1
+        has_pos   = pos.any(dim=1)
+        anchors   = torch.arange(bs, device=batch.device)[has_pos]
+        positives = torch.multinomial(pos[has_pos].float(), 1).view(-1)
+
+        return MiningResult(anchors, positives, negatives[has_pos], sq_distances)
+
+    def inverse_sphere_distances(self, dim, distances, same):
+        #negated log-distribution of distances of unit sphere in dimension <dim>
+        log_q_d_inv = ((2.0 - float(dim)) * torch.log(distances) - (float(dim-3) / 2) * torch.log(1.0 - 0.25 * (distances.pow(2))))
+        log_q_d_inv = log_q_d_inv.masked_fill(same, -float('inf'))
+
+        ### NOTE: Cutting of values with high distances made the results slightly worse. It can also lead to
+        # errors where there are no available negatives (for high samples_per_class cases).
+        # log_q_d_inv = log_q_d_inv.masked_fill(distances > self.upper_cutoff, -float('inf'))
+
+        # - max(log) for stability, rows are normalized by multinomial
+        row_max = log_q_d_inv.max(dim=1, keepdim=True)[0].clamp(min=-np.finfo(np.float32).max)
+        return torch.exp(log_q_d_inv - row_max)
@@ -0,0 +1,31 @@
+import numpy as np, torch
+from batchminer.mining_result import MiningResult, sq_pdist
+
+
+class BatchMiner():
+    def __init__(self, name='lifted'):
+        self.name         = 'lifted'
+
+    def __call__(self, batch, labels, sq_distances=None):
+        """
+        Lifted-structure mining: every sample with another sample of its class is an anchor, with the set of all other
+        samples of its class as positives and all samples of other classes as negatives.
+
+        Args:
+            batch:        torch.Tensor: Embeddings (BS x DIM).
+            labels:       torch.Tensor/nparray: Class of each embedding (BS).
+            sq_distances: torch.Tensor, optional: Precomputed (BS x BS) squared distances.
+        Returns:
+            MiningResult with anchors (T) and positives and negatives as (T x BS) bool masks.
+        """
+        bs     = batch.size(0)
+        labels = torch.as_tensor(labels, device=batch.device).view(-1)
+        if sq_distances is None:
+            sq_distances = sq_pdist(batch)
+
+        same = labels.view(-1, 1) == labels.view(1, -1)
+        pos  = same & ~torch.eye(bs, dtype=torch.bool, device=batch.device)
+        has_pos = pos.any(dim=1)
+
+        anchors = torch.arange(bs, device=batch.device)[has_pos]
+        return MiningResult(anchors, pos[has_pos], ~same[has_pos], sq_distances)
@@ -0,0 +1,46 @@
+import torch
+
+
+class MiningResult():
+    """
+    Triplets mined from a batch, returned by all batchminers.
+
+    Args:
+        anchors, positives, negatives: int64 tensors (T) of batch indices, on the device of the batch. Miners of sets
+            (npair, lifted) return positives and/or negatives as (T x BS) bool masks instead.
+        sq_distances: torch.Tensor, optional: (BS x BS) squared euclidean distances of the batch the miner computed,
+            with gradient, so criteria reuse them instead of computing distances a second time.
+    """
+    def __init__(self, anchors, positives, negatives, sq_distances=None):
+        self.anchors      = anchors
+        self.positives    = positives
+        self.negatives    = negatives
+        self.sq_distances = sq_distances
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def pair_sq_distances(self, batch, idx_a, idx_b):
+        """Squared distances between batch[idx_a] and batch[idx_b] (broadcasting index tensors), gathered from
+        sq_distances if available."""
+        if self.sq_distances is not None:
+            return self.sq_distances[idx_a, idx_b]
+        if idx_a.dim() == 1 and idx_b.dim() == 1:
+            return (batch.index_select(0, idx_a) - batch.index_select(0, idx_b)).pow(2).sum(dim=-1)
+        return (batch[idx_a] - batch[idx_b]).pow(2).sum(dim=-1)
+
+    def pair_distances(self, batch, idx_a, idx_b, eps=1e-8):
+        """Euclidean distances, with <eps> keeping the gradient of the sqrt finite for (near-)identical embeddings."""
+        return (self.pair_sq_distances(batch, idx_a, idx_b).clamp(min=0) + eps).sqrt()
+
+    def tolist(self):
+        """List of [a, p, n] triplets, with a single host transfer."""
+        return torch.stack([self.anchors, self.positives, self.negatives], dim=1).tolist()
+
+
+def sq_pdist(A):
+    """
+    (BS x BS) squared euclidean distances, differentiable. Computed from exact differences instead of
+    |a|^2 + |b|^2 - 2ab, which cancels to noise for near-duplicate embeddings whose distances are then sqrt'ed.
+    """
+    return torch.cdist(A, A, compute_mode='donot_use_mm_for_euclid_dist').pow(2)
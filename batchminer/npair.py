@@ -0,0 +1,32 @@
+import numpy as np, torch
+from batchminer.mining_result import MiningResult
+
+
+class BatchMiner():
+    def __init__(self, name='npair'):
+        self.name         = 'npair'
+
+    def __call__(self, batch, labels, sq_distances=None):
+        """
+        N-pair mining: every sample with another sample of its class is an anchor, paired with one random other
+        positive and the set of all samples of other classes as negatives.
+
+        Args:
+            batch:        torch.Tensor: Embeddings (BS x DIM).
+            labels:       torch.Tensor/nparray: Class of each embedding (BS).
+            sq_distances: torch.Tensor, optional: Precomputed (BS x BS) squared distances, handed through to the result.
+        Returns:
+            MiningResult with anchors and positives (T) and negatives as a (T x BS) bool mask.
+        """
+        bs     = batch.size(0)
+        labels = torch.as_tensor(labels, device=batch.device).view(-1)
+
+        same = labels.view(-1, 1) == labels.view(1, -1)
+        pos  = same & ~torch.eye(bs, dtype=torch.bool, device=batch.device)
+        has_pos = pos.any(dim=1)
+
+        anchors   = torch.arange(bs, device=batch.device)[has_pos]
+        positives = torch.multinomial(pos[has_pos].float(), 1).view(-1)
+        negatives = ~same[has_pos]
+
+        return MiningResult(anchors, positives, negatives, sq_distances)
@@ -1,23 +1,45 @@
 import numpy as np, torch
-import itertools as it
-import random
+from batchminer.mining_result import MiningResult
+
 
 class BatchMiner():
     def __init__(self, name):
         self.name         = 'random'
 
-    def __call__(self, batch, labels):
-        if isinstance(labels, torch.Tensor): labels = labels.detach().cpu().numpy()
-        unique_classes = np.unique(labels)
-        indices        = np.arange(len(batch))
-        class_dict     = {i:indices[labels==i] for i in unique_classes}
+    def __call__(self, batch, labels, sq_distances=None):
+        """
+        Draws BS random triplets, uniformly from all valid (a, p, n) with a != p of the same class and n of another
+        class, in O(BS) without enumerating them: anchors are drawn proportionally to their number of valid triplets
+        (n_c - 1) * (BS - n_c), then a positive and a negative uniformly by index arithmetic on the label-sorted batch.
+
+        Args:
+            batch:        torch.Tensor: Embeddings (BS x DIM).
+            labels:       torch.Tensor/nparray: Class of each embedding (BS).
+            sq_distances: torch.Tensor, optional: Precomputed (BS x BS) squared distances, handed through to the result.
+        Returns:
+            MiningResult. Random mining needs no distances, so the criterion computes the few it needs itself.
+        """
+        bs     = batch.size(0)
+        labels = torch.as_tensor(labels, device=batch.device).view(-1)
+
+        ### Label-sorted batch: samples of the class of position i are order[start[i]:start[i]+count[i]]
+        order     = torch.argsort(labels)
+        _, inverse, counts = torch.unique(labels[order], return_inverse=True, return_counts=True)
+        offsets   = torch.cumsum(counts, dim=0) - counts
+        count     = counts[inverse]
+        start     = offsets[inverse]
+        rank      = torch.arange(bs, device=batch.device) - start
 
-        sampled_triplets = [list(it.product([x],[x],[y for y in unique_classes if x!=y])) for x in unique_classes]
-        sampled_triplets = [x for y in sampled_triplets for x in y]
+        weights = ((count - 1) * (bs - count)).float()
+        if weights.sum() == 0:
+            empty = torch.zeros(0, dtype=torch.long, device=batch.device)
+            return MiningResult(empty, empty, empty, sq_distances)
+        a = torch.multinomial(weights, bs, replacement=True)
 
-        sampled_triplets = [[x for x in list(it.product(*[class_dict[j] for j in i])) if x[0]!=x[1]] for i in sampled_triplets]
-        sampled_triplets = [x for y in sampled_triplets for x in y]
+        ### Positive: another position of the same class block. Negative: a position outside the class block.
+        shift = 1 + (torch.rand(bs, device=batch.device) * (count[a] - 1)).long()
+        p     = start[a] + (rank[a] + shift) % count[a]
+        n     = (torch.rand(bs, device=batch.device) * (bs - count[a])).long()
+        n     = torch.where(n < start[a], n, n + count[a])
 
-        #NOTE: The number of possible triplets is given by #unique_classes*(2*(samples_per_class-1)!)*(#unique_classes-1)*samples_per_class
-        sampled_triplets = random.sample(sampled_triplets, batch.shape[0])
-        return sampled_triplets
+        return MiningResult(order[a], order[p], order[n], sq_distances)
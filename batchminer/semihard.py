@@ -1,4 +1,5 @@
 import numpy as np, torch
+from batchminer.mining_result import MiningResult, sq_pdist
 
 
 class BatchMiner():
@@ -6,41 +7,39 @@ class BatchMiner():
         self.name         = 'semihard'
         self.margin       = margin
 
-    def __call__(self, batch, labels, return_distances=False):
-        if isinstance(labels, torch.Tensor): labels = labels.detach().numpy()
-        bs = batch.size(0)
+    def __call__(self, batch, labels, sq_distances=None):
+        """
+        Semihard mining for all anchors at once, on the device of <batch>. Per anchor a random positive p is drawn,
+        then a random negative n with d(a,p) < d(a,n) < d(a,p) + margin, or any random negative if there is none.
+
+        Args:
+            batch:        torch.Tensor: Embeddings (BS x DIM).
+            labels:       torch.Tensor/nparray: Class of each embedding (BS).
+            sq_distances: torch.Tensor, optional: Precomputed (BS x BS) squared distances.
+        Returns:
+            MiningResult.
+        """
+        bs     = batch.size(0)
+        labels = torch.as_tensor(labels, device=batch.device).view(-1)
         #Return distance matrix for all elements in batch (BSxBS)
-        distances = self.pdist(batch.detach()).detach().cpu().numpy()
-
-        positives, negatives = [], []
-        anchors = []
-        for i in range(bs):
-            l, d = labels[i], distances[i]
-            neg = labels!=l; pos = labels==l
-
-            anchors.append(i)
-            pos[i] = 0
-            p      = np.random.choice(np.where(pos)[0])
-            positives.append(p)
-
-            #Find negatives that violate tripet constraint semi-negatives
-            neg_mask = np.logical_and(neg,d>d[p])
-            neg_mask = np.logical_and(neg_mask,d<self.margin+d[p])
-            if neg_mask.sum()>0:
-                negatives.append(np.random.choice(np.where(neg_mask)[0]))
-            else:
-                negatives.append(np.random.choice(np.where(neg)[0]))
-
-        sampled_triplets = [[a, p, n] for a, p, n in zip(anchors, positives, negatives)]
-
-        if return_distances:
-            return sampled_triplets, distances
-        else:
-            return sampled_triplets
-
-
-    def pdist(self, A):
-        prod = torch.mm(A, A.t())
-        norm = prod.diag().unsqueeze(1).expand_as(prod)
-        res = (norm + norm.t() - 2 * prod).clamp(min = 0)
-        return res.clamp(min = 0).sqrt()
+        if sq_distances is None:
+            sq_distances = sq_pdist(batch)
+        distances = sq_distances.detach().sqrt()
+        anchors = torch.arange(bs, device=batch.device)
+
+        same = labels.view(-1, 1) == labels.view(1, -1)
+        neg  = ~same
+        pos  = same.clone()
+        pos[anchors, anchors] = pos.sum(dim=1) <= 1 # the anchor only serves as its own positive if there is no other
+        positives = torch.multinomial(pos.float(), 1).view(-1)
+
+        #Find negatives that violate tripet constraint semi-negatives
+        d_ap     = distances[anchors, positives].view(-1, 1)
+        neg_mask = neg & (distances > d_ap) & (distances < self.margin + d_ap)
+
+        ### Rows without semihard negatives fall back to random negatives, rows without negatives to random samples
+        neg_mask = torch.where(neg_mask.any(dim=1, keepdim=True), neg_mask, neg)
+        neg_mask = torch.where(neg_mask.any(dim=1, keepdim=True), neg_mask, torch.ones_like(neg_mask))
+        negatives = torch.multinomial(neg_mask.float(), 1).view(-1)
+
+        return MiningResult(anchors, positives, negatives, sq_distances)
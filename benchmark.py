@@ -0,0 +1,396 @@
+import argparse, time, copy, glob, os, socket
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+from pytorch_lightning import Trainer, seed_everything
+from pytorch_lightning.callbacks import Callback
+from utils.auxiliaries import instantiate_from_config
+from data.basic_dml_dataset import normalization_params, normalize_batch
+
+
+def get_parser(**parser_kwargs):
+    parser = argparse.ArgumentParser(**parser_kwargs)
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="loader",
+        choices=["loader", "train", "ddp", "loss"],
+        help="loader: images/sec of the train dataloader with float32 vs. uint8 batches, per architecture. "
+        "train: training and validation throughput of each config in --configs on synthetic data. "
+        "ddp: scaling efficiency of the first --base config over --world_sizes cpu processes (gloo) on synthetic data. "
+        "loss: forward+backward time of the criterion of each --base config over --loss_batch_sizes on random embeddings",
+    )
+    parser.add_argument(
+        "--world_sizes",
+        nargs="*",
+        type=int,
+        default=[1, 2, 4, 8],
+        help="ddp mode: numbers of processes",
+    )
+    parser.add_argument(
+        "--loss_batch_sizes",
+        nargs="*",
+        type=int,
+        default=[64, 128, 256, 512, 1024],
+        help="loss mode: batch sizes",
+    )
+    parser.add_argument(
+        "--samples_per_class",
+        type=int,
+        default=2,
+        help="loss mode: samples per class of the random batches",
+    )
+    parser.add_argument(
+        "--configs",
+        nargs="*",
+        default=sorted(glob.glob("configs/*.yaml")),
+        help="train mode: configs to benchmark, each is run separately",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="train mode: batch size",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="train mode: dataloader workers",
+    )
+    parser.add_argument(
+        "--synthetic",
+        nargs="*",
+        default=["n_classes=20", "images_per_class=20", "image_size=[300,500]"],
+        help="train mode: parameters of data.synthetic.DATA as `key=value`",
+    )
+    parser.add_argument(
+        "-b",
+        "--base",
+        nargs="*",
+        metavar="configs/marginloss.yaml",
+        help="paths to base configs. Loaded from left-to-right. "
+        "Parameters can be overwritten or added with command-line options of the form `nested.key=value`.",
+        default=["configs/marginloss.yaml"],
+    )
+    parser.add_argument(
+        "--archs",
+        nargs="*",
+        default=["resnet50", "bninception", "vit_small_patch16_224", "clip_vit_b32"],
+        help="architecture names, only used to select normalization and crop size of the data pipeline",
+    )
+    parser.add_argument(
+        "--n_batches",
+        type=int,
+        default=50,
+        help="number of timed batches per run",
+    )
+    parser.add_argument(
+        "--n_warmup",
+        type=int,
+        default=5,
+        help="number of untimed batches per run (worker startup)",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device the batches are transferred to (and normalized on for uint8 batches)",
+    )
+    return parser
+
+
+def load_config(opt, unknown):
+    configs = [OmegaConf.load(cfg) for cfg in opt.base]
+    cli = OmegaConf.from_dotlist(unknown)
+    return OmegaConf.merge(*configs, cli)
+
+
+def time_loader(loader, n_batches, n_warmup, device, f_norm=None):
+    """Iterates <loader> and returns images/sec over <n_batches> batches, including host-to-device transfer and <f_norm>."""
+    n_images, start = 0, None
+    for i, batch in enumerate(loader):
+        if i == n_warmup:
+            if device.type == 'cuda': torch.cuda.synchronize()
+            start = time.perf_counter()
+        inputs = batch[0].to(device, non_blocking=True)
+        if f_norm is not None:
+            inputs = f_norm(inputs)
+        if i >= n_warmup:
+            n_images += len(inputs)
+        if i + 1 == n_warmup + n_batches:
+            break
+    if start is None:
+        raise ValueError(f'Loader yielded fewer than n_warmup={n_warmup} batches.')
+    if device.type == 'cuda': torch.cuda.synchronize()
+    return n_images / (time.perf_counter() - start)
+
+
+class StepTimer(Callback):
+    """Measures the time spent waiting for each training batch (loading, transfer, batch transforms) and the time of
+    the training step itself. The first <n_warmup> steps are discarded."""
+    def __init__(self, n_warmup, device):
+        self.n_warmup = n_warmup
+        self.device = device
+        self.wait_times, self.step_times, self.n_images = [], [], []
+        self.last_end, self.start = None, None
+
+    def now(self):
+        if self.device.type == 'cuda': torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+        self.start = self.now()
+        self.wait = self.start - self.last_end if self.last_end is not None else None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        self.last_end = self.now()
+        if self.wait is not None and batch_idx >= self.n_warmup:
+            self.wait_times.append(self.wait)
+            self.step_times.append(self.last_end - self.start)
+            self.n_images.append(len(batch[1]))
+
+    def summary(self):
+        wait, step = np.array(self.wait_times), np.array(self.step_times)
+        total = wait + step
+        return {'images/sec': np.sum(self.n_images) / np.sum(total), 'data_wait': np.sum(wait) / np.sum(total),
+                'p50': np.percentile(total, 50), 'p90': np.percentile(total, 90), 'p99': np.percentile(total, 99)}
+
+
+def align_embed_dims(config, default_dim=512):
+    """
+    Sets the criterion embed_dim of <config> to the dimension its architecture outputs. Shipped configs may leave
+    embed_dim at -1 (the backbone's own dimension, only supported by architectures without a linear embedding head,
+    <default_dim> is used for the others) or give the criterion a different one.
+    """
+    arch = config.model.params.config.Architecture
+    try:
+        net = instantiate_from_config(arch)
+    except RuntimeError:
+        arch.params.embed_dim = default_dim
+        net = instantiate_from_config(arch)
+    with torch.no_grad():
+        embed_dim = net.eval()(torch.zeros(1, 3, 224, 224))['embeds'].shape[-1]
+    if "embed_dim" in config.model.params.config.Loss.params:
+        config.model.params.config.Loss.params.embed_dim = embed_dim
+
+
+def setup_train_run(config, opt, device):
+    """Datamodule and model of <config> as built in main.py, on synthetic data and without pretrained weights."""
+    config = copy.deepcopy(config)
+    synthetic = OmegaConf.from_dotlist(opt.synthetic)
+    config.data.params.pop("test", None)
+    config.data.params.batch_size = opt.batch_size
+    config.data.params.num_workers = opt.num_workers
+    config.data.params.stage_dir = None
+    for split in ["train", "validation"]:
+        split_params = config.data.params[split].params
+        config.data.params[split].target = "data.synthetic.DATA"
+        split_params.root = None
+        split_params.pop("ooDML_split_id", None)
+        config.data.params[split].params = OmegaConf.merge(split_params, synthetic)
+    config.model.target = "models.dml_trainer.DML_Model"
+    config.model.params.config.Architecture.params.pretraining = None
+    config.model.params.config.Evaluation.params.evaluate_on_gpu = device.type == 'cuda'
+    align_embed_dims(config)
+
+    data = instantiate_from_config(config.data)
+    config.model.params.config.Evaluation.params.n_classes = data.datasets['validation'].n_classes
+    config.model.params.config.Loss.params.n_classes = data.datasets['train'].n_classes
+
+    model = instantiate_from_config(config.model)
+    train_dataset = data.datasets['train'].dataset
+    model.set_input_pipeline(train_dataset.norm_mean, train_dataset.norm_std, train_dataset.flip_channels,
+                             train_dataset.batch_transform, train_dataset.n_views)
+    model.type_optim = config.model.get("type_optim", "adam")
+    model.weight_decay, model.gamma, model.tau = config.model.weight_decay, config.model.gamma, config.model.tau
+    model.learning_rate = config.model.base_learning_rate
+    return data, model
+
+
+def run_train_benchmark(cfg, opt, unknown, device):
+    config = load_config(argparse.Namespace(base=[cfg]), unknown)
+    data, model = setup_train_run(config, opt, device)
+
+    timer = StepTimer(opt.n_warmup, device)
+    trainer = Trainer(accelerator='gpu' if device.type == 'cuda' else 'cpu', devices=1, max_steps=opt.n_warmup + opt.n_batches,
+                      callbacks=[timer], logger=False, enable_checkpointing=False, enable_progress_bar=False,
+                      enable_model_summary=False, num_sanity_val_steps=0, check_val_every_n_epoch=10**6)
+    trainer.fit(model, data)
+    if len(timer.step_times) == 0:
+        raise ValueError(f'Trained fewer than n_warmup={opt.n_warmup} steps, increase the synthetic dataset size.')
+
+    start = time.perf_counter()
+    trainer.validate(model, data, verbose=False)
+    return {**timer.summary(), 'val_time': time.perf_counter() - start}
+
+
+def benchmark_train(opt, unknown):
+    device = torch.device(opt.device)
+    results = {}
+    for cfg in opt.configs:
+        seed_everything(0)
+        try:
+            results[cfg] = run_train_benchmark(cfg, opt, unknown, device)
+        except Exception as e:
+            ## Report broken configs instead of aborting the whole benchmark
+            print(f"\n[{cfg}] failed: {type(e).__name__}: {e}\n")
+            results[cfg] = None
+
+    print(f"\nTRAINING THROUGHPUT (synthetic data, batch_size: {opt.batch_size}, num_workers: {opt.num_workers}, timed steps: {opt.n_batches}, device: {device}):")
+    print(f"{'config':<32}{'images/sec':>12}{'data wait':>11}{'p50 [s]':>10}{'p90 [s]':>10}{'p99 [s]':>10}{'val [s]':>10}")
+    for cfg, r in results.items():
+        if r is None:
+            print(f"{cfg:<32}{'failed':>12}")
+            continue
+        print(f"{cfg:<32}{r['images/sec']:>12.1f}{r['data_wait']:>10.1%}{r['p50']:>10.3f}{r['p90']:>10.3f}{r['p99']:>10.3f}{r['val_time']:>10.1f}")
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ddp_worker(rank, world_size, port, opt, unknown, results):
+    """One DDP rank: trains the model of opt.base[0] on synthetic data and reports its throughput and the fraction of
+    samples that were also used by another rank in the same step."""
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(os.cpu_count() // world_size, 1))
+    seed_everything(0)
+
+    config = load_config(argparse.Namespace(base=opt.base[:1]), unknown)
+    data, model = setup_train_run(config, opt, torch.device('cpu'))
+    loader = data.train_dataloader()
+    loader.batch_sampler.set_epoch(0)
+    net = torch.nn.parallel.DistributedDataParallel(model.model)
+    optimizer = torch.optim.SGD(list(net.parameters()) + list(model.loss.parameters()), lr=1e-5)
+
+    indices, n_images = [], 0
+    for i, batch in enumerate(loader):
+        if i == opt.n_warmup:
+            dist.barrier()
+            start = time.perf_counter()
+        inputs, labels = batch[0], batch[1]
+        if inputs.dtype == torch.uint8:
+            inputs = model.f_norm(inputs)
+        loss = model.loss(net(inputs)['embeds'], labels, global_step=i, split="train")
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if i >= opt.n_warmup:
+            indices.append(batch[2].tolist())
+            n_images += len(labels)
+        if i + 1 == opt.n_warmup + opt.n_batches:
+            break
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    all_indices = [None] * world_size
+    dist.all_gather_object(all_indices, indices)
+    if rank == 0:
+        n_steps = min(len(x) for x in all_indices)
+        n_total = sum(len(x[step]) for x in all_indices for step in range(n_steps))
+        n_unique = sum(len(set(sum([x[step] for x in all_indices], []))) for step in range(n_steps))
+        results[world_size] = {'images/sec': n_images * world_size / elapsed, 'duplicates': 1 - n_unique / n_total}
+    dist.destroy_process_group()
+
+
+def benchmark_ddp(opt, unknown):
+    ### Create the synthetic images once instead of in every rank
+    instantiate_from_config({"target": "data.synthetic.DATA", "params": {"arch": "resnet50", **OmegaConf.to_container(OmegaConf.from_dotlist(opt.synthetic))}})
+
+    results = mp.Manager().dict()
+    for world_size in opt.world_sizes:
+        mp.spawn(ddp_worker, args=(world_size, free_port(), opt, unknown, results), nprocs=world_size)
+
+    base = results[opt.world_sizes[0]]['images/sec'] / opt.world_sizes[0]
+    print(f"\nDDP SCALING [gloo, cpu] ({opt.base[0]}, synthetic data, batch_size per rank: {opt.batch_size}, timed steps: {opt.n_batches}):")
+    print(f"{'processes':<12}{'images/sec':>12}{'efficiency':>12}{'duplicates':>12}")
+    for world_size in opt.world_sizes:
+        r = results[world_size]
+        print(f"{world_size:<12}{r['images/sec']:>12.1f}{r['images/sec'] / (world_size * base):>12.1%}{r['duplicates']:>12.1%}")
+    return dict(results)
+
+
+def time_loss(criterion, embed_dim, batch_size, samples_per_class, opt, device):
+    """Mean forward+backward time of <criterion> on random unit-norm embeddings of class-balanced batches."""
+    labels = torch.arange(batch_size // samples_per_class, device=device).repeat_interleave(samples_per_class)
+    times = []
+    for i in range(opt.n_warmup + opt.n_batches):
+        embeds = torch.nn.functional.normalize(torch.randn(len(labels), embed_dim, device=device), dim=-1).requires_grad_()
+        if device.type == 'cuda': torch.cuda.synchronize()
+        start = time.perf_counter()
+        loss = criterion(embeds, labels, global_step=i, split="train")
+        loss.backward()
+        if device.type == 'cuda': torch.cuda.synchronize()
+        if i >= opt.n_warmup:
+            times.append(time.perf_counter() - start)
+    return np.mean(times)
+
+
+def benchmark_loss(opt, unknown):
+    device = torch.device(opt.device)
+    n_classes = max(opt.loss_batch_sizes) // opt.samples_per_class
+    results = {}
+    for cfg in opt.base:
+        config = OmegaConf.to_container(load_config(argparse.Namespace(base=[cfg]), unknown).model.params.config, resolve=True)
+        config["Loss"]["params"]["n_classes"] = n_classes
+        config["Loss"]["params"]["batchminer"] = instantiate_from_config(config["Batchmining"]) if "Batchmining" in config.keys() else None
+        criterion = instantiate_from_config(config["Loss"]).to(device)
+        embed_dim = config["Architecture"]["params"]["embed_dim"]
+        results[cfg] = {bs: time_loss(criterion, embed_dim, bs, opt.samples_per_class, opt, device) for bs in opt.loss_batch_sizes}
+
+    print(f"\nLOSS FORWARD+BACKWARD [ms] (random embeddings, samples_per_class: {opt.samples_per_class}, timed steps: {opt.n_batches}, device: {device}):")
+    print(f"{'config':<32}" + "".join(f"{'bs=' + str(bs):>10}" for bs in opt.loss_batch_sizes))
+    for cfg, r in results.items():
+        print(f"{cfg:<32}" + "".join(f"{1000 * r[bs]:>10.2f}" for bs in opt.loss_batch_sizes))
+    return results
+
+
+def benchmark_loader(config, opt):
+    device = torch.device(opt.device)
+    results = {}
+    for arch in opt.archs:
+        for uint8_batches in [False, True]:
+            data_config = copy.deepcopy(config.data)
+            data_config.params.pop("validation", None)
+            data_config.params.pop("test", None)
+            data_config.params.train.params.arch = arch
+            data_config.params.train.params.uint8_batches = uint8_batches
+            data = instantiate_from_config(data_config)
+
+            f_norm = None
+            if uint8_batches:
+                mean, std = normalization_params(arch)
+                mean, std = torch.tensor(mean, device=device).view(1, -1, 1, 1), torch.tensor(std, device=device).view(1, -1, 1, 1)
+                f_norm = lambda x: normalize_batch(x, mean, std, 'bninception' in arch)
+
+            results[(arch, uint8_batches)] = time_loader(data.train_dataloader(), opt.n_batches, opt.n_warmup, device, f_norm)
+
+    print(f"\nLOADER THROUGHPUT [images/sec] (num_workers: {data.num_workers}, batch_size: {data.batch_size}, device: {device}):")
+    print(f"{'arch':<28}{'float32':>12}{'uint8':>12}{'speedup':>10}")
+    for arch in opt.archs:
+        fp32, uint8 = results[(arch, False)], results[(arch, True)]
+        print(f"{arch:<28}{fp32:>12.1f}{uint8:>12.1f}{uint8/fp32:>9.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    # Benchmark entry point. Uses the same config files as main.py, `nested.key=value` arguments overwrite config
+    # parameters, e.g. `data.params.train.params.root=/path/to/cub200`.
+    parser = get_parser()
+    opt, unknown = parser.parse_known_args()
+
+    if opt.mode == "loader":
+        benchmark_loader(load_config(opt, unknown), opt)
+    elif opt.mode == "train":
+        benchmark_train(opt, unknown)
+    elif opt.mode == "ddp":
+        benchmark_ddp(opt, unknown)
+    elif opt.mode == "loss":
+        benchmark_loss(opt, unknown)
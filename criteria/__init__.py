@@ -61,6 +61,11 @@ def add_criterion_optim_params(criterion, to_optim):
     if loss_lib.REQUIRES_OPTIM:
         if hasattr(criterion,'optim_dict_list') and criterion.optim_dict_list is not None:
             to_optim += criterion.optim_dict_list
+        elif getattr(criterion, 'proxy_bank', None) is not None:
+            ### Proxies in a ProxyBank are updated by the bank itself, only add the remaining parameters
+            params = list(criterion.parameters())
+            if params:
+                to_optim += [{'params':params, 'lr':criterion.lr}]
         else:
             to_optim    += [{'params':criterion.parameters(), 'lr':criterion.lr}]
 
@@ -39,22 +39,26 @@ class Criterion(torch.nn.Module):
             labels: nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
         ####NOTE: Normalize Angular Loss, but not normalize npair loss!
-        anchors, positives, negatives = self.batchminer(batch, labels)
-        anchors, positives, negatives = batch[anchors], batch[positives], batch[negatives]
-        n_anchors, n_positives, n_negatives = F.normalize(anchors, dim=1), F.normalize(positives, dim=1), F.normalize(negatives, dim=-1)
+        mined = self.batchminer(batch, labels)
+        if not len(mined):
+            return batch.sum()*0.
+        anchors, positives = batch[mined.anchors], batch[mined.positives]
+        n_anchors, n_positives, n_batch = F.normalize(anchors, dim=1), F.normalize(positives, dim=1), F.normalize(batch, dim=-1)
 
-        is_term1 = 4*self.tan_angular_margin**2*(n_anchors + n_positives)[:,None,:].bmm(n_negatives.permute(0,2,1))
-        is_term2 = 2*(1+self.tan_angular_margin**2)*n_anchors[:,None,:].bmm(n_positives[:,None,:].permute(0,2,1))
-        is_term1 = is_term1.view(is_term1.shape[0], is_term1.shape[-1])
-        is_term2 = is_term2.view(-1, 1)
+        ### Terms against all samples, restricted to the negative set of each anchor by masking
+        is_term1 = 4*self.tan_angular_margin**2*(n_anchors + n_positives).mm(n_batch.T)
+        is_term2 = 2*(1+self.tan_angular_margin**2)*(n_anchors*n_positives).sum(dim=1, keepdim=True)
 
-        inner_sum_ang = is_term1 - is_term2
-        angular_loss = torch.mean(torch.log(torch.sum(torch.exp(inner_sum_ang), dim=1) + 1))
+        inner_sum_ang = self.masked_log1p_sum_exp(is_term1 - is_term2, mined.negatives)
+        angular_loss  = torch.mean(inner_sum_ang)
 
-
-        inner_sum_npair = anchors[:,None,:].bmm((negatives - positives[:,None,:]).permute(0,2,1))
-        inner_sum_npair = inner_sum_npair.view(inner_sum_npair.shape[0], inner_sum_npair.shape[-1])
-        npair_loss = torch.mean(torch.log(torch.sum(torch.exp(inner_sum_npair.clamp(max=50,min=-50)), dim=1) + 1))
+        inner_sum_npair = anchors.mm(batch.T) - (anchors*positives).sum(dim=1, keepdim=True)
+        npair_loss      = torch.mean(self.masked_log1p_sum_exp(inner_sum_npair.clamp(max=50,min=-50), mined.negatives))
 
         loss = npair_loss + self.lam*angular_loss + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
         return loss
+
+    def masked_log1p_sum_exp(self, x, mask):
+        """log(1 + sum_j exp(x_ij)) over the entries j of <mask> per row."""
+        x = x.masked_fill(~mask, -float('inf'))
+        return torch.logsumexp(torch.cat([torch.zeros_like(x[:,:1]), x], dim=1), dim=1)
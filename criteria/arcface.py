@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from criteria import partial_proxies
 
 """================================================================================================="""
 ALLOWED_MINING_OPS  = None
@@ -9,7 +10,7 @@ REQUIRES_OPTIM      = True
 
 ### This implementation follows the pseudocode provided in the original paper.
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             margin:             Triplet Margin.
@@ -26,9 +27,11 @@ class Criterion(torch.nn.Module):
         self.angular_margin = opt.loss_arcface_angular_margin
         self.feature_scale  = opt.loss_arcface_feature_scale
 
-        self.class_map = torch.nn.Parameter(torch.Tensor(opt.n_classes, opt.embed_dim))
-        stdv = 1. / np.sqrt(self.class_map.size(1))
-        self.class_map.data.uniform_(-stdv, stdv)
+        ### With partial proxies (see criteria.partial_proxies) the class map lives in the ProxyBank instead.
+        stdv = 1. / np.sqrt(opt.embed_dim)
+        class_map = torch.Tensor(opt.n_classes, opt.embed_dim).uniform_(-stdv, stdv)
+        self.proxy_bank = partial_proxies.from_opt(opt, opt.n_classes, (opt.embed_dim,), class_map, opt.loss_arcface_lr)
+        self.class_map  = torch.nn.Parameter(class_map) if self.proxy_bank is None else None
 
         self.name  = 'arcface'
 
@@ -40,14 +43,18 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        bs, labels = len(batch), labels.to(self.par.device)
+        bs = len(batch)
+        if self.proxy_bank is None:
+            class_map, labels = self.class_map, torch.as_tensor(labels, device=batch.device).long()
+        else:
+            class_map, labels, _ = self.proxy_bank(batch, labels)
 
-        class_map      = torch.nn.functional.normalize(self.class_map, dim=1)
+        class_map      = torch.nn.functional.normalize(class_map, dim=1)
         #Note that the similarity becomes the cosine for normalized embeddings. Denoted as 'fc7' in the paper pseudocode.
         cos_similarity = batch.mm(class_map.T).clamp(min=1e-10, max=1-1e-10)
 
-        pick = torch.zeros(bs, self.par.n_classes).byte().to(self.par.device)
-        pick[torch.arange(bs), labels] = 1
+        pick = torch.zeros(bs, len(class_map), dtype=torch.bool, device=batch.device)
+        pick[torch.arange(bs, device=batch.device), labels] = True
 
         original_target_logit  = cos_similarity[pick]
 
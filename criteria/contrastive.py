@@ -3,7 +3,7 @@ import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = False
 
@@ -32,14 +32,10 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        sampled_triplets = self.batchminer(batch, labels)
+        mined = self.batchminer(batch, labels)
 
-        anchors   = [triplet[0] for triplet in sampled_triplets]
-        positives = [triplet[1] for triplet in sampled_triplets]
-        negatives = [triplet[2] for triplet in sampled_triplets]
-
-        pos_dists = torch.mean(F.relu(nn.PairwiseDistance(p=2)(batch[anchors,:], batch[positives,:]) -  self.pos_margin))
-        neg_dists = torch.mean(F.relu(self.neg_margin - nn.PairwiseDistance(p=2)(batch[anchors,:], batch[negatives,:])))
+        pos_dists = torch.mean(F.relu(mined.pair_distances(batch, mined.anchors, mined.positives) -  self.pos_margin))
+        neg_dists = torch.mean(F.relu(self.neg_margin - mined.pair_distances(batch, mined.anchors, mined.negatives)))
 
         loss      = pos_dists + neg_dists
 
@@ -1,10 +1,11 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from batchminer.mining_result import sq_pdist
 
 
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = False
 ### MarginLoss with trainable class separation margin beta. Runs on Mini-batches as well.
@@ -37,26 +38,25 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels: nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        sampled_triplets, distances = self.batchminer(batch, labels, return_distances=True)
-        a_list, p_list, n_list = [], [], []
-
-        loss, count = 0, 0
-        for i in range(len(labels)):
-            a,_,n  = sampled_triplets[i]
-            neg    = np.array(labels!=labels[i]); pos = np.array(labels==labels[i])
-            pos[i] = 0
-
-            if np.sum(pos)>1:
-                pos_idxs = np.where(pos)[0]
-                p        = pos_idxs[np.argmin(distances[i][pos])]
-                loss    += -F.log_softmax(torch.stack([self.similarity(batch[a],batch[p]),self.similarity(batch[a],batch[n])]).unsqueeze(0)/self.temp)[:,0]
-                count   += 1
-        loss = loss/count
-
-        return loss
-
-    def similarity(self,x,y, mode='euclidean'):
-        if mode=='euclidean':
-            return 1-torch.dist(x,y,p=2)/2
-        elif mode=='cosine':
-            return x.T.mm(y)
+        mined  = self.batchminer(batch, labels)
+        labels = torch.as_tensor(labels, device=batch.device).view(-1)
+
+        ### Easy positive: the closest other sample of the anchor's class, for anchors with more than one of them
+        pos = labels.view(-1, 1) == labels.view(1, -1)
+        pos.fill_diagonal_(False)
+        sq_distances = mined.sq_distances if mined.sq_distances is not None else sq_pdist(batch)
+        easy_pos = sq_distances.detach().masked_fill(~pos, float('inf')).argmin(dim=1)
+
+        keep = pos.sum(dim=1)[mined.anchors] > 1
+        if not keep.any():
+            return batch.sum() * 0.
+        a, n = mined.anchors[keep], mined.negatives[keep]
+        p    = easy_pos[a]
+
+        sims = torch.stack([self.similarity(mined.pair_distances(batch, a, p)), self.similarity(mined.pair_distances(batch, a, n))], dim=1)
+        loss = -F.log_softmax(sims/self.temp, dim=1)[:,0]
+
+        return loss.mean()
+
+    def similarity(self, dists):
+        return 1-dists/2
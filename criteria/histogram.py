@@ -11,7 +11,7 @@ REQUIRES_OPTIM      = False
 #NOTE: This implementation follows: https://github.com/valerystrizh/pytorch-histogram-loss
 
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             margin:             Triplet Margin.
@@ -22,10 +22,6 @@ class Criterion(torch.nn.Module):
         self.nbins     = opt.loss_histogram_nbins
         self.bin_width = 2/(self.nbins - 1)
 
-        # We require a numpy and torch support as parts of the computation require numpy.
-        self.support        = np.linspace(-1,1,self.nbins).reshape(-1,1)
-        self.support_torch  = torch.linspace(-1,1,self.nbins).reshape(-1,1).to(opt.device)
-
         self.name           = 'histogram'
 
         ####
@@ -42,67 +38,43 @@ class Criterion(torch.nn.Module):
         """
         #The original paper utilizes similarities instead of distances.
         similarity = batch.mm(batch.T)
-
-        bs         = labels.size()[0]
-
-        ### We create a equality matrix for labels occuring in the batch
-        label_eqs = (labels.repeat(bs, 1)  == labels.view(-1, 1).repeat(1, bs))
+        labels     = torch.as_tensor(labels, device=batch.device).view(-1)
+        bs         = len(labels)
 
         ### Because the similarity matrix is symmetric, we will only utilise the upper triangular.
-        ### These values are indexed by sim_inds
-        sim_inds = torch.triu(torch.ones(similarity.size()), 1).bool().to(self.par.device)
+        rows, cols = torch.triu_indices(bs, bs, 1, device=batch.device)
+        unique_sim = similarity[rows, cols]
 
         ### For the upper triangular similarity matrix, we want to know where our positives/anchors and negatives are:
-        pos_inds = label_eqs[sim_inds].repeat(self.nbins, 1)
-        neg_inds = ~label_eqs[sim_inds].repeat(self.nbins, 1)
-
-        ###
-        n_pos = pos_inds[0].sum()
-        n_neg = neg_inds[0].sum()
-
-        ### Extract upper triangular from the similarity matrix. (produces a one-dim vector)
-        unique_sim = similarity[sim_inds].view(1, -1)
+        pos_inds = labels[rows] == labels[cols]
 
-        ### We broadcast this vector to each histogram bin. Each bin entry requires a different summation in self.histogram()
-        unique_sim_rep = unique_sim.repeat(self.nbins, 1)
-
-        ### This assigns bin-values for float-similarities. The conversion to numpy is important to avoid rounding errors in torch.
-        assigned_bin_values = ((unique_sim_rep.detach().cpu().numpy() + 1) / self.bin_width).astype(int) * self.bin_width - 1
-
-        ### We now compute the histogram over distances
-        hist_pos_sim = self.histogram(unique_sim_rep, assigned_bin_values, pos_inds, n_pos)
-        hist_neg_sim = self.histogram(unique_sim_rep, assigned_bin_values, neg_inds, n_neg)
+        ### We now compute the histogram over similarities
+        hist_pos_sim = self.histogram(unique_sim, pos_inds)
+        hist_neg_sim = self.histogram(unique_sim, ~pos_inds)
 
         ### Compute the CDF for the positive similarity histogram
-        hist_pos_rep  = hist_pos_sim.view(-1, 1).repeat(1, hist_pos_sim.size()[0])
-        hist_pos_inds = torch.tril(torch.ones(hist_pos_rep.size()), -1).bool()
-        hist_pos_rep[hist_pos_inds] = 0
-        hist_pos_cdf  = hist_pos_rep.sum(0)
+        hist_pos_cdf = torch.cumsum(hist_pos_sim, dim=0)
 
         loss = torch.sum(hist_neg_sim * hist_pos_cdf)
 
         return loss
 
 
-    def histogram(self, unique_sim_rep, assigned_bin_values, idxs, n_elem):
+    def histogram(self, sims, idxs):
         """
-        Compute the histogram over similarities.
+        Compute the histogram over similarities with linear (soft) bin assignment: each similarity adds 1-frac to its
+        lower bin and frac to the upper bin, with frac its relative position between the two bin centers.
         Args:
-            unique_sim_rep:      torch tensor of shape nbins x n_unique_neg_similarities.
-            assigned_bin_values: Bin value for each similarity value in unique_sim_rep.
-            idxs:                positive/negative entry indices in unique_sim_rep
-            n_elem:              number of elements in unique_sim_rep.
+            sims: torch tensor of similarities in [-1, 1].
+            idxs: bool tensor selecting the positive/negative entries of <sims>.
         """
-        # Cloning is required because we change the similarity matrix in-place, but need it for the
-        # positive AND negative histogram. Note that clone() allows for backprop.
-        usr = unique_sim_rep.clone()
-        # For each bin (and its lower neighbour bin) we find the distance values that belong.
-        indsa = torch.tensor((assigned_bin_values==(self.support-self.bin_width) ) & idxs.detach().cpu().numpy())
-        indsb = torch.tensor((assigned_bin_values==self.support) & idxs.detach().cpu().numpy())
-        # Set all irrelevant similarities to 0
-        usr[~(indsb|indsa)]=0
-        #
-        usr[indsa] = (usr  - self.support_torch + self.bin_width)[indsa] / self.bin_width
-        usr[indsb] = (-usr + self.support_torch + self.bin_width)[indsb] / self.bin_width
-
-        return usr.sum(1)/n_elem
+        idxs = idxs.to(sims.dtype)
+        pos  = (sims + 1) / self.bin_width
+        bins = pos.detach().floor().clamp(0, self.nbins - 1).long()
+        frac = pos - bins
+
+        hist = sims.new_zeros(self.nbins)
+        hist = hist.scatter_add(0, bins, (1 - frac) * idxs)
+        hist = hist.scatter_add(0, (bins + 1).clamp(max=self.nbins - 1), frac * idxs * (bins + 1 < self.nbins))
+
+        return hist/idxs.sum().clamp(min=1)
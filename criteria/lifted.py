@@ -33,14 +33,14 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        anchors, positives, negatives = self.batchminer(batch, labels)
+        mined = self.batchminer(batch, labels)
+        if not len(mined):
+            return self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
 
-        loss = []
-        for anchor, positive_set, negative_set in zip(anchors, positives, negatives):
-            anchor, positive_set, negative_set = batch[anchor, :].view(1,-1), batch[positive_set, :].view(1,len(positive_set),-1), batch[negative_set, :].view(1,len(negative_set),-1)
-            pos_term = torch.logsumexp(nn.PairwiseDistance(p=2)(anchor[:,:,None], positive_set.permute(0,2,1)), dim=1)
-            neg_term = torch.logsumexp(self.margin - nn.PairwiseDistance(p=2)(anchor[:,:,None], negative_set.permute(0,2,1)), dim=1)
-            loss.append(F.relu(pos_term + neg_term))
+        ### Per anchor: logsumexp of the distances to its positives plus logsumexp of margin - distances to its negatives
+        dists    = mined.pair_distances(batch, mined.anchors.view(-1,1), torch.arange(len(batch), device=batch.device).view(1,-1))
+        pos_term = torch.logsumexp(dists.masked_fill(~mined.positives, -float('inf')), dim=1)
+        neg_term = torch.logsumexp((self.margin - dists).masked_fill(~mined.negatives, -float('inf')), dim=1)
 
-        loss = torch.mean(torch.stack(loss)) + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
+        loss = torch.mean(F.relu(pos_term + neg_term)) + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
         return loss
@@ -3,7 +3,7 @@ import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = True
 REQUIRES_LOGGING    = False
@@ -50,36 +50,28 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels: nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        sampled_triplets = self.batchminer(batch, labels)
+        mined = self.batchminer(batch, labels)
 
-        if len(sampled_triplets):
-            d_ap, d_an = [],[]
-            for triplet in sampled_triplets:
-                train_triplet = {'Anchor': batch[triplet[0],:], 'Positive':batch[triplet[1],:], 'Negative':batch[triplet[2]]}
-
-                pos_dist = ((train_triplet['Anchor']-train_triplet['Positive']).pow(2).sum()+1e-8).pow(1/2)
-                neg_dist = ((train_triplet['Anchor']-train_triplet['Negative']).pow(2).sum()+1e-8).pow(1/2)
-
-                d_ap.append(pos_dist)
-                d_an.append(neg_dist)
-            d_ap, d_an = torch.stack(d_ap), torch.stack(d_an)
+        if len(mined):
+            d_ap = mined.pair_distances(batch, mined.anchors, mined.positives)
+            d_an = mined.pair_distances(batch, mined.anchors, mined.negatives)
 
             if self.beta_constant:
                 beta = self.beta
             else:
-                beta = torch.stack([self.beta[labels[triplet[0]]] for triplet in sampled_triplets]).to(torch.float).to(d_ap.device)
+                labels = torch.as_tensor(labels, device=d_ap.device).view(-1)
+                beta   = self.beta[labels[mined.anchors]]
 
             pos_loss = torch.nn.functional.relu(d_ap-beta+self.margin)
             neg_loss = torch.nn.functional.relu(beta-d_an+self.margin)
 
-            pair_count = torch.sum((pos_loss>0.)+(neg_loss>0.)).to(torch.float).to(d_ap.device)
-
-            if pair_count == 0.:
-                loss = torch.sum(pos_loss+neg_loss)
-            else:
-                loss = torch.sum(pos_loss+neg_loss)/pair_count
+            ### Without active triplets the sum is 0 as well, clamping avoids a host sync on the count
+            pair_count = torch.sum((pos_loss>0.)+(neg_loss>0.)).to(torch.float)
+            loss = torch.sum(pos_loss+neg_loss)/pair_count.clamp(min=1)
 
-            if self.nu: loss = loss + beta_regularisation_loss.to(torch.float).to(d_ap.device)
+            ### Pushes the class margins beta of the mined anchors towards 0, i.e. towards tighter classes
+            if self.nu and not self.beta_constant:
+                loss = loss + self.nu * torch.sum(beta)
         else:
             loss = torch.tensor(0.).to(torch.float).to(batch.device)
 
@@ -1,8 +1,6 @@
 import numpy as np
-import copy
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
-import copy
 
 
 """================================================================================================="""
@@ -83,24 +81,16 @@ class Criterion(torch.nn.Module):
 
     ###
     def sample_mask(self, sims):
-        ### Get Indices/Sampling Bounds
-        bsame_labels = copy.deepcopy(self.bsame_labels)
-        bdiff_labels = copy.deepcopy(self.bdiff_labels)
-        pos_bound, neg_bound = [], []
-        bound = []
-        for i in range(len(sims)):
-            pos_ixs    = bsame_labels[i]
-            neg_ixs    = bdiff_labels[i]
-            pos_ixs[i] = False
-            pos_bsims  = self.similarity[i][pos_ixs]
-            neg_bsims  = self.similarity[i][neg_ixs]
-            if self.d_mode=='euclidean':
-                pos_bound.append(pos_bsims.max())
-                neg_bound.append(neg_bsims.min())
-            else:
-                pos_bound.append(pos_bsims.min())
-                neg_bound.append(neg_bsims.max())
-        pos_bound, neg_bound = torch.stack(pos_bound), torch.stack(neg_bound)
+        ### Get Indices/Sampling Bounds: hardest other positive and hardest negative of each sample, via masked reductions
+        sims     = sims.detach()
+        pos_ixs  = self.bsame_labels & ~torch.eye(len(sims), dtype=torch.bool, device=sims.device)
+        neg_ixs  = self.bdiff_labels
+        if self.d_mode=='euclidean':
+            pos_bound = sims.masked_fill(~pos_ixs, -float('inf')).max(dim=1)[0]
+            neg_bound = sims.masked_fill(~neg_ixs,  float('inf')).min(dim=1)[0]
+        else:
+            pos_bound = sims.masked_fill(~pos_ixs,  float('inf')).min(dim=1)[0]
+            neg_bound = sims.masked_fill(~neg_ixs, -float('inf')).max(dim=1)[0]
         ### Get LogSumExp-Masks
         if self.d_mode=='euclidean':
             self.neg_mask = neg_mask = self.bdiff_labels*((self.similarity - self.margin) < pos_bound)
@@ -28,28 +28,27 @@ class Criterion(torch.nn.Module):
 
 
     def forward(self, batch, labels, **kwargs):
-        anchors, positives, negatives = self.batchminer(batch, labels)
+        """
+        Args:
+            batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
+            labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
+        """
+        mined = self.batchminer(batch, labels)
+        if not len(mined):
+            return batch.sum()*0.
 
         ##
-        loss  = 0
-        if 'bninception' in self.pars.arch:
+        if 'bninception' in getattr(self.pars, 'arch', ''):
             ### NPair does not allow for a logsumexp - notation, hence the clamping to avoid overflow!
             batch = batch/4
-        for anchor, positive, negative_set in zip(anchors, positives, negatives):
-            a_embs, p_embs, n_embs = batch[anchor:anchor+1], batch[positive:positive+1], batch[negative_set]
-            inner_sum = a_embs[:,None,:].bmm((n_embs - p_embs[:,None,:]).permute(0,2,1))
-            inner_sum = inner_sum.view(inner_sum.shape[0], inner_sum.shape[-1])
-            loss  = loss + torch.mean(torch.log(torch.sum(torch.exp(inner_sum), dim=1) + 1))/len(anchors)
-            loss  = loss + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))/len(anchors)
-
-
-
-        # a_embs, p_embs, n_embs = batch[anchors], batch[positives], batch[negatives]
-        # inner_sum = a_embs[:,None,:].bmm((n_embs - p_embs[:,None,:]).permute(0,2,1))
-        # inner_sum = inner_sum.view(inner_sum.shape[0], inner_sum.shape[-1])
-        #
-        # loss      = torch.mean(torch.log(torch.sum(torch.exp(inner_sum), dim=1) + 1))
-        # loss      = loss + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
-        # from IPython import embed; embed()
+
+        ### log(1 + sum_n exp(<a,n> - <a,p>)) over the negative set of each anchor, as one masked logsumexp
+        sims      = batch.mm(batch.T)
+        inner_sum = sims[mined.anchors] - sims[mined.anchors, mined.positives].view(-1,1)
+        inner_sum = inner_sum.masked_fill(~mined.negatives, -float('inf'))
+        inner_sum = torch.cat([torch.zeros_like(inner_sum[:,:1]), inner_sum], dim=1)
+
+        loss  = torch.mean(torch.logsumexp(inner_sum, dim=1))
+        loss  = loss + self.l2_weight*torch.mean(torch.norm(batch, p=2, dim=1))
 
         return loss
@@ -2,6 +2,7 @@ import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 import criteria
+from criteria import partial_proxies
 
 """================================================================================================="""
 ALLOWED_MINING_OPS  = None
@@ -30,15 +31,14 @@ class Criterion(torch.nn.Module):
         self.num_proxies        = opt.n_classes
         self.embed_dim          = opt.embed_dim
 
-        self.proxies            = torch.randn(self.num_proxies, self.embed_dim)/8
-        self.proxies            = torch.nn.Parameter(self.proxies)
-        proxy_optim_dict        = {'params':self.proxies, 'lr':opt.lr * opt.loss_oproxy_lrmulti}
+        ### With partial proxies (see criteria.partial_proxies) the proxies live in the ProxyBank and are updated by it.
+        proxies                 = torch.randn(self.num_proxies, self.embed_dim)/8
+        self.proxy_bank         = partial_proxies.from_opt(opt, self.num_proxies, (self.embed_dim,), proxies, opt.lr * opt.loss_oproxy_lrmulti)
+        self.proxies            = torch.nn.Parameter(proxies) if self.proxy_bank is None else None
 
         self.optim_dict_list = []
-        self.optim_dict_list.append(proxy_optim_dict)
-
-        ###
-        self.class_idxs         = torch.arange(self.num_proxies)
+        if self.proxy_bank is None:
+            self.optim_dict_list.append({'params':self.proxies, 'lr':opt.lr * opt.loss_oproxy_lrmulti})
 
         self.name           = 'oproxy'
 
@@ -81,6 +81,11 @@ class Criterion(torch.nn.Module):
         # else:
         batch       = self.prep(batch)
 
+        if self.proxy_bank is None:
+            proxies, labels = self.proxies, torch.as_tensor(labels, device=batch.device).long()
+        else:
+            proxies, labels, _ = self.proxy_bank(batch, labels)
+
         self.labels = labels.unsqueeze(1)
 
         ###
@@ -90,7 +95,7 @@ class Criterion(torch.nn.Module):
             self.u_labels, self.freq = self.labels.view(-1), None
         self.same_labels = (self.labels.T == self.u_labels.view(-1,1)).to(batch.device).T
 
-        class_idxs = self.class_idxs.to(batch.device)
+        class_idxs = torch.arange(len(proxies), device=batch.device)
         self.diff_labels = (class_idxs.unsqueeze(1) != self.labels.T).to(torch.float).to(batch.device).T
 
         ###
@@ -100,15 +105,15 @@ class Criterion(torch.nn.Module):
             self.dim = 1
 
         ###
-        loss = self.compute_proxyloss(batch, detach_proxies=self.detach_proxies)
+        loss = self.compute_proxyloss(batch, proxies, detach_proxies=self.detach_proxies)
         self.it_count += 1
 
         ###
         return loss
 
     ###
-    def compute_proxyloss(self, batch, detach_proxies=False):
-        proxies     = self.prep(self.proxies)
+    def compute_proxyloss(self, batch, proxies, detach_proxies=False):
+        proxies     = self.prep(proxies)
         if detach_proxies: proxies = proxies.detach()
         pars = {k:-p if self.euclidean and 'alpha' in k else p for k,p in self.pars.items()}
         ###
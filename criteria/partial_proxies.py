@@ -0,0 +1,189 @@
+import numpy as np
+import torch, torch.nn as nn, torch.nn.functional as F
+import torch.distributed as dist
+
+
+"""================================================================================================="""
+################## PARTIAL PROXIES #################################################################
+# Proxy and classification criteria compare each batch against the proxies of all C classes and update all C rows
+# every step. With a ProxyBank they only use the proxies of the classes in the batch plus <n_negatives> negative
+# classes, and only these rows are updated (lazy Adam), so step time and optimizer state no longer scale with C.
+#
+# The bank is enabled per criterion through the loss params
+#     partial_proxies_n_negatives: number of negative proxies per step, 0 (default) keeps the full proxy matrix.
+#     partial_proxies_mode:        'sampled' (uniformly drawn negatives) or 'hard' (the negatives most similar to the
+#                                  batch among partial_proxies_hard_pool x n_negatives uniformly drawn candidates).
+#     partial_proxies_storage:     'device' or 'cpu' (proxies and Adam moments stay in host memory).
+# DML_Model.on_before_optimizer_step applies the update of the rows used since the last optimizer step, see ProxyBank.step.
+
+def from_opt(opt, n_classes, row_shape, init, lr):
+    """ProxyBank for a criterion if opt enables partial proxies, None otherwise. <init> is the initial (C x *row_shape) tensor."""
+    n_negatives = getattr(opt, 'partial_proxies_n_negatives', 0)
+    if not n_negatives:
+        return None
+    return ProxyBank(n_classes, row_shape, init, lr, n_negatives=n_negatives,
+                     mode=getattr(opt, 'partial_proxies_mode', 'sampled'),
+                     storage=getattr(opt, 'partial_proxies_storage', 'device'),
+                     hard_pool=getattr(opt, 'partial_proxies_hard_pool', 4))
+
+
+class ProxyBank(torch.nn.Module):
+    """
+    Proxies of all classes with sparse updates, see the section comment above.
+
+    The proxies are plain tensors instead of a Parameter or buffer: DDP neither broadcasts nor all-reduces them, the
+    touched rows are synchronized in step() instead, and CPU storage is kept on the host when the module is moved.
+
+    Args:
+        n_classes (int): Number of classes (rows).
+        row_shape (tuple): Shape of the proxy (or proxies) of one class, e.g. (embed_dim,).
+        init (torch.Tensor): Initial (n_classes x *row_shape) proxies.
+        lr (float): Learning rate of the lazy Adam update.
+        n_negatives (int, optional): Number of negative classes per step.
+        mode (string, optional): 'sampled' or 'hard'.
+        storage (string, optional): 'device' or 'cpu'.
+        hard_pool (int, optional): Hard mode: candidates per negative.
+    """
+    def __init__(self, n_classes, row_shape, init, lr, n_negatives=1024, mode='sampled', storage='device', hard_pool=4,
+                 betas=(0.9, 0.999), eps=1e-8):
+        super(ProxyBank, self).__init__()
+        assert mode in ['sampled', 'hard'], f'Unknown partial proxy mode [{mode}].'
+        assert storage in ['device', 'cpu'], f'Unknown partial proxy storage [{storage}].'
+        self.n_classes   = n_classes
+        self.row_shape   = tuple(row_shape)
+        self.n_negatives = n_negatives
+        self.mode        = mode
+        self.storage     = storage
+        self.hard_pool   = hard_pool
+        self.lr, self.betas, self.eps = lr, betas, eps
+
+        ### Proxies and lazy Adam state, one step counter per row for the bias correction
+        self.weight     = init.detach().clone().view(n_classes, *self.row_shape).float()
+        self.exp_avg    = torch.zeros_like(self.weight)
+        self.exp_avg_sq = torch.zeros_like(self.weight)
+        self.row_steps  = torch.zeros(n_classes, dtype=torch.long)
+
+        ### (class ids, proxy rows) of the forward passes since the last step, several with gradient accumulation
+        self.active = []
+
+    def _apply(self, fn):
+        super(ProxyBank, self)._apply(fn)
+        if self.storage == 'device':
+            self.weight, self.exp_avg, self.exp_avg_sq = fn(self.weight), fn(self.exp_avg), fn(self.exp_avg_sq)
+            self.row_steps = self.row_steps.to(self.weight.device)
+        return self
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(ProxyBank, self)._save_to_state_dict(destination, prefix, keep_vars)
+        for key in ['weight', 'exp_avg', 'exp_avg_sq', 'row_steps']:
+            destination[prefix + key] = getattr(self, key).detach()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        keys = [prefix + key for key in ['weight', 'exp_avg', 'exp_avg_sq', 'row_steps']]
+        for key in keys:
+            if key in state_dict:
+                getattr(self, key[len(prefix):]).copy_(state_dict[key])
+            elif strict:
+                missing_keys.append(key)
+        state_dict = {key: value for key, value in state_dict.items() if key not in keys}
+        super(ProxyBank, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    @torch.no_grad()
+    def negatives(self, batch, positives):
+        """Negative class ids for the positive class ids <positives> (on the storage device)."""
+        n_neg = min(self.n_negatives, self.n_classes - len(positives))
+        n_candidates = n_neg if self.mode == 'sampled' else min(self.hard_pool * n_neg, self.n_classes - len(positives))
+
+        is_pos = torch.zeros(self.n_classes, dtype=torch.bool, device=positives.device)
+        is_pos[positives] = True
+        candidates = torch.randperm(self.n_classes, device=positives.device)[:n_candidates + len(positives)]
+        candidates = candidates[~is_pos[candidates]][:n_candidates]
+
+        if self.mode == 'hard' and n_candidates > n_neg:
+            ### Candidates with the highest similarity to any sample of the batch
+            rows  = F.normalize(self.weight[candidates].to(batch.device).view(len(candidates), -1, batch.shape[-1]), dim=-1)
+            sims  = torch.einsum('bd,ckd->bck', F.normalize(batch.detach(), dim=-1), rows).amax(dim=(0, 2))
+            candidates = candidates[sims.topk(n_neg)[1].to(candidates.device)]
+        return candidates
+
+    def forward(self, batch, labels):
+        """
+        Proxies of the classes of <labels> and of the sampled negatives, as a leaf tensor on the device of <batch>.
+
+        Returns:
+            (K x *row_shape) proxies, labels mapped to rows of them (positives come first, sorted by class id), class ids.
+        """
+        labels    = torch.as_tensor(labels, device=batch.device).view(-1).long()
+        positives = torch.unique(labels)
+        class_ids = torch.cat([positives.to(self.weight.device), self.negatives(batch, positives.to(self.weight.device))])
+
+        rows = self.weight[class_ids].to(batch.device).requires_grad_(self.training)
+        if self.training:
+            self.active.append((class_ids, rows))
+        return rows, torch.searchsorted(positives, labels), class_ids
+
+    @torch.no_grad()
+    def step(self, grad_scale=1.0, lr_factor=1.0):
+        """
+        Lazy Adam update of the rows used since the last step (all accumulated forward passes), with gradients averaged
+        over DDP ranks. Called once per optimizer step.
+
+        Args:
+            grad_scale (float or torch.Tensor, optional): Loss scale of mixed precision training the gradients are
+                multiplied with. Steps with non-finite gradients leave the rows unchanged, as GradScaler does for the
+                optimizer. A tensor (GradScaler's scale) keeps this free of host syncs.
+            lr_factor (float, optional): Factor of the learning rate schedule applied to lr.
+        """
+        active = [(class_ids, rows) for class_ids, rows in self.active if rows.grad is not None]
+        self.active = []
+        if not active:
+            return
+        class_ids = torch.cat([class_ids.to(rows.device) for class_ids, rows in active])
+        grads     = torch.cat([rows.grad.float() for _, rows in active]) / grad_scale
+
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            class_ids, grads = self.gather_rows(class_ids, grads)
+            grads = grads / dist.get_world_size()
+
+        ### Sum the gradients of rows touched by several ranks or forward passes, then update them once
+        class_ids, inverse = torch.unique(class_ids, return_inverse=True)
+        grads = torch.zeros((len(class_ids),) + grads.shape[1:], dtype=grads.dtype, device=grads.device).index_add_(0, inverse, grads)
+        class_ids, grads = class_ids.to(self.weight.device), grads.to(self.weight.device)
+
+        ### Checked after gathering, so all ranks skip the same steps. Applied with torch.where instead of a python branch
+        finite = torch.isfinite(grads).all()
+        grads  = torch.where(finite, grads, torch.zeros_like(grads))
+
+        beta1, beta2 = self.betas
+        row_steps = self.row_steps[class_ids] + finite.long()
+        self.row_steps[class_ids] = row_steps
+        shape = (-1,) + (1,) * len(self.row_shape)
+        steps = row_steps.clamp(min=1).to(grads.dtype).view(shape)
+
+        exp_avg, exp_avg_sq = self.exp_avg[class_ids], self.exp_avg_sq[class_ids]
+        exp_avg    = torch.where(finite, exp_avg * beta1 + grads * (1 - beta1), exp_avg)
+        exp_avg_sq = torch.where(finite, exp_avg_sq * beta2 + grads * grads * (1 - beta2), exp_avg_sq)
+        self.exp_avg[class_ids], self.exp_avg_sq[class_ids] = exp_avg, exp_avg_sq
+
+        denom = (exp_avg_sq / (1 - beta2 ** steps)).sqrt_().add_(self.eps)
+        self.weight[class_ids] -= finite * self.lr * lr_factor * (exp_avg / (1 - beta1 ** steps)) / denom
+
+    def gather_rows(self, class_ids, grads):
+        """All-gathers the (class id, gradient) rows of all ranks, padded to the largest number of rows."""
+        world_size = dist.get_world_size()
+        n_rows = torch.tensor([len(class_ids)], device=grads.device)
+        all_n_rows = [torch.zeros_like(n_rows) for _ in range(world_size)]
+        dist.all_gather(all_n_rows, n_rows)
+        all_n_rows = [int(n) for n in all_n_rows]
+        max_rows = max(all_n_rows)
+
+        padded_ids   = torch.zeros(max_rows, dtype=class_ids.dtype, device=grads.device)
+        padded_grads = torch.zeros((max_rows,) + grads.shape[1:], dtype=grads.dtype, device=grads.device)
+        padded_ids[:len(class_ids)], padded_grads[:len(class_ids)] = class_ids, grads
+
+        all_ids   = [torch.zeros_like(padded_ids) for _ in range(world_size)]
+        all_grads = [torch.zeros_like(padded_grads) for _ in range(world_size)]
+        dist.all_gather(all_ids, padded_ids)
+        dist.all_gather(all_grads, padded_grads)
+        return (torch.cat([ids[:n] for ids, n in zip(all_ids, all_n_rows)]),
+                torch.cat([g[:n] for g, n in zip(all_grads, all_n_rows)]))
@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from criteria import partial_proxies
 
 
 """================================================================================================="""
@@ -11,7 +12,7 @@ REQUIRES_LOGGING    = False
 
 
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             opt: Namespace containing all relevant parameters.
@@ -28,9 +29,13 @@ class Criterion(torch.nn.Module):
 
         ####
         self.embed_div          = opt.loss_proxyanchor_div
-        self.proxies            = torch.nn.Parameter(torch.randn(self.num_proxies, self.embed_dim)/self.embed_div)
         self.lr   = opt.lr * opt.loss_proxyanchor_lrmulti
 
+        ### With partial proxies (see criteria.partial_proxies) the proxies live in the ProxyBank instead.
+        proxies                 = torch.randn(self.num_proxies, self.embed_dim)/self.embed_div
+        self.proxy_bank         = partial_proxies.from_opt(opt, self.num_proxies, (self.embed_dim,), proxies, self.lr)
+        self.proxies            = torch.nn.Parameter(proxies) if self.proxy_bank is None else None
+
         self.class_idxs         = torch.arange(self.num_proxies)
 
         self.name           = 'proxyanchor'
@@ -44,7 +49,7 @@ class Criterion(torch.nn.Module):
     def prep(self, thing):
         return self.sphereradius*torch.nn.functional.normalize(thing, dim=1)
 
-    def forward(self, batch, labels, aux_batch=None):
+    def forward(self, batch, labels, aux_batch=None, **kwargs):
         """
         Args:
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
@@ -57,14 +62,20 @@ class Criterion(torch.nn.Module):
         batch       = self.prep(batch)
         batch_dict  = {}
 
+        ###
+        if self.proxy_bank is None:
+            proxies, labels = self.proxies, torch.as_tensor(labels, device=batch.device).long()
+        else:
+            proxies, labels, _ = self.proxy_bank(batch, labels)
+
         ###
         labels       = labels.unsqueeze(1)
         bsame_labels = labels.T == labels
         bdiff_labels = labels.T != labels
-        diff_labels  = torch.arange(len(self.proxies)).unsqueeze(1) != labels.T
+        diff_labels  = torch.arange(len(proxies), device=batch.device).unsqueeze(1) != labels.T
 
         ###
-        proxies     = self.prep(self.proxies)
+        proxies     = self.prep(proxies)
         pos_proxies = proxies[labels.squeeze(-1)]
 
         ###
@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from criteria import partial_proxies
 
 
 """================================================================================================="""
@@ -10,7 +11,7 @@ REQUIRES_OPTIM      = True
 
 
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             opt: Namespace containing all relevant parameters.
@@ -26,13 +27,15 @@ class Criterion(torch.nn.Module):
         self.num_proxies        = opt.n_classes
         self.embed_dim          = opt.embed_dim
 
-        self.proxies            = torch.nn.Parameter(torch.randn(self.num_proxies, self.embed_dim)/8)
-        self.class_idxs         = torch.arange(self.num_proxies)
-
         self.name           = 'proxynca'
 
         self.lr   = opt.lr * opt.loss_proxynca_lrmulti
 
+        ### With partial proxies (see criteria.partial_proxies) the proxies live in the ProxyBank instead.
+        proxies                 = torch.randn(self.num_proxies, self.embed_dim)/8
+        self.proxy_bank         = partial_proxies.from_opt(opt, self.num_proxies, (self.embed_dim,), proxies, self.lr)
+        self.proxies            = torch.nn.Parameter(proxies) if self.proxy_bank is None else None
+
         self.sphereradius = opt.loss_proxynca_sphereradius
         self.T            = opt.loss_proxynca_temperature
         self.convert_to_p = opt.loss_proxynca_convert_to_p
@@ -46,10 +49,15 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels: nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
+        if self.proxy_bank is None:
+            proxies, labels = self.proxies, torch.as_tensor(labels, device=batch.device).long()
+        else:
+            proxies, labels, _ = self.proxy_bank(batch, labels)
+
         #Empirically, multiplying the embeddings during the computation of the loss seem to allow for more stable training;
         #presumably due to increased loss value.
         batch   = self.sphereradius*torch.nn.functional.normalize(batch, dim=1)
-        proxies = self.sphereradius*torch.nn.functional.normalize(self.proxies, dim=1)
+        proxies = self.sphereradius*torch.nn.functional.normalize(proxies, dim=1)
 
         #Loss based on distance to positive proxies
         if self.cosine:
@@ -62,25 +70,21 @@ class Criterion(torch.nn.Module):
 
         loss_pos = torch.mean(-dist_to_pos_proxies/self.T)
 
-        #Loss based on distance to negative (or all) proxies
-        if not self.convert_to_p:
-            batch_neg_idxs = labels.unsqueeze(1) != self.class_idxs.unsqueeze(1).T
+        #Loss based on distance to negative (or all) proxies, as one masked logsumexp over all samples (BS x C)
+        if self.cosine:
+            dist_to_proxies = -batch.mm(proxies.T)
         else:
-            batch_neg_idxs = torch.ones((len(batch),self.num_proxies)).bool().to(labels.device)
-
-        loss_neg = 0
-        for neg_idxs, sample in zip(batch_neg_idxs, batch):
-            if self.cosine:
-                dist_to_neg_proxies = -sample.unsqueeze(0).mm(proxies[neg_idxs,:].T).squeeze(0)
+            sq_dists = (batch.pow(2).sum(-1).unsqueeze(1) + proxies.pow(2).sum(-1).unsqueeze(0) - 2*batch.mm(proxies.T))
+            if self.sq_dist:
+                dist_to_proxies = sq_dists.clamp(min=1e-20).sqrt()
             else:
-                if self.sq_dist:
-                    dist_to_neg_proxies = (sample.unsqueeze(0)-proxies[neg_idxs,:]).pow(2).sum(1).sqrt()
-                else:
-                    dist_to_neg_proxies = (sample.unsqueeze(0)-proxies[neg_idxs,:]).pow(2).sum(1)
-
+                dist_to_proxies = sq_dists.clamp(min=0)
 
-            loss_neg           += torch.logsumexp(-dist_to_neg_proxies, dim=-1)
-        loss_neg /= len(batch)
+        if not self.convert_to_p:
+            batch_neg_idxs = labels.unsqueeze(1) != torch.arange(len(proxies), device=batch.device).unsqueeze(0)
+        else:
+            batch_neg_idxs = torch.ones_like(dist_to_proxies, dtype=torch.bool)
+        loss_neg = torch.logsumexp((-dist_to_proxies).masked_fill(~batch_neg_idxs, -float('inf')), dim=-1).mean()
 
         loss = loss_pos + loss_neg
         # neg_proxies = torch.stack([torch.cat([self.class_idxs[:class_label],self.class_idxs[class_label+1:]]) for class_label in labels])
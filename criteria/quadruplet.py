@@ -2,7 +2,7 @@ import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = False
 
@@ -26,11 +26,11 @@ class Criterion(torch.nn.Module):
         self.REQUIRES_BATCHMINER = REQUIRES_BATCHMINER
         self.REQUIRES_OPTIM      = REQUIRES_OPTIM
 
-    def triplet_distance(self, anchor, positive, negative):
-        return torch.nn.functional.relu(torch.norm(anchor-positive, p=2, dim=-1)-torch.norm(anchor-negative, p=2, dim=-1)+self.margin_alpha_1)
+    def triplet_distance(self, d_ap, d_an):
+        return torch.nn.functional.relu(d_ap-d_an+self.margin_alpha_1)
 
-    def quadruplet_distance(self, anchor, positive, negative, fourth_negative):
-        return torch.nn.functional.relu(torch.norm(anchor-positive, p=2, dim=-1)-torch.norm(negative-fourth_negative, p=2, dim=-1)+self.margin_alpha_2)
+    def quadruplet_distance(self, d_ap, d_nn):
+        return torch.nn.functional.relu(d_ap-d_nn+self.margin_alpha_2)
 
     def forward(self, batch, labels, **kwargs):
         """
@@ -38,17 +38,20 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        sampled_triplets    = self.batchminer(batch, labels)
+        mined = self.batchminer(batch, labels)
 
-        anchors   = np.array([triplet[0] for triplet in sampled_triplets]).reshape(-1,1)
-        positives = np.array([triplet[1] for triplet in sampled_triplets]).reshape(-1,1)
-        negatives = np.array([triplet[2] for triplet in sampled_triplets]).reshape(-1,1)
+        ### Fourth sample: per triplet i a random sample j whose triplet has a different negative (negatives[j] != negatives[i])
+        fourth_negatives = mined.negatives.view(-1,1)!=mined.negatives.view(1,-1)
+        fourth_negatives = torch.where(fourth_negatives.any(dim=1, keepdim=True), fourth_negatives, torch.ones_like(fourth_negatives))
+        fourth_negatives = torch.multinomial(fourth_negatives.float(), 1).view(-1)
 
-        fourth_negatives = negatives!=negatives.T
-        fourth_negatives = [np.random.choice(np.arange(len(batch))[idxs]) for idxs in fourth_negatives]
+        ### As before, every negative is compared with the fourth samples of all triplets, giving (T x T) quadruplet terms
+        d_ap = mined.pair_distances(batch, mined.anchors, mined.positives).view(-1,1)
+        d_an = mined.pair_distances(batch, mined.anchors, mined.negatives).view(-1,1)
+        d_nn = mined.pair_distances(batch, mined.negatives.view(-1,1), fourth_negatives.view(1,-1))
 
-        triplet_loss     = self.triplet_distance(batch[anchors,:],batch[positives,:],batch[negatives,:])
-        quadruplet_loss  = self.quadruplet_distance(batch[anchors,:],batch[positives,:],batch[negatives,:],batch[fourth_negatives,:])
+        triplet_loss     = self.triplet_distance(d_ap, d_an)
+        quadruplet_loss  = self.quadruplet_distance(d_ap, d_nn)
         # triplet_loss     = torch.stack([self.triplet_distance(batch[anchor,:],batch[positive,:],batch[negative,:]) for anchor,positive,negative in zip(anchors, positives, negatives)])
         # quadruplet_loss  = torch.stack([self.quadruplet_distance(batch[anchor,:],batch[positive,:],batch[negative,:],batch[fourth_negative,:]) for anchor,positive,negative,fourth_negative in zip(anchors, positives, negatives, fourth_negatives)])
 
@@ -40,24 +40,32 @@ class Criterion(torch.nn.Module):
         self.REQUIRES_OPTIM      = REQUIRES_OPTIM
         self.REQUIRES_LOGGING = REQUIRES_LOGGING
 
-    def forward(self, batch, labels, **kwargs):
+    def forward(self, batch, labels, n_views=1, **kwargs):
         """
         Args:
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels: nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
+            n_views: int: Number of consecutive augmented views per image in the batch. If >1, the second view of
+                     each sample is another view of the same image instead of another image of the same class.
         """
 
         ids_pos = []
         bs, _ = batch.shape
-        for i in range(bs):
-            pos = (labels == labels[i]).cpu().numpy() # represents second view
+        if n_views > 1:
+            ### Pick one of the other n_views-1 views of the same decoded image
+            ids = torch.arange(bs, device=batch.device)
+            view_offsets = torch.randint(1, n_views, (bs,), device=batch.device)
+            ids_pos = ids - ids % n_views + (ids % n_views + view_offsets) % n_views
+        else:
+            for i in range(bs):
+                pos = (labels == labels[i]).cpu().numpy() # represents second view
 
-            # Sample positives randomly
-            if np.sum(pos) > 0:
-                if np.sum(pos) > 1: pos[i] = 0 # exclude anchor itself
-                ids_pos.append(np.random.choice(np.where(pos)[0]))
-            else:
-                raise Exception("Anchor without positive detected!")
+                # Sample positives randomly
+                if np.sum(pos) > 0:
+                    if np.sum(pos) > 1: pos[i] = 0 # exclude anchor itself
+                    ids_pos.append(np.random.choice(np.where(pos)[0]))
+                else:
+                    raise Exception("Anchor without positive detected!")
 
         positives = batch[ids_pos, :]
 
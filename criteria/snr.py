@@ -3,7 +3,7 @@ import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = True
 
@@ -37,15 +37,15 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        sampled_triplets = self.batchminer(batch, labels)
-        anchors   = [triplet[0] for triplet in sampled_triplets]
-        positives = [triplet[1] for triplet in sampled_triplets]
-        negatives = [triplet[2] for triplet in sampled_triplets]
+        mined     = self.batchminer(batch, labels)
+        anchors   = batch.index_select(0, mined.anchors)
+        positives = batch.index_select(0, mined.positives)
+        negatives = batch.index_select(0, mined.negatives)
 
-        pos_snr  = torch.var(batch[anchors,:]-batch[positives,:], dim=1)/torch.var(batch[anchors,:], dim=1)
-        neg_snr  = torch.var(batch[anchors,:]-batch[negatives,:], dim=1)/torch.var(batch[anchors,:], dim=1)
+        pos_snr  = torch.var(anchors-positives, dim=1)/torch.var(anchors, dim=1)
+        neg_snr  = torch.var(anchors-negatives, dim=1)/torch.var(anchors, dim=1)
 
-        reg_loss = torch.mean(torch.abs(torch.sum(batch[anchors,:],dim=1)))
+        reg_loss = torch.mean(torch.abs(torch.sum(anchors,dim=1)))
 
         if self.beta is not None:
             pos_snr  = torch.nn.functional.relu(pos_snr-beta+self.margin)
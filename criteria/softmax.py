@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from criteria import partial_proxies
 
 """================================================================================================="""
 ALLOWED_MINING_OPS  = None
@@ -10,7 +11,7 @@ REQUIRES_OPTIM      = True
 ### This Implementation follows: https://github.com/azgo14/classification_metric_learning
 
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             margin:             Triplet Margin.
@@ -20,9 +21,11 @@ class Criterion(torch.nn.Module):
 
         self.temperature = opt.loss_softmax_temperature
 
-        self.class_map = torch.nn.Parameter(torch.Tensor(opt.n_classes, opt.embed_dim))
-        stdv = 1. / np.sqrt(self.class_map.size(1))
-        self.class_map.data.uniform_(-stdv, stdv)
+        ### With partial proxies (see criteria.partial_proxies) the class map lives in the ProxyBank instead.
+        stdv = 1. / np.sqrt(opt.embed_dim)
+        class_map = torch.Tensor(opt.n_classes, opt.embed_dim).uniform_(-stdv, stdv)
+        self.proxy_bank = partial_proxies.from_opt(opt, opt.n_classes, (opt.embed_dim,), class_map, opt.loss_softmax_lr)
+        self.class_map  = torch.nn.Parameter(class_map) if self.proxy_bank is None else None
 
         self.name           = 'softmax'
 
@@ -40,8 +43,13 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        class_mapped_batch = torch.nn.functional.linear(batch, torch.nn.functional.normalize(self.class_map, dim=1))
+        if self.proxy_bank is None:
+            class_map, labels = self.class_map, torch.as_tensor(labels, device=batch.device).long()
+        else:
+            class_map, labels, _ = self.proxy_bank(batch, labels)
 
-        loss = torch.nn.CrossEntropyLoss()(class_mapped_batch/self.temperature, labels.to(torch.long).to(self.par.device))
+        class_mapped_batch = torch.nn.functional.linear(batch, torch.nn.functional.normalize(class_map, dim=1))
+
+        loss = torch.nn.CrossEntropyLoss()(class_mapped_batch/self.temperature, labels)
 
         return loss
@@ -1,6 +1,7 @@
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
+from criteria import partial_proxies
 
 """================================================================================================="""
 ALLOWED_MINING_OPS  = None
@@ -9,7 +10,7 @@ REQUIRES_OPTIM      = True
 
 ### This implementation follows https://github.com/idstcv/SoftTriple
 class Criterion(torch.nn.Module):
-    def __init__(self, opt):
+    def __init__(self, opt, **kwargs):
         """
         Args:
             margin: Triplet Margin.
@@ -34,22 +35,24 @@ class Criterion(torch.nn.Module):
 
 
         ####
+        ### The regularizer only involves centroid pairs of the same class: upper triangular of each class' K x K block
         self.reg_norm    = self.n_classes*self.n_centroids*(self.n_centroids-1)
-        self.reg_indices = torch.zeros((self.n_classes*self.n_centroids, self.n_classes*self.n_centroids), dtype=torch.bool).to(opt.device)
-        for i in range(0, self.n_classes):
-            for j in range(0, self.n_centroids):
-                self.reg_indices[i*self.n_centroids+j, i*self.n_centroids+j+1:(i+1)*self.n_centroids] = 1
+        self.register_buffer('reg_indices', torch.triu(torch.ones(self.n_centroids, self.n_centroids, dtype=torch.bool), 1), persistent=False)
 
 
         ####
-        self.intra_class_centroids = torch.nn.Parameter(torch.Tensor(opt.embed_dim, self.n_classes*self.n_centroids))
-        stdv = 1. / np.sqrt(self.intra_class_centroids.size(1))
-        self.intra_class_centroids.data.uniform_(-stdv, stdv)
-
         self.name = 'softtriplet'
 
         self.lr   = opt.loss_softtriplet_lr
 
+        ####
+        ### With partial proxies (see criteria.partial_proxies) the centroids live in the ProxyBank, one (K x D) row per class.
+        stdv = 1. / np.sqrt(self.n_classes*self.n_centroids)
+        intra_class_centroids = torch.Tensor(opt.embed_dim, self.n_classes*self.n_centroids).uniform_(-stdv, stdv)
+        self.proxy_bank = partial_proxies.from_opt(opt, self.n_classes, (self.n_centroids, opt.embed_dim),
+                                                   intra_class_centroids.T.reshape(self.n_classes, self.n_centroids, -1), self.lr)
+        self.intra_class_centroids = torch.nn.Parameter(intra_class_centroids) if self.proxy_bank is None else None
+
         ####
         self.ALLOWED_MINING_OPS  = ALLOWED_MINING_OPS
         self.REQUIRES_BATCHMINER = REQUIRES_BATCHMINER
@@ -64,18 +67,31 @@ class Criterion(torch.nn.Module):
         """
         bs = batch.size(0)
 
-        intra_class_centroids     = torch.nn.functional.normalize(self.intra_class_centroids, dim=1)
-        similarities_to_centroids = batch.mm(intra_class_centroids).reshape(-1, self.n_classes, self.n_centroids)
+        if self.proxy_bank is None:
+            n_classes, reg_norm   = self.n_classes, self.reg_norm
+            intra_class_centroids = torch.nn.functional.normalize(self.intra_class_centroids, dim=1)
+            class_centroids       = intra_class_centroids.T.reshape(self.n_classes, self.n_centroids, -1)
+        else:
+            ### Partial proxies: centroids of the batch classes and sampled negatives, normalized per centroid since
+            # the normalization over all classes above would need every row.
+            class_centroids, labels, _ = self.proxy_bank(batch, labels)
+            class_centroids       = torch.nn.functional.normalize(class_centroids, dim=-1)
+            n_classes             = len(class_centroids)
+            reg_norm              = n_classes*self.n_centroids*(self.n_centroids-1)
+            intra_class_centroids = class_centroids.reshape(-1, class_centroids.shape[-1]).T
+        similarities_to_centroids = batch.mm(intra_class_centroids).reshape(-1, n_classes, self.n_centroids)
 
         soft_weight_over_centroids = torch.nn.Softmax(dim=1)(self.gamma*similarities_to_centroids)
         per_class_embed            = torch.sum(soft_weight_over_centroids * similarities_to_centroids, dim=2)
 
-        margin_delta = torch.zeros(per_class_embed.shape).to(self.par.device)
+        labels       = torch.as_tensor(labels, device=batch.device).to(torch.long).view(-1)
+        margin_delta = torch.zeros_like(per_class_embed)
         margin_delta[torch.arange(0, bs), labels] = self.margin_delta
 
-        centroid_classification_loss = torch.nn.CrossEntropyLoss()(self.lam*(per_class_embed-margin_delta), labels.to(torch.long).to(self.par.device))
+        centroid_classification_loss = torch.nn.CrossEntropyLoss()(self.lam*(per_class_embed-margin_delta), labels)
 
-        inter_centroid_similarity = intra_class_centroids.T.mm(intra_class_centroids)
-        regularisation_loss = torch.sum(torch.sqrt(2.00001-2*inter_centroid_similarity[self.reg_indices]))/self.reg_norm
+        ### Per class K x K centroid Gram matrices from a (C x K x D) view, instead of the full (C*K) x (C*K) one
+        inter_centroid_similarity = torch.bmm(class_centroids, class_centroids.transpose(1, 2))
+        regularisation_loss = torch.sum(torch.sqrt(2.00001-2*inter_centroid_similarity[:, self.reg_indices]))/reg_norm
 
         return centroid_classification_loss + self.reg_weight * regularisation_loss
@@ -3,7 +3,7 @@ import torch, torch.nn as nn, torch.nn.functional as F
 import batchminer
 
 """================================================================================================="""
-ALLOWED_MINING_OPS  = list(batchminer.BATCHMINING_METHODS.keys())
+ALLOWED_MINING_OPS  = list(batchminer.TRIPLET_MINING_METHODS)
 REQUIRES_BATCHMINER = True
 REQUIRES_OPTIM      = False
 
@@ -25,8 +25,9 @@ class Criterion(torch.nn.Module):
         self.REQUIRES_OPTIM      = REQUIRES_OPTIM
 
 
-    def triplet_distance(self, anchor, positive, negative):
-        return torch.nn.functional.relu((anchor-positive).pow(2).sum()-(anchor-negative).pow(2).sum()+self.margin)
+    def triplet_distance(self, mined, batch):
+        return torch.nn.functional.relu(mined.pair_sq_distances(batch, mined.anchors, mined.positives)
+                                        - mined.pair_sq_distances(batch, mined.anchors, mined.negatives) + self.margin)
 
     def forward(self, batch, labels, **kwargs):
         """
@@ -34,8 +35,7 @@ class Criterion(torch.nn.Module):
             batch:   torch.Tensor: Input of embeddings with size (BS x DIM)
             labels:  nparray/list: For each element of the batch assigns a class [0,...,C-1], shape: (BS x 1)
         """
-        if isinstance(labels, torch.Tensor): labels = labels.cpu().numpy()
-        sampled_triplets = self.batchminer(batch, labels)
-        loss             = torch.stack([self.triplet_distance(batch[triplet[0],:],batch[triplet[1],:],batch[triplet[2],:]) for triplet in sampled_triplets])
+        mined = self.batchminer(batch, labels)
+        loss  = self.triplet_distance(mined, batch)
 
         return torch.mean(loss)
@@ -15,6 +15,8 @@ class DATA(Dataset):
         train (bool, optional): Specifies type of data split (train or validation).
         arch (string, optional): Type of network architecture used for training, influences choice of transformations
             applied when sampling batches.
+        ooDML_split_id (int, optional): ooDML data split to use, -1 for the official split.
+        **kwargs: Passed on to BaseDataset, e.g. uint8_batches.
 
     """
 
@@ -24,6 +26,7 @@ class DATA(Dataset):
             train = True,
             arch = 'resnet50',
             ooDML_split_id=-1,
+            **kwargs,
             ):
 
         super(DATA, self).__init__()
@@ -72,13 +75,13 @@ class DATA(Dataset):
 
         ###
         if self.train:
-            train_dataset = BaseDataset(train_image_dict, arch)
+            train_dataset = BaseDataset(train_image_dict, arch, **kwargs)
             self.dataset = train_dataset
             print(f'DATASET:\ntype: CARS196\nSetup: Train\n#Classes: {len(train_image_dict)}')
             print(f'ooDML Data Split [{ooDML_split_id}] with FID: [{fid:.2f}]')
 
         else:
-            test_dataset = BaseDataset(test_image_dict, arch, is_validation=True)
+            test_dataset = BaseDataset(test_image_dict, arch, is_validation=True, **kwargs)
             self.dataset = test_dataset
             print(f'DATASET:\ntype: CARS196\nSetup: Val\n#Classes: {len(test_image_dict)}')
             print(f'ooDML Data Split [{ooDML_split_id}] with FID: [{fid:.2f}]\n')
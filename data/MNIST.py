@@ -53,6 +53,27 @@ class MNISTDATA(Dataset):
 
         self.data, self.targets = torch.load(os.path.join(self.root, data_file))
 
+        ### Same interface as the DATA wrappers of the other datasets (see data.basic_dml_dataset.BaseDataset)
+        self.dataset = self
+        self.norm_mean, self.norm_std = [0.], [1.]
+        self.flip_channels = False
+        self.batch_transform = None
+        self.n_views = 1
+
+        ### CSR-style class index for the datasamplers
+        targets = np.asarray(self.targets)
+        self.avail_classes = np.unique(targets)
+        self.class_indices = np.argsort(targets, kind='stable').astype(np.int64)
+        self.class_offsets = np.zeros(len(self.avail_classes)+1, dtype=np.int64)
+        self.class_offsets[1:] = np.cumsum(np.bincount(np.searchsorted(self.avail_classes, targets)))
+
+    def tensor_data(self):
+        """Returns (uint8 images, labels, channels_last) for data.tensor_loader.TensorBatchLoader, None if per-sample
+        transforms are set."""
+        if self.transform is not None or self.target_transform is not None:
+            return None
+        return self.data.unsqueeze(1), self.targets, False
+
     def __getitem__(self, index: int):
         """
         Args:
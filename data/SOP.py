@@ -17,6 +17,8 @@ class DATA(Dataset):
         train (bool, optional): Specifies type of data split (train or validation).
         arch (string, optional): Type of network architecture used for training, influences choice of transformations
             applied when sampling batches.
+        ooDML_split_id (int, optional): ooDML data split to use, -1 for the official split.
+        **kwargs: Passed on to BaseDataset, e.g. uint8_batches.
 
     """
 
@@ -26,6 +28,7 @@ class DATA(Dataset):
             train = True,
             arch = 'resnet50',
             ooDML_split_id=-1,
+            **kwargs,
     ):
 
         super(DATA, self).__init__()
@@ -38,29 +41,23 @@ class DATA(Dataset):
         training_files = pd.read_table(self.root + '/Info_Files/Ebay_train.txt', header=0, delimiter=' ')
         test_files = pd.read_table(self.root + '/Info_Files/Ebay_test.txt', header=0, delimiter=' ')
 
-        # super_dict = {}
+        super_dict = {}
         super_conversion = {}
         class_dict = {}
         class_conversion = {}
 
         for i, (super_ix, class_ix, image_path) in enumerate(zip(training_files['super_class_id'], training_files['class_id'], training_files['path'])):
-            # if super_ix not in super_dict: super_dict[super_ix] = {}
-            # if class_ix not in super_dict[super_ix]: super_dict[super_ix][class_ix] = []
-            # super_dict[super_ix][class_ix].append(image_sourcepath + '/' + image_path)
-
             class_ix -= 1 # let class ids start with 0
 
+            super_dict[class_ix] = super_ix - 1 # super-category of each class, also starting with 0
             if class_ix not in class_dict: class_dict[class_ix] = []
             class_dict[class_ix].append(image_sourcepath + '/' + image_path)
             class_conversion[class_ix] = image_path.split('/')[-1].split('_')[0]
 
         for i, (super_ix, class_ix, image_path) in enumerate(zip(test_files['super_class_id'], test_files['class_id'], test_files['path'])):
-            # if super_ix not in super_dict: super_dict[super_ix] = {}
-            # if class_ix not in super_dict[super_ix]: super_dict[super_ix][class_ix] = []
-            # super_dict[super_ix][class_ix].append(image_sourcepath + '/' + image_path)
-
             class_ix -= 1 # let class ids start with 0
 
+            super_dict[class_ix] = super_ix - 1 # super-category of each class, also starting with 0
             if class_ix not in class_dict: class_dict[class_ix] = []
             class_dict[class_ix].append(image_sourcepath + '/' + image_path)
             class_conversion[class_ix] = image_path.split('/')[-1].split('_')[0]
@@ -81,13 +78,15 @@ class DATA(Dataset):
 
         ###
         if self.train:
-            train_dataset = BaseDataset(train_image_dict, arch)
+            train_dataset = BaseDataset(train_image_dict, arch, **kwargs)
             train_dataset.conversion = train_conversion
+            train_dataset.set_super_classes(super_dict)
             self.dataset = train_dataset
             print(f'DATASET:\ntype: SOP\nSetup: Train\n#Classes: {len(train_image_dict)}')
         else:
-            test_dataset = BaseDataset(test_image_dict, arch, is_validation=True)
+            test_dataset = BaseDataset(test_image_dict, arch, is_validation=True, **kwargs)
             test_dataset.conversion = test_conversion
+            test_dataset.set_super_classes(super_dict)
             self.dataset = test_dataset
             print(f'DATASET:\ntype: SOP\nSetup: Val\n#Classes: {len(test_image_dict)}\n')
 
@@ -1,6 +1,10 @@
-from torch.utils.data import random_split, DataLoader, Dataset
+import os, json, time, socket
+from torch.utils.data import random_split, DataLoader, Dataset, IterableDataset
 import pytorch_lightning as pl
 from utils.auxiliaries import instantiate_from_config
+from data.image_cache import signature
+from data.tensor_loader import TensorBatchLoader
+from data import cache_warmer
 import batchminer as bmine
 
 
@@ -16,14 +20,72 @@ class WrappedDataset(Dataset):
         return self.data[idx]
 
 
+def time_dataloader(loader, n_batches, n_warmup=2):
+    """Returns images/sec of iterating <n_batches> batches of <loader>, after <n_warmup> untimed batches (worker startup)."""
+    n_warmup = max(min(n_warmup, len(loader) - 1), 0)
+    n_images, start = 0, time.perf_counter()
+    for i, batch in enumerate(loader):
+        if i < n_warmup:
+            start = time.perf_counter()
+            continue
+        n_images += len(batch[0])
+        if i + 1 == n_warmup + n_batches:
+            break
+    return n_images / (time.perf_counter() - start)
+
+
 class DataModuleFromConfig(pl.LightningDataModule):
     def __init__(self, batch_size, train=None, validation=None, test=None,
-                 wrap=False, num_workers=None):
+                 wrap=False, num_workers=None, pin_memory=False, persistent_workers=False, prefetch_factor=2,
+                 autotune=False, autotune_workers=None, autotune_prefetch=None, autotune_batches=20, autotune_cache=None,
+                 tensor_loader=False, stage_dir=None, stage_threads=16, stage_verify='size'):
+        """
+        Args:
+            batch_size (int): Number of samples per batch.
+            train, validation, test (config, optional): Dataset configs, optionally with a data_sampler config.
+            wrap (bool, optional): Wrap datasets into WrappedDataset.
+            num_workers (int, optional): Dataloader workers, defaults to batch_size//2.
+            pin_memory (bool, optional): Use page-locked host memory for faster host-to-GPU copies.
+            persistent_workers (bool, optional): Keep workers alive between epochs instead of re-forking them.
+            prefetch_factor (int, optional): Batches loaded in advance per worker.
+            autotune (bool, optional): Benchmark candidate worker counts (at prefetch_factor), then prefetch depths (at the
+                fastest worker count) on the train dataset and sampler before training, and use the fastest setting.
+                Results are cached per host and dataset in <autotune_cache>.
+            autotune_workers (list, optional): Candidate worker counts, defaults to powers of two up to the number of cpus.
+            autotune_prefetch (list, optional): Candidate prefetch factors, defaults to [2, 4, 8].
+            autotune_batches (int, optional): Number of timed batches per candidate.
+            autotune_cache (string, optional): Json file of autotune results, defaults to ~/.cache/vq_dml/loader_autotune.json.
+            tensor_loader (bool, optional): Serve splits that are held in memory as a single uint8 array (MNIST, or a
+                completely filled decoded/validation cache) through data.tensor_loader.TensorBatchLoader, i.e. gather
+                batches directly without workers. Other splits fall back to a regular DataLoader. prepare_data decodes
+                all images missing in the decoded/validation caches once per node, so these splits are served from memory
+                from the first epoch on.
+            stage_dir (string, optional): Node-local directory (e.g. local scratch) the image files of all splits are
+                copied to in prepare_data, see data.cache_warmer. Once staging completed, setup() redirects the dataset
+                roots to the local copies on every rank. Restarts only copy missing or invalid files.
+            stage_threads (int, optional): Number of parallel copies.
+            stage_verify (string, optional): Verification of staged files, 'size' or 'sha1'.
+        """
         super().__init__()
         self.batch_size = batch_size
         self.dataset_configs = dict()
         self.num_workers = num_workers if num_workers is not None else batch_size//2
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
         self.wrap = wrap
+        self.tensor_loader = tensor_loader
+        self.stage_dir = stage_dir
+        self.stage_threads = stage_threads
+        self.stage_verify = stage_verify
+        self.staged_splits = set()
+
+        ## Dataloader autotuning, performed on the first call of train_dataloader (after ddp has been initialized)
+        self.autotune = autotune
+        self.autotune_workers = autotune_workers
+        self.autotune_prefetch = autotune_prefetch if autotune_prefetch is not None else [2, 4, 8]
+        self.autotune_batches = autotune_batches
+        self.autotune_cache = autotune_cache if autotune_cache is not None else os.path.expanduser("~/.cache/vq_dml/loader_autotune.json")
 
         ## Gather dataset configs
         if train is not None:
@@ -62,39 +124,171 @@ class DataModuleFromConfig(pl.LightningDataModule):
         if self.wrap:
             for k in self.datasets:
                 self.datasets[k] = WrappedDataset(self.datasets[k])
+        ## Streaming datasets (data.streaming) assemble the batches themselves, see _streaming_dataloader
+        for k in self.datasets:
+            if isinstance(self.datasets[k], IterableDataset):
+                self.datasets[k].dataset.batch_size = self.batch_size
+
+    def _loader_kwargs(self, num_workers=None, prefetch_factor=None, persistent_workers=None):
+        num_workers = self.num_workers if num_workers is None else num_workers
+        kwargs = dict(num_workers=num_workers, pin_memory=self.pin_memory)
+        if num_workers > 0:
+            kwargs['persistent_workers'] = self.persistent_workers if persistent_workers is None else persistent_workers
+            kwargs['prefetch_factor'] = self.prefetch_factor if prefetch_factor is None else prefetch_factor
+        return kwargs
+
+    def _streaming_dataloader(self, dataset, **loader_kwargs):
+        loader_kwargs = self._loader_kwargs(**loader_kwargs)
+        self.datasets[dataset].dataset.num_workers = loader_kwargs['num_workers']
+        return DataLoader(self.datasets[dataset], batch_size=None, **loader_kwargs)
 
-    def _train_dataloader(self):
+    def _tensor_dataloader(self, dataset, datasampler, shuffle=False):
+        tensor_data = self.datasets[dataset].dataset.tensor_data() if self.tensor_loader and not self.wrap else None
+        if tensor_data is None:
+            return None
+        images, labels, channels_last = tensor_data
+        print(f"\nTensor loader: serving [{dataset}] from memory ({len(labels)} samples).\n")
+        return TensorBatchLoader(images, labels, self.batch_size, batch_sampler=datasampler, shuffle=shuffle,
+                                 channels_last=channels_last, pin_memory=self.pin_memory)
+
+    def _train_dataloader(self, **loader_kwargs):
         datasampler = self._add_datasampler(dataset="train") if self.train_datasampler else None # instantiate after ddp has been initialized to enable multi GPU training
+        tensor_loader = self._tensor_dataloader("train", datasampler, shuffle=True) if not loader_kwargs else None
+        if tensor_loader is not None:
+            return tensor_loader
+        if self.autotune and not loader_kwargs:
+            self._autotune()
+        if isinstance(self.datasets["train"], IterableDataset):
+            return self._streaming_dataloader("train", **loader_kwargs)
         return DataLoader(self.datasets["train"],
                           batch_size=self.batch_size if not self.train_datasampler else 1,
-                          num_workers=self.num_workers,
                           batch_sampler=datasampler,
-                          shuffle=not self.train_datasampler)
+                          shuffle=not self.train_datasampler,
+                          **self._loader_kwargs(**loader_kwargs))
 
     def _val_dataloader(self):
         datasampler = self._add_datasampler(dataset="validation") if self.val_datasampler else None # instantiate after ddp has been initialized to enable multi GPU training
+        tensor_loader = self._tensor_dataloader("validation", datasampler)
+        if tensor_loader is not None:
+            return tensor_loader
+        if isinstance(self.datasets["validation"], IterableDataset):
+            return self._streaming_dataloader("validation")
         return DataLoader(self.datasets["validation"],
                           batch_size=self.batch_size if not self.val_datasampler else 1,
-                          num_workers=self.num_workers,
-                          batch_sampler=datasampler)
+                          batch_sampler=datasampler,
+                          **self._loader_kwargs())
 
     def _test_dataloader(self):
         datasampler = self._add_datasampler(dataset='test') if self.test_datasampler else None # instantiate after ddp has been initialized to enable multi GPU training
+        tensor_loader = self._tensor_dataloader("test", datasampler)
+        if tensor_loader is not None:
+            return tensor_loader
+        if isinstance(self.datasets["test"], IterableDataset):
+            return self._streaming_dataloader("test")
         return DataLoader(self.datasets["test"],
                           batch_size=self.batch_size if not self.test_datasampler else 1,
-                          num_workers=self.num_workers,
-                          batch_sampler=datasampler)
+                          batch_sampler=datasampler,
+                          **self._loader_kwargs())
 
     def _add_datasampler(self, dataset):
+        ## The index arrays are handed over directly, storing them in the (omegaconf) config would convert them to python objects
         config_datasampler = self.dataset_configs[dataset]["data_sampler"]
-        config_datasampler["params"]['batch_size'] = self.batch_size
-        config_datasampler["params"]['image_dict'] = self.datasets[dataset].dataset.image_dict
-        config_datasampler["params"]['image_list'] = self.datasets[dataset].dataset.image_list
+        params = dict(config_datasampler.get("params", dict()))
+        params['batch_size'] = self.batch_size
+        params['class_offsets'] = self.datasets[dataset].dataset.class_offsets
+        params['class_indices'] = self.datasets[dataset].dataset.class_indices
+        if getattr(self.datasets[dataset].dataset, 'super_offsets', None) is not None:
+            params['super_offsets'] = self.datasets[dataset].dataset.super_offsets
+            params['super_indices'] = self.datasets[dataset].dataset.super_indices
+
+        return instantiate_from_config({"target": config_datasampler["target"], "params": params})
+
+    def _autotune_key(self):
+        return signature(socket.gethostname(), os.cpu_count(), self.batch_size, str(self.dataset_configs["train"]), len(self.datasets["train"]))
+
+    def _autotune(self):
+        self.autotune = False
+        key = self._autotune_key()
+        cache = {}
+        if os.path.exists(self.autotune_cache):
+            with open(self.autotune_cache) as f:
+                cache = json.load(f)
+
+        if key in cache:
+            result = cache[key]
+            print(f"\nDataloader autotune: using cached setting num_workers=[{result['num_workers']}], prefetch_factor=[{result['prefetch_factor']}] ({result['images_per_sec']:.1f} images/sec).\n")
+        else:
+            workers = self.autotune_workers
+            if workers is None:
+                workers = [2**i for i in range(1, 10) if 2**i <= os.cpu_count()]
+                workers = sorted(set(workers + [self.num_workers]))
+
+            ### Coordinate search: worker count at the configured prefetch depth, then prefetch depth at the best worker count
+            timings = {}
+            for num_workers in workers:
+                timings[(num_workers, self.prefetch_factor)] = self._time_train_loader(num_workers, self.prefetch_factor)
+            best_workers = max(timings, key=timings.get)[0]
+            for prefetch_factor in self.autotune_prefetch if best_workers > 0 else []:
+                if (best_workers, prefetch_factor) not in timings:
+                    timings[(best_workers, prefetch_factor)] = self._time_train_loader(best_workers, prefetch_factor)
+            (num_workers, prefetch_factor), images_per_sec = max(timings.items(), key=lambda x: x[1])
+            result = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'images_per_sec': images_per_sec, 'host': socket.gethostname()}
+
+            print("\nDataloader autotune [images/sec]:")
+            for (w, pf), ips in sorted(timings.items()):
+                print(f"num_workers={w:<4} prefetch_factor={pf:<4} {ips:.1f}")
+            print(f"Selected num_workers=[{num_workers}], prefetch_factor=[{prefetch_factor}].\n")
+
+            if self.trainer is None or self.trainer.global_rank == 0:
+                cache[key] = result
+                os.makedirs(os.path.dirname(self.autotune_cache), exist_ok=True)
+                tmp_path = self.autotune_cache + '.{}.tmp'.format(os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(cache, f, indent=2)
+                os.replace(tmp_path, self.autotune_cache)
+
+        self.num_workers = result['num_workers']
+        self.prefetch_factor = result['prefetch_factor']
+
+    def _time_train_loader(self, num_workers, prefetch_factor):
+        loader = self._train_dataloader(num_workers=num_workers, prefetch_factor=prefetch_factor, persistent_workers=False)
+        return time_dataloader(loader, self.autotune_batches)
+
 
-        return instantiate_from_config(config_datasampler)
+    def _stage_jobs(self):
+        ## (split, dataset wrapper, image paths, local root) of all splits that read image files and are not relocated yet
+        jobs = []
+        for k, dataset in self.datasets.items():
+            if k in self.staged_splits or self.wrap or not hasattr(dataset.dataset, 'relocate'):
+                continue
+            paths = [dataset.dataset.get_path(idx) for idx in range(len(dataset.dataset))]
+            local_root = os.path.join(self.stage_dir, signature(os.path.abspath(dataset.root)))
+            jobs.append((k, dataset, paths, local_root))
+        return jobs
 
+    def prepare_data(self):
+        ## Called once per node (local rank 0) before setup
+        if self.stage_dir is not None:
+            for k, dataset, paths, local_root in self._stage_jobs():
+                cache_warmer.stage_files(paths, dataset.root, local_root, n_threads=self.stage_threads, verify=self.stage_verify)
 
+        ## Fill the caches the tensor loader serves splits from, all other ranks wait for prepare_data to finish
+        if self.tensor_loader and not self.wrap:
+            for k, dataset in self.datasets.items():
+                if not callable(getattr(dataset.dataset, 'fill_tensor_cache', None)):
+                    continue
+                start = time.time()
+                n_filled = dataset.dataset.fill_tensor_cache(num_workers=self.num_workers)
+                if n_filled:
+                    print(f"\nTensor loader: decoded [{n_filled}] missing samples of [{k}] into its cache in {time.time()-start:.1f}s.\n")
 
-    # def prepare_data(self):
-    #     for data_cfg in self.dataset_configs.values():
-    #         instantiate_from_config(data_cfg)
\ No newline at end of file
+    def setup(self, stage=None):
+        ## Called on every rank, splits that have not been staged completely keep reading from the original root
+        if self.stage_dir is None:
+            return
+        for k, dataset, paths, local_root in self._stage_jobs():
+            if cache_warmer.is_staged(paths, local_root, self.stage_verify):
+                dataset.dataset.relocate(dataset.root, local_root)
+                dataset.root = local_root
+                self.staged_splits.add(k)
+                print(f"Dataset [{k}] reads from staged copy [{local_root}].")
\ No newline at end of file
@@ -1,75 +1,335 @@
-from torch.utils.data import Dataset
+import os
+import torch
+from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as transforms
+from data import batch_augmentation
+from data.image_cache import MemmapCache, signature, local_rank
 import numpy as np
 from PIL import Image
 
 """==================================================================================================="""
+def normalization_params(arch):
+    """Per-channel (mean, std) of the RGB inputs expected by the pretrained network <arch>."""
+    if 'clip' in arch:
+        return [0.48145466, 0.4578275, 0.40821073], [0.26862954, 0.26130258, 0.27577711]
+    elif 'bninception' in arch:
+        return [0.502, 0.4588, 0.4078], [0.0039, 0.0039, 0.0039]
+    elif 'vit' in arch:
+        return [0.5, 0.5, 0.5], [0.5, 0.5, 0.5]
+    else:
+        return [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
+def normalize_batch(inputs, mean, std, flip_channels=False):
+    """Batched ToTensor+Normalize for uint8 (or float in [0, 1]) (BS x 3 x H x W) inputs. <mean>/<std> are broadcastable
+    tensors on the inputs' device."""
+    if inputs.dtype == torch.uint8:
+        inputs = inputs.float().div_(255.)
+    inputs = (inputs - mean) / std
+    if flip_channels:
+        inputs = inputs.flip(1)
+    return inputs
+
+
+def build_transforms(arch, is_validation=False, uint8_batches=False, batch_augment=False, intermediate_size=256):
+    """Per-image transformation and batched training transformation (None unless <batch_augment>), see BaseDataset."""
+    mean, std = normalization_params(arch)
+    crop_im_size = 224 if 'googlenet' not in arch else 227
+
+    batch_transform = None
+    normal_transform = []
+    if batch_augment:
+        normal_transform.append(transforms.Resize((intermediate_size, intermediate_size)))
+        batch_transform = batch_augmentation.Compose([batch_augmentation.RandomResizedCrop(size=crop_im_size), batch_augmentation.RandomHorizontalFlip(0.5)])
+    elif not is_validation:
+        normal_transform.extend([transforms.RandomResizedCrop(size=crop_im_size), transforms.RandomHorizontalFlip(0.5)])
+    else:
+        normal_transform.extend([transforms.Resize(256), transforms.CenterCrop(crop_im_size)])
+    if uint8_batches or batch_augment:
+        normal_transform.append(transforms.PILToTensor())
+    else:
+        normal_transform.extend([transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)])
+    return transforms.Compose(normal_transform), batch_transform
+
+
 ################## BASIC PYTORCH DATASET USED FOR ALL DATASETS ##################################
 class BaseDataset(Dataset):
-    def __init__(self, image_dict, arch, is_validation=False):
+    def __init__(self, image_dict, arch, is_validation=False, uint8_batches=False, batch_augment=False, intermediate_size=256, n_views=1,
+                 decoded_cache_dir=None, decoded_size=256, decoded_max_aspect=2.0, val_cache_dir=None, val_cache_dtype='uint8'):
+        """
+        Args:
+            image_dict (dict): Dictionary of structure class: list_of_image_paths.
+            arch (string): Type of network architecture, influences normalization and crop size.
+            is_validation (bool, optional): Use deterministic validation transformations.
+            uint8_batches (bool, optional): Return uint8 CHW crops. Normalization (and the bninception channel flip)
+                is then left to the consumer, see DML_Model.f_norm.
+            batch_augment (bool, optional): Training only. Workers only decode and resize to <intermediate_size> and
+                return uint8 batches, the training augmentation is applied batched by the consumer through batch_transform.
+            intermediate_size (int, optional): Side length images are resized to when using batch_augment.
+            n_views (int, optional): Training only. Number of independently augmented views produced from each decoded
+                image. Samples are returned as (n_views x 3 x H x W) stacks, with batch_augment the views are created
+                by the consumer instead. Views are flattened into the batch with a shared label, see DML_Model.
+            decoded_cache_dir (string, optional): Training only. Directory (e.g. /dev/shm) of a node-wide cache of
+                decoded images. The process with LOCAL_RANK 0 creates it, all DDP ranks (and their workers) on the node
+                fill it with the images they decode, so every image is decoded once per node. With batch_augment it holds
+                exactly what the uncached pipeline starts from (the square <intermediate_size> resize). Without it, it holds
+                a downscaled copy with the aspect ratio kept (see decode_resized) and RandomResizedCrop crops from that
+                instead of the full resolution image: crops are upsampled from fewer pixels, so small crop scales lose
+                detail. Slots have a fixed size of decoded_size x decoded_max_aspect*decoded_size x 3 bytes per image
+                (~393KB with the defaults, ~23GB for SOP), printed when the cache is created.
+            decoded_size (int, optional): Without batch_augment: short side of the cached decoded images. Larger values
+                get closer to the uncached augmentation at a quadratic memory cost.
+            decoded_max_aspect (float, optional): Without batch_augment: the long side of cached images is at most
+                <decoded_max_aspect> x <decoded_size>, more elongated images are stored with a shorter short side.
+            val_cache_dir (string, optional): Validation only. Directory of a memmap holding the final deterministic
+                crops of the split, filled by all ranks during the first validation epoch and read by all later ones. The
+                cache is keyed by the split, transformations and normalization, so changing any of them starts a new one.
+            val_cache_dtype (string, optional): 'uint8' stores crops before normalization, 'float16' stores normalized
+                crops. uint8_batches always uses 'uint8'.
+        """
         self.is_validation = is_validation
         self.arch        = arch
+        self.batch_augment = batch_augment and not is_validation
+        self.uint8_batches = uint8_batches or self.batch_augment
+        self.n_views = n_views if not is_validation else 1
         self.path_ooDML_splits = None
 
         #####
-        self.image_dict = image_dict
+        self.init_setup(image_dict)
 
         #####
-        self.init_setup()
+        self.decoded_cache, self.decoded_shapes = None, None
+        self.decoded_size = intermediate_size if self.batch_augment else decoded_size
+        self.decoded_max_size = self.decoded_size if self.batch_augment else int(decoded_size*decoded_max_aspect)
+        if decoded_cache_dir is not None and not self.is_validation:
+            key = 'decoded_' + signature(self.path_blob, self.path_offsets, self.batch_augment, self.decoded_size, self.decoded_max_size)
+            if self.batch_augment:
+                slot_shape = (self.decoded_size, self.decoded_size, 3)
+            else:
+                ### Images of varying shape are stored flattened, their (H, W) in a second cache
+                slot_shape = (self.decoded_size*self.decoded_max_size*3,)
+                self.decoded_shapes = MemmapCache(decoded_cache_dir, key + '_shapes', self.n_files, (2,), dtype=np.int32, owner=local_rank()==0)
+            self.decoded_cache = MemmapCache(decoded_cache_dir, key, self.n_files, slot_shape, owner=local_rank()==0)
+            if local_rank() == 0:
+                slot_bytes = int(np.prod(slot_shape))
+                print(f"Decoded cache: [{self.n_files}] images of up to [{slot_bytes/1e3:.0f}] KB, [{self.n_files*slot_bytes/1e9:.1f}] GB in [{decoded_cache_dir}]"
+                      + ("." if self.batch_augment else f", training crops are taken from images downscaled to a short side of [{self.decoded_size}]."))
 
         #####
-        if 'clip' in self.arch:
-            self.f_norm = normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],std=[0.26862954, 0.26130258, 0.27577711])
-        elif 'bninception' in self.arch:
-            self.f_norm = normalize = transforms.Normalize(mean=[0.502, 0.4588, 0.4078],std=[0.0039, 0.0039, 0.0039])
-        elif 'vit' in self.arch:
-            self.f_norm = normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5],std=[0.5, 0.5, 0.5])
-        else:
-            self.f_norm = normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
+        self.norm_mean, self.norm_std = normalization_params(self.arch)
+        self.flip_channels = 'bninception' in self.arch
+        self.f_norm = transforms.Normalize(mean=self.norm_mean, std=self.norm_std)
         self.crop_size = crop_im_size = 224 if 'googlenet' not in self.arch else 227
 
         #############
-        self.normal_transform = []
-        if not self.is_validation:
-            self.normal_transform.extend([transforms.RandomResizedCrop(size=crop_im_size), transforms.RandomHorizontalFlip(0.5)])
-        else:
-            self.normal_transform.extend([transforms.Resize(256), transforms.CenterCrop(crop_im_size)])
-        self.normal_transform.extend([transforms.ToTensor(), normalize])
-        self.normal_transform = transforms.Compose(self.normal_transform)
+        self.normal_transform, self.batch_transform = build_transforms(self.arch, self.is_validation, self.uint8_batches,
+                                                                       self.batch_augment, intermediate_size)
 
-    def init_setup(self):
-        self.n_files       = np.sum([len(self.image_dict[key]) for key in self.image_dict.keys()])
-        self.avail_classes = sorted(list(self.image_dict.keys()))
+        #############
+        self.val_cache = None
+        if val_cache_dir is not None and self.is_validation:
+            val_cache_dtype = np.dtype('uint8' if self.uint8_batches else val_cache_dtype)
+            self.val_cache_transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(crop_im_size), transforms.PILToTensor()])
+            key = 'val_' + signature(self.path_blob, self.path_offsets, repr(self.val_cache_transform), self.norm_mean, self.norm_std,
+                                     self.flip_channels, val_cache_dtype)
+            self.val_cache = MemmapCache(val_cache_dir, key, self.n_files, (3, crop_im_size, crop_im_size), dtype=val_cache_dtype,
+                                         owner=local_rank()==0)
+            self.norm_mean_t, self.norm_std_t = torch.tensor(self.norm_mean).view(-1, 1, 1), torch.tensor(self.norm_std).view(-1, 1, 1)
+
+    def init_setup(self, image_dict):
+        self.avail_classes = np.array(sorted(list(image_dict.keys())))
+
+        ### Flatten the {class: [paths]} dict into a few contiguous arrays. Python lists of tuples get their refcounts
+        ### touched by every dataloader worker, which breaks copy-on-write and duplicates them per worker and rank.
+        paths        = [path.encode('utf-8') for key in self.avail_classes for path in image_dict[key]]
+        class_counts = np.array([len(image_dict[key]) for key in self.avail_classes], dtype=np.int64)
 
-        counter = 0
-        temp_image_dict = {}
-        for i,key in enumerate(self.avail_classes):
-            temp_image_dict[key] = []
-            for path in self.image_dict[key]:
-                temp_image_dict[key].append([path, counter])
-                counter += 1
+        self.n_files      = int(class_counts.sum())
+        self.path_blob    = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        self.path_offsets = np.zeros(self.n_files+1, dtype=np.int64)
+        self.path_offsets[1:] = np.cumsum([len(path) for path in paths])
+        self.labels       = np.repeat(self.avail_classes, class_counts).astype(np.int32)
 
-        self.image_dict = temp_image_dict
-        self.image_list = [[(x[0],key) for x in self.image_dict[key]] for key in self.image_dict.keys()]
-        self.image_list = [x for y in self.image_list for x in y]
+        ### CSR-style class index: samples of class avail_classes[c] are class_indices[class_offsets[c]:class_offsets[c+1]]
+        self.class_offsets = np.zeros(len(self.avail_classes)+1, dtype=np.int64)
+        self.class_offsets[1:] = np.cumsum(class_counts)
+        self.class_indices = np.arange(self.n_files, dtype=np.int64)
 
-        self.image_paths = self.image_list
+        ### Optional class hierarchy, see set_super_classes
+        self.class_super = None
+        self.super_offsets, self.super_indices = None, None
 
         self.is_init = True
 
+    def set_super_classes(self, super_dict):
+        """
+        Stores a class hierarchy (e.g. the SOP super-categories) as arrays: class_super[c] is the super-class of class
+        avail_classes[c], and CSR-style the classes (positions in avail_classes) of super-class s are
+        super_indices[super_offsets[s]:super_offsets[s+1]]. Super-class ids are renumbered to 0..n_super-1.
+
+        Args:
+            super_dict (dict): Dictionary of structure class: super_class, covering all available classes.
+        """
+        _, self.class_super = np.unique([super_dict[key] for key in self.avail_classes], return_inverse=True)
+        self.class_super   = self.class_super.astype(np.int64)
+        self.super_indices = np.argsort(self.class_super, kind='stable').astype(np.int64)
+        self.super_offsets = np.zeros(self.class_super.max()+2, dtype=np.int64)
+        self.super_offsets[1:] = np.cumsum(np.bincount(self.class_super))
+
+    def get_path(self, idx):
+        return bytes(self.path_blob[self.path_offsets[idx]:self.path_offsets[idx+1]]).decode('utf-8')
+
+    def relocate(self, old_root, new_root):
+        """Points all image paths below <old_root> to the same relative location below <new_root>, see data.cache_warmer.
+        Cache keys stay tied to the original paths."""
+        old_root, new_root = os.path.abspath(old_root), os.path.abspath(new_root)
+        paths = [os.path.abspath(self.get_path(idx)) for idx in range(self.n_files)]
+        paths = [os.path.join(new_root, os.path.relpath(path, old_root)).encode('utf-8') for path in paths]
+        self.path_blob    = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        self.path_offsets = np.zeros(self.n_files+1, dtype=np.int64)
+        self.path_offsets[1:] = np.cumsum([len(path) for path in paths])
+
+    @property
+    def image_list(self):
+        """List of (path, label) tuples. Materialized on every access, only meant for inspection."""
+        return [(self.get_path(idx), int(self.labels[idx])) for idx in range(self.n_files)]
+
+    @property
+    def image_paths(self):
+        return self.image_list
+
+    @property
+    def image_dict(self):
+        """Dict of structure class: [[path, idx], ...]. Materialized on every access, only meant for inspection."""
+        return {int(key): [[self.get_path(idx), int(idx)] for idx in self.class_indices[self.class_offsets[c]:self.class_offsets[c+1]]]
+                for c, key in enumerate(self.avail_classes)}
+
     def ensure_3dim(self, img):
         if len(img.size)==2:
             img = img.convert('RGB')
         return img
 
 
+    def load_image(self, idx):
+        if self.decoded_cache is None:
+            return self.ensure_3dim(Image.open(self.get_path(idx)))
+
+        ### Slots are flagged after they are written, so a filled image slot always has its shape filled
+        if self.decoded_shapes is None:
+            img = self.decoded_cache.get(idx)
+        else:
+            shape = self.decoded_shapes.get(idx)
+            img = self.decoded_cache.get(idx, int(np.prod(shape))*3) if shape is not None else None
+            img = img.reshape(*shape, 3) if img is not None else None
+        if img is None:
+            img = self.decode_resized(idx)
+            if self.decoded_shapes is not None:
+                self.decoded_shapes.put(idx, np.array(img.shape[:2], dtype=np.int32))
+            self.decoded_cache.put(idx, img)
+        return Image.fromarray(img)
+
+    def decode_resized(self, idx):
+        """
+        Decoded image <idx> as stored in the decoded cache: with batch_augment exactly the square resize of
+        build_transforms, otherwise resized like transforms.Resize(decoded_size), i.e. keeping the aspect ratio that
+        RandomResizedCrop samples from, with the long side limited to decoded_max_size.
+        """
+        img = Image.open(self.get_path(idx)).convert('RGB')
+        if self.batch_augment:
+            return np.asarray(img.resize((self.decoded_size, self.decoded_size), Image.BILINEAR))
+        w, h = img.size
+        short, long = min(w, h), max(w, h)
+        new_short, new_long = self.decoded_size, int(self.decoded_size * long / short)
+        if new_long > self.decoded_max_size:
+            new_short, new_long = max(1, int(self.decoded_max_size * short / long)), self.decoded_max_size
+        return np.asarray(img.resize((new_long, new_short) if w >= h else (new_short, new_long), Image.BILINEAR))
+
+    def tensor_cache(self):
+        """
+        Cache the whole split can be served from by data.tensor_loader.TensorBatchLoader, or None. Training uses the
+        decoded cache and requires batch_augment, as the cached images are only resized. Validation uses a uint8 val_cache.
+        """
+        if not self.is_validation and self.batch_augment and self.decoded_cache is not None:
+            return self.decoded_cache
+        elif self.is_validation and self.val_cache is not None and self.val_cache.dtype == np.uint8:
+            return self.val_cache
+        return None
+
+    def tensor_data(self):
+        """
+        Returns (uint8 images, labels, channels_last) of the whole split for data.tensor_loader.TensorBatchLoader, or None
+        if the split is not fully held in memory, i.e. tensor_cache() is not completely filled, see fill_tensor_cache.
+        """
+        cache = self.tensor_cache()
+        if cache is None or cache.n_filled() < self.n_files:
+            return None
+        return cache.data, self.labels, cache is self.decoded_cache
+
+    def fill_tensor_cache(self, num_workers=0):
+        """
+        Decodes all samples missing in tensor_cache() into it, in index order with <num_workers> dataloader workers.
+        Samplers do not guarantee to visit every index, so training would rarely fill the cache completely.
+        Returns the number of filled samples.
+        """
+        cache = self.tensor_cache()
+        if cache is None or not cache.writable or not cache.attach():
+            return 0
+        missing = np.flatnonzero(np.asarray(cache.filled) == 0)
+        if len(missing):
+            for _ in DataLoader(CacheFillDataset(self, missing), batch_size=None, num_workers=num_workers):
+                pass
+        return len(missing)
+
+    def val_cache_item(self, idx):
+        im_a = self.val_cache.get(idx)
+        if im_a is None:
+            im_a = self.val_cache_transform(self.load_image(idx))
+            if self.val_cache.dtype == np.float16:
+                im_a = normalize_batch(im_a, self.norm_mean_t, self.norm_std_t, False).half()
+            im_a = im_a.numpy()
+            self.val_cache.put(idx, im_a)
+        im_a = torch.from_numpy(im_a)
+
+        if self.uint8_batches:
+            return im_a
+        elif im_a.dtype == torch.uint8:
+            return normalize_batch(im_a, self.norm_mean_t, self.norm_std_t, False)
+        else:
+            return im_a.float()
+
     def __getitem__(self, idx):
+        if self.val_cache is not None:
+            im_a = self.val_cache_item(idx)
+            if self.flip_channels and not self.uint8_batches:
+                im_a = im_a[range(3)[::-1], :, :]
+            return im_a, int(self.labels[idx]), idx
 
-        input_image = self.ensure_3dim(Image.open(self.image_list[idx][0]))
-        im_a = self.normal_transform(input_image)
-        if 'bninception' in self.arch:
-            im_a = im_a[range(3)[::-1],:]
-        return im_a, self.image_list[idx][-1], idx
+        input_image = self.load_image(idx)
+        if self.n_views > 1 and not self.batch_augment:
+            im_a = torch.stack([self.normal_transform(input_image) for _ in range(self.n_views)])
+        else:
+            im_a = self.normal_transform(input_image)
+        if self.flip_channels and not self.uint8_batches:
+            im_a = im_a[..., range(3)[::-1], :, :]
+        return im_a, int(self.labels[idx]), idx
 
     def __len__(self):
         return self.n_files
+
+
+class CacheFillDataset(Dataset):
+    """Fills the decoded/validation cache of <dataset> at the indices <missing>, see BaseDataset.fill_tensor_cache."""
+    def __init__(self, dataset, missing):
+        self.dataset = dataset
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.missing)
+
+    def __getitem__(self, i):
+        idx = int(self.missing[i])
+        if self.dataset.is_validation:
+            self.dataset.val_cache_item(idx)
+        else:
+            self.dataset.load_image(idx)
+        return idx
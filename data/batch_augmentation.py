@@ -0,0 +1,176 @@
+import math
+import numbers
+import torch
+import torch.nn.functional as F
+
+"""==================================================================================================="""
+################## BATCHED COUNTERPARTS OF THE PER-IMAGE TRANSFORMS IN augmentation.py #############
+# All transforms take a (BS x 3 x H x W) tensor, draw their random parameters per sample and run on the device the
+# batch lives on. uint8 inputs are converted to float in [0, 1] by Compose, all outputs are float in [0, 1].
+
+class Compose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, imgs):
+        if imgs.dtype == torch.uint8:
+            imgs = imgs.float().div_(255.)
+        for t in self.transforms:
+            imgs = t(imgs)
+        return imgs
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + ', '.join([repr(t) for t in self.transforms]) + ')'
+
+
+def apply_mask(p, bs, device):
+    return torch.rand(bs, device=device) < p
+
+
+def affine_sample(imgs, theta, size):
+    grid = F.affine_grid(theta, [len(imgs), imgs.shape[1], size[0], size[1]], align_corners=False)
+    return F.grid_sample(imgs, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+
+class RandomResizedCrop:
+    """Crops a random area (fraction <scale> of the image, aspect ratio in <ratio>) per sample and resizes it to <size>.
+
+    Unlike torchvision, crops that do not fit are shrunk to the image borders instead of being re-drawn.
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4, 4. / 3)):
+        self.size = (int(size), int(size)) if isinstance(size, numbers.Number) else size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+
+    def __call__(self, imgs):
+        bs, device = len(imgs), imgs.device
+        area = torch.empty(bs, device=device).uniform_(*self.scale)
+        aspect_ratio = torch.exp(torch.empty(bs, device=device).uniform_(*self.log_ratio))
+
+        ### Crop width/height relative to the image size, crop center in normalized [-1, 1] coordinates
+        w = torch.sqrt(area * aspect_ratio).clamp(max=1.)
+        h = torch.sqrt(area / aspect_ratio).clamp(max=1.)
+        cx = (torch.rand(bs, device=device) * 2 - 1) * (1 - w)
+        cy = (torch.rand(bs, device=device) * 2 - 1) * (1 - h)
+
+        theta = torch.zeros(bs, 2, 3, device=device)
+        theta[:, 0, 0], theta[:, 0, 2] = w, cx
+        theta[:, 1, 1], theta[:, 1, 2] = h, cy
+        return affine_sample(imgs, theta, self.size)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0}, scale={1})'.format(self.size, self.scale)
+
+
+class RandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        flip = apply_mask(self.p, len(imgs), imgs.device).view(-1, 1, 1, 1)
+        return torch.where(flip, imgs.flip(-1), imgs)
+
+
+class RandomRotation:
+    """Rotates each sample by an angle drawn uniformly from [-degree, degree]. The output keeps the input size."""
+    def __init__(self, degree=15, p=1.0):
+        self.degree = degree
+        self.p = p
+
+    def __call__(self, imgs):
+        bs, device = len(imgs), imgs.device
+        h, w = imgs.shape[-2:]
+        angle = torch.empty(bs, device=device).uniform_(-self.degree, self.degree) * math.pi / 180
+        angle = angle * apply_mask(self.p, bs, device)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        ### Rotation in pixel space, expressed in normalized coordinates of a possibly non-square image
+        theta = torch.zeros(bs, 2, 3, device=device)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin * h / w
+        theta[:, 1, 0], theta[:, 1, 1] = sin * w / h, cos
+        return affine_sample(imgs, theta, (h, w))
+
+
+class RandomGray:
+    '''Actually it is a channel splitting, not strictly grayscale images'''
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        bs, device = len(imgs), imgs.device
+        channel = torch.randint(imgs.shape[1], (bs,), device=device)
+        gray = imgs[torch.arange(bs, device=device), channel].unsqueeze(1).expand_as(imgs)
+        return torch.where(apply_mask(self.p, bs, device).view(-1, 1, 1, 1), gray, imgs)
+
+
+class ColorJitter:
+    """Randomly change the brightness, contrast, saturation and hue of each sample. Parameters follow
+    augmentation.ColorJitter, but the adjustments are applied in a fixed order and hue is rotated in YIQ space.
+    """
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0, p=1.0):
+        self.brightness = self._check_input(brightness, 'brightness')
+        self.contrast = self._check_input(contrast, 'contrast')
+        self.saturation = self._check_input(saturation, 'saturation')
+        self.hue = self._check_input(hue, 'hue', center=0, bound=(-0.5, 0.5), clip_first_on_zero=False)
+        self.p = p
+
+    def _check_input(self, value, name, center=1, bound=(0, float('inf')), clip_first_on_zero=True):
+        if isinstance(value, numbers.Number):
+            if value < 0:
+                raise ValueError("If {} is a single number, it must be non negative.".format(name))
+            value = [center - value, center + value]
+            if clip_first_on_zero:
+                value[0] = max(value[0], 0)
+        elif isinstance(value, (tuple, list)) and len(value) == 2:
+            if not bound[0] <= value[0] <= value[1] <= bound[1]:
+                raise ValueError("{} values should be between {}".format(name, bound))
+        else:
+            raise TypeError("{} should be a single number or a list/tuple with lenght 2.".format(name))
+
+        if value[0] == value[1] == center:
+            value = None
+        return value
+
+    def _factors(self, value, center, mask):
+        factors = torch.empty(len(mask), device=mask.device).uniform_(value[0], value[1])
+        return torch.where(mask, factors, torch.full_like(factors, center)).view(-1, 1, 1, 1)
+
+    @staticmethod
+    def grayscale(imgs):
+        return (0.299 * imgs[:, 0:1] + 0.587 * imgs[:, 1:2] + 0.114 * imgs[:, 2:3])
+
+    def __call__(self, imgs):
+        mask = apply_mask(self.p, len(imgs), imgs.device)
+
+        if self.brightness is not None:
+            imgs = (imgs * self._factors(self.brightness, 1, mask)).clamp(0, 1)
+
+        if self.contrast is not None:
+            mean = self.grayscale(imgs).mean(dim=(1, 2, 3), keepdim=True)
+            imgs = ((imgs - mean) * self._factors(self.contrast, 1, mask) + mean).clamp(0, 1)
+
+        if self.saturation is not None:
+            gray = self.grayscale(imgs)
+            imgs = ((imgs - gray) * self._factors(self.saturation, 1, mask) + gray).clamp(0, 1)
+
+        if self.hue is not None:
+            angle = self._factors(self.hue, 0, mask).view(-1) * 2 * math.pi
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            rgb2yiq = imgs.new_tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+            yiq2rgb = torch.inverse(rgb2yiq)
+            rot = torch.zeros(len(imgs), 3, 3, device=imgs.device)
+            rot[:, 0, 0] = 1
+            rot[:, 1, 1], rot[:, 1, 2] = cos, -sin
+            rot[:, 2, 1], rot[:, 2, 2] = sin, cos
+            transform = yiq2rgb.unsqueeze(0) @ rot @ rgb2yiq.unsqueeze(0)
+            imgs = torch.einsum('bij,bjhw->bihw', transform, imgs).clamp(0, 1)
+
+        return imgs
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + '('
+        format_string += 'brightness={0}'.format(self.brightness)
+        format_string += ', contrast={0}'.format(self.contrast)
+        format_string += ', saturation={0}'.format(self.saturation)
+        format_string += ', hue={0})'.format(self.hue)
+        return format_string
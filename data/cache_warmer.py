@@ -0,0 +1,85 @@
+import os
+import time
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from data.image_cache import signature
+
+
+"""==================================================================================================="""
+################## STAGING OF DATASET FILES FROM SHARED STORAGE TO A NODE-LOCAL DIRECTORY ##########
+# Files are copied to a temporary name and renamed once verified, so an interrupted run never leaves a partial file
+# under its final name. Restarts skip all files that are already present and verified. A marker file keyed by the
+# staged file list is written once all files of a split are in place, see is_staged.
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_valid_copy(src, dst, verify='size'):
+    """Checks <dst> against <src> by file size, or by size and sha1 checksum for verify='sha1'."""
+    if not os.path.exists(dst) or os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    if verify == 'sha1':
+        return file_digest(src) == file_digest(dst)
+    return True
+
+
+def stage_file(src, dst, verify='size'):
+    """Copies <src> to <dst> unless a valid copy exists. Returns the number of bytes copied."""
+    if is_valid_copy(src, dst, verify):
+        return 0
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = dst + '.{}.tmp'.format(os.getpid())
+    shutil.copyfile(src, tmp_path)
+    if not is_valid_copy(src, tmp_path, verify):
+        os.remove(tmp_path)
+        raise IOError(f'Staged copy of [{src}] does not match the source.')
+    os.replace(tmp_path, dst)
+    return os.path.getsize(dst)
+
+
+def marker_path(paths, dst_root, verify='size'):
+    return os.path.join(dst_root, '.staged_' + signature(*paths, verify))
+
+
+def is_staged(paths, dst_root, verify='size'):
+    return os.path.exists(marker_path(paths, dst_root, verify))
+
+
+def stage_files(paths, src_root, dst_root, n_threads=16, verify='size'):
+    """
+    Copies <paths> (below <src_root>) in parallel to the same relative locations below <dst_root>.
+
+    Args:
+        paths (list): Absolute paths of the files to stage, all below <src_root>.
+        src_root (string): Root directory on the shared storage.
+        dst_root (string): Node-local directory mirroring <src_root>.
+        n_threads (int, optional): Number of parallel copies. Copying is I/O bound, so threads suffice.
+        verify (string, optional): 'size' or 'sha1', see is_valid_copy.
+    """
+    if is_staged(paths, dst_root, verify):
+        print(f'\nCache warmer: [{len(paths)}] files already staged in [{dst_root}].\n')
+        return
+
+    src_root = os.path.abspath(src_root)
+    jobs = []
+    for path in paths:
+        rel_path = os.path.relpath(os.path.abspath(path), src_root)
+        if rel_path.startswith('..'):
+            raise ValueError(f'[{path}] is not located below the dataset root [{src_root}].')
+        jobs.append((path, os.path.join(dst_root, rel_path)))
+
+    start = time.time()
+    with ThreadPoolExecutor(n_threads) as pool:
+        n_bytes = list(pool.map(lambda job: stage_file(*job, verify=verify), jobs))
+    n_copied = sum([x > 0 for x in n_bytes])
+    print(f'\nCache warmer: staged [{len(paths)}] files from [{src_root}] to [{dst_root}], copied [{n_copied}] '
+          f'({sum(n_bytes)/1e6:.1f} MB) in {time.time()-start:.1f}s.\n')
+
+    with open(marker_path(paths, dst_root, verify), 'w') as f:
+        f.write(src_root)
@@ -0,0 +1,108 @@
+import os
+import hashlib
+import numpy as np
+
+
+"""==================================================================================================="""
+################## FIXED-SHAPE SLOT CACHE ON A MEMORY MAPPED FILE ##################################
+class MemmapCache:
+    """
+    Caches one fixed-shape array per sample index in a memory mapped .npy file, e.g. in /dev/shm to share it between
+    all processes on a node. A second uint8 file marks filled slots: a slot is written first and flagged afterwards,
+    so readers never need a lock and at worst decode a sample that is being written concurrently. Slots only depend
+    on the sample, so several processes may fill the same slot concurrently.
+
+    Args:
+        cache_dir (string): Directory the cache files are placed in.
+        key (string): Unique name of the cache, e.g. from signature().
+        n_slots (int): Number of samples.
+        slot_shape (tuple): Shape of a single cached sample.
+        dtype (numpy dtype, optional): Data type of the cached samples.
+        writable (bool, optional): Whether this process fills the cache.
+        owner (bool, optional): Whether this process creates the files, defaults to <writable>. All other instances
+            wait for the owner to create the files and treat missing files as cache misses.
+    """
+    def __init__(self, cache_dir, key, n_slots, slot_shape, dtype=np.uint8, writable=True, owner=None):
+        self.data_path   = os.path.join(cache_dir, key + '.npy')
+        self.filled_path = os.path.join(cache_dir, key + '_filled.npy')
+        self.n_slots     = n_slots
+        self.slot_shape  = tuple(slot_shape)
+        self.dtype       = np.dtype(dtype)
+        self.writable    = writable
+        self.owner       = writable if owner is None else owner
+
+        self.data, self.filled = None, None
+        if self.owner:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.create()
+
+    def create(self):
+        ### Reuse existing files of matching shape (e.g. from a previous run on this node)
+        if self.attach():
+            return
+        for path, shape, dtype in [(self.data_path, (self.n_slots, *self.slot_shape), self.dtype), (self.filled_path, (self.n_slots,), np.uint8)]:
+            tmp_path = path + '.{}.tmp.npy'.format(os.getpid())
+            np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape).flush()
+            os.replace(tmp_path, path)
+        self.data, self.filled = None, None
+
+    def attach(self):
+        """Opens the memory maps in the calling process, returns False if the cache files do not exist (yet)."""
+        if self.filled is not None:
+            return True
+        if not os.path.exists(self.filled_path):
+            return False
+        mode = 'r+' if self.writable else 'r'
+        data   = np.load(self.data_path, mmap_mode=mode)
+        filled = np.load(self.filled_path, mmap_mode=mode)
+        if data.shape != (self.n_slots, *self.slot_shape) or data.dtype != self.dtype or filled.shape != (self.n_slots,):
+            if not self.owner:
+                return False
+            del data, filled
+            os.remove(self.filled_path)
+            return False
+        self.data, self.filled = data, filled
+        return True
+
+    def get(self, idx, size=None):
+        """Copy of slot <idx>, None if it is not filled. <size> only reads the first entries of a flat (1-dim) slot."""
+        if not self.attach() or not self.filled[idx]:
+            return None
+        return np.array(self.data[idx] if size is None else self.data[idx, :size])
+
+    def put(self, idx, value):
+        """Fills slot <idx>. Values smaller than a flat (1-dim) slot are stored at its beginning, see get()."""
+        if not self.writable or not self.attach():
+            return
+        if len(self.slot_shape) == 1:
+            value = np.asarray(value).reshape(-1)
+            self.data[idx, :len(value)] = value
+        else:
+            self.data[idx] = value
+        self.filled[idx] = 1
+
+    def n_filled(self):
+        return int(np.count_nonzero(self.filled)) if self.attach() else 0
+
+    def __getstate__(self):
+        ### Memory maps are re-opened in each dataloader worker
+        state = self.__dict__.copy()
+        state['data'], state['filled'] = None, None
+        return state
+
+
+def signature(*items):
+    """Hash of arbitrary strings/bytes/arrays, used to key caches by their content."""
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = item.tobytes()
+        elif not isinstance(item, bytes):
+            item = str(item).encode('utf-8')
+        h.update(item)
+        h.update(b'|')
+    return h.hexdigest()[:16]
+
+
+def local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
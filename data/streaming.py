@@ -0,0 +1,302 @@
+import os
+import io
+import json
+import tarfile
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from PIL import Image
+from .basic_dml_dataset import build_transforms, normalization_params
+
+
+"""==================================================================================================="""
+################## PACKED SHARDS ###################################################################
+# A shard is an uncompressed tar file holding <index>.jpg (the encoded image) followed by <index>.cls (its label) per
+# sample. shards.json in the shard directory lists the shards, their number of samples and the number of samples and
+# classes.
+
+def write_shards(paths, labels, out_dir, samples_per_shard=1000, seed=0):
+    """
+    Packs image files into shards for StreamingDataset, e.g. write_shards(*zip(*dataset.image_list), out_dir) for a
+    BaseDataset. Classes are written in random order with their samples consecutively, so that a reader collects
+    samples_per_class images of a class from a few shards without buffering large parts of the dataset.
+
+    Args:
+        paths (list): Image files.
+        labels (list): Class label of each image.
+        out_dir (string): Directory the shards and shards.json are written to.
+        samples_per_shard (int, optional): Number of samples per shard.
+        seed (int, optional): Seed of the class and sample order.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    classes = rng.permutation(np.unique(labels))
+    order = np.concatenate([rng.permutation(np.where(labels == c)[0]) for c in classes])
+
+    os.makedirs(out_dir, exist_ok=True)
+    shards, shard_sizes = [], []
+    for start in range(0, len(order), samples_per_shard):
+        name = 'shard-{:06d}.tar'.format(len(shards))
+        tmp_path = os.path.join(out_dir, name + '.tmp')
+        with tarfile.open(tmp_path, 'w') as tar:
+            for idx in order[start:start+samples_per_shard]:
+                with open(paths[idx], 'rb') as f:
+                    add_member(tar, '{:09d}.jpg'.format(idx), f.read())
+                add_member(tar, '{:09d}.cls'.format(idx), str(int(labels[idx])).encode('utf-8'))
+        os.replace(tmp_path, os.path.join(out_dir, name))
+        shards.append(name)
+        shard_sizes.append(len(order[start:start+samples_per_shard]))
+
+    with open(os.path.join(out_dir, 'shards.json'), 'w') as f:
+        json.dump({'shards': shards, 'shard_sizes': shard_sizes, 'n_samples': len(order), 'n_classes': len(classes)}, f, indent=2)
+    print(f'Wrote [{len(order)}] samples of [{len(classes)}] classes to [{len(shards)}] shards in [{out_dir}].')
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def read_shard(path):
+    """Yields (index, encoded image, label) of all samples of a shard, reading it sequentially."""
+    sample = {}
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            key, ext = os.path.splitext(member.name)
+            sample[ext] = tar.extractfile(member).read()
+            if '.jpg' in sample and '.cls' in sample:
+                yield int(key), sample['.jpg'], int(sample['.cls'])
+                sample = {}
+
+
+def interleave(iterators):
+    """Round robin over <iterators> until all are exhausted."""
+    iterators = list(iterators)
+    while iterators:
+        for it in list(iterators):
+            try:
+                yield next(it)
+            except StopIteration:
+                iterators.remove(it)
+
+
+def distributed_info():
+    try:
+        return dist.get_rank(), dist.get_world_size()
+    except:
+        return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+"""==================================================================================================="""
+################## STREAMING DATASET ###############################################################
+class StreamingDataset(IterableDataset):
+    """
+    Streams samples from packed shards (see write_shards) instead of addressing single image files, for datasets whose
+    file list does not fit into memory. Every iteration yields a complete (images, labels, indices) batch, so it is
+    used with DataLoader(batch_size=None), see DataModuleFromConfig.
+
+    The shards are shuffled per epoch and split across DDP ranks and dataloader workers without overlap. Training
+    batches mimic class_random_sampler: each worker keeps a bounded reservoir of at most <class_capacity> samples per
+    class and <buffer_size> samples in total, and once it is full emits a batch of batch_size//samples_per_class
+    random classes with <samples_per_class> random samples each. If too few classes hold enough samples, the class
+    that entered the buffer first is dropped. Validation shards are only split across dataloader workers, every DDP rank
+    evaluates the full set (as with map-style datasets) with batches emitted in shard order.
+
+    Args:
+        shard_dir (string): Directory with shards.json and the shards.
+        arch (string): Type of network architecture, influences normalization and crop size.
+        batch_size (int, optional): Number of samples per batch, set by DataModuleFromConfig.
+        num_workers (int, optional): Number of dataloader workers, set by DataModuleFromConfig. Validation only, gives
+            the number of batches.
+        samples_per_class (int, optional): Number of samples per class in a training batch.
+        is_validation (bool, optional): Use deterministic validation transformations and batches in shard order.
+        buffer_size (int, optional): Maximal number of buffered samples per worker.
+        class_capacity (int, optional): Maximal number of buffered samples per class, defaults to 4*samples_per_class.
+        n_open_shards (int, optional): Number of shards read interleaved by each worker.
+        batches_per_epoch (int, optional): Training only. Number of batches per epoch and rank, defaults to
+            n_samples // world_size // batch_size. Workers cycle through their shards until they produced their share,
+            so all DDP ranks run the same number of steps regardless of shard sizes and buffer evictions.
+        seed (int, optional): Seed of the shard order, shared by all ranks.
+        uint8_batches, batch_augment, intermediate_size: See BaseDataset.
+    """
+    def __init__(self, shard_dir, arch, batch_size=None, num_workers=0, samples_per_class=2, is_validation=False, buffer_size=4096,
+                 class_capacity=None, n_open_shards=4, batches_per_epoch=None, seed=0, uint8_batches=False,
+                 batch_augment=False, intermediate_size=256):
+        with open(os.path.join(shard_dir, 'shards.json')) as f:
+            index = json.load(f)
+        self.shards     = [os.path.join(shard_dir, name) for name in index['shards']]
+        self.shard_sizes = index.get('shard_sizes')
+        self.n_samples  = index['n_samples']
+        self.n_classes  = index['n_classes']
+
+        self.arch              = arch
+        self.is_validation     = is_validation
+        self.batch_size        = batch_size
+        self.num_workers       = num_workers
+        self.samples_per_class = samples_per_class
+        self.buffer_size       = buffer_size
+        self.class_capacity    = class_capacity if class_capacity is not None else 4 * samples_per_class
+        self.n_open_shards     = n_open_shards
+        self.batches_per_epoch = batches_per_epoch if not is_validation else None
+        self.seed              = seed
+        ### Shared with the dataloader workers, so persistent workers see set_epoch as well
+        self.shared_epoch      = torch.zeros(1, dtype=torch.long).share_memory_()
+
+        #####
+        self.batch_augment = batch_augment and not is_validation
+        self.uint8_batches = uint8_batches or self.batch_augment
+        self.n_views = 1
+        self.norm_mean, self.norm_std = normalization_params(self.arch)
+        self.flip_channels = 'bninception' in self.arch
+        self.normal_transform, self.batch_transform = build_transforms(self.arch, self.is_validation, self.uint8_batches,
+                                                                       self.batch_augment, intermediate_size)
+
+    def set_epoch(self, epoch):
+        ## Called before the epoch's iterators are created (SamplerEpochCallback), workers read it when they start iterating
+        self.shared_epoch[0] = epoch
+
+    def __len__(self):
+        ## Validation: every worker may end with a partial batch, an upper bound if shards.json holds no shard sizes
+        if self.is_validation:
+            n_workers = max(self.num_workers, 1)
+            if self.shard_sizes is None:
+                return -(-self.n_samples // self.batch_size) + n_workers - 1
+            return sum(-(-sum(self.shard_sizes[w::n_workers]) // self.batch_size) for w in range(n_workers))
+        if self.batches_per_epoch is not None:
+            return self.batches_per_epoch
+        _, world_size = distributed_info()
+        return max(self.n_samples // world_size // self.batch_size, 1)
+
+    def worker_shards(self, epoch, n_pass=0):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        ### Validation: every rank reads all shards in order, split across its workers
+        if self.is_validation:
+            return self.shards[worker_id::num_workers], worker_id, num_workers
+
+        ### Training: same shard permutation on all ranks, every (rank, worker) reads a disjoint subset
+        rank, world_size = distributed_info()
+        n_streams, stream = world_size * num_workers, rank * num_workers + worker_id
+        if len(self.shards) < n_streams:
+            raise ValueError(f'{len(self.shards)} shards can not be split across {world_size} ranks x {num_workers} workers.')
+        order = np.random.default_rng([self.seed, epoch, n_pass]).permutation(len(self.shards))
+        return [self.shards[i] for i in order[stream::n_streams]], worker_id, num_workers
+
+    def stream_samples(self, epoch, cycle=False):
+        n_pass = 0
+        while True:
+            shards, _, _ = self.worker_shards(epoch, n_pass)
+            for start in range(0, len(shards), self.n_open_shards):
+                yield from interleave(read_shard(path) for path in shards[start:start+self.n_open_shards])
+            if not cycle:
+                return
+            n_pass += 1
+
+    def make_batch(self, samples):
+        images = []
+        for _, data, _ in samples:
+            im = self.normal_transform(Image.open(io.BytesIO(data)).convert('RGB'))
+            if self.flip_channels and not self.uint8_batches:
+                im = im[range(3)[::-1], :, :]
+            images.append(im)
+        return torch.stack(images), torch.tensor([x[2] for x in samples]), torch.tensor([x[0] for x in samples])
+
+    def class_balanced_batches(self, samples, rng):
+        classes_per_batch = self.batch_size // self.samples_per_class
+        buffer, n_seen, n_buffered = {}, {}, 0
+
+        def pop_batch(ready):
+            batch = []
+            for label in rng.choice(ready, classes_per_batch, replace=False):
+                items = buffer[label]
+                for j in sorted(rng.choice(len(items), self.samples_per_class, replace=False), reverse=True):
+                    batch.append(items.pop(j))
+                if not items:
+                    del buffer[label], n_seen[label]
+            return batch
+
+        for sample in samples:
+            label = sample[2]
+            ### Reservoir sampling within each class, bounded by class_capacity
+            if label not in buffer:
+                buffer[label], n_seen[label] = [], 0
+            n_seen[label] += 1
+            if len(buffer[label]) < self.class_capacity:
+                buffer[label].append(sample)
+                n_buffered += 1
+            else:
+                j = rng.integers(n_seen[label])
+                if j < self.class_capacity:
+                    buffer[label][j] = sample
+            if n_buffered < self.buffer_size:
+                continue
+
+            ready = [key for key, items in buffer.items() if len(items) >= self.samples_per_class]
+            if len(ready) >= classes_per_batch:
+                n_buffered -= self.batch_size
+                yield pop_batch(ready)
+            else:
+                oldest = next(iter(buffer))
+                n_buffered -= len(buffer[oldest])
+                del buffer[oldest], n_seen[oldest]
+
+        ### Drain the buffer at the end of the stream
+        while True:
+            ready = [key for key, items in buffer.items() if len(items) >= self.samples_per_class]
+            if len(ready) < classes_per_batch:
+                return
+            yield pop_batch(ready)
+
+    def __iter__(self):
+        epoch = int(self.shared_epoch[0])
+        _, worker_id, num_workers = self.worker_shards(epoch)
+
+        if self.is_validation:
+            batch = []
+            for sample in self.stream_samples(epoch):
+                batch.append(sample)
+                if len(batch) == self.batch_size:
+                    yield self.make_batch(batch)
+                    batch = []
+            if batch:
+                yield self.make_batch(batch)
+            return
+
+        rank, _ = distributed_info()
+        rng = np.random.default_rng([self.seed, epoch, rank, worker_id])
+        ### Every rank yields exactly len(self) batches, split across its workers
+        n_batches = len(self) // num_workers + int(worker_id < len(self) % num_workers)
+        if n_batches == 0:
+            return
+        for i, batch in enumerate(self.class_balanced_batches(self.stream_samples(epoch, cycle=True), rng)):
+            yield self.make_batch(batch)
+            if i + 1 == n_batches:
+                return
+
+
+class DATA(IterableDataset):
+    """
+    Dataset target of DataModuleFromConfig streaming from packed shards, see StreamingDataset.
+
+    Args:
+        root (string): Directory of the shards of the split.
+        train (bool, optional): Specifies type of data split (train or validation).
+        arch (string, optional): Type of network architecture used for training, influences choice of transformations
+            applied when sampling batches.
+        **kwargs: Passed on to StreamingDataset, e.g. samples_per_class.
+    """
+    def __init__(self, root, train=True, arch='resnet50', **kwargs):
+        super(DATA, self).__init__()
+        self.train = train
+        self.root = root
+        self.dataset = StreamingDataset(root, arch, is_validation=not train, **kwargs)
+        self.n_classes = self.dataset.n_classes
+        print(f'DATASET:\ntype: Streaming\nSetup: {"Train" if train else "Val"}\n#Classes: {self.n_classes}\n#Images: {self.dataset.n_samples}\n#Shards: {len(self.dataset.shards)}')
+
+    def __iter__(self):
+        return iter(self.dataset)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+from .basic_dml_dataset import BaseDataset
+from .image_cache import signature
+
+
+class DATA(Dataset):
+    """
+    Synthetic DML dataset of JPEG files, e.g. to benchmark the training pipeline without CUB200/CARS196/SOP. Each class
+    is a random base color with per-image noise, so the images carry some class information. Files are generated once
+    per parameter set and reused by later instantiations. As for CUB200, the first half of the classes is used for
+    training and the second half for validation.
+
+    Args:
+        root (string, optional): Directory the images are written to, defaults to a directory in the system temp dir.
+        train (bool, optional): Specifies type of data split (train or validation).
+        arch (string, optional): Type of network architecture used for training, influences choice of transformations
+            applied when sampling batches.
+        n_classes (int, optional): Total number of classes of both splits.
+        images_per_class (int, optional): Number of images per class.
+        image_size (list, optional): [min, max] side lengths, width and height are drawn independently per image.
+        jpeg_quality (int, optional): JPEG quality of the written files, influences decoding time.
+        seed (int, optional): Seed of the generated images.
+        **kwargs: Passed on to BaseDataset, e.g. uint8_batches.
+    """
+    def __init__(
+            self,
+            root=None,
+            train=True,
+            arch='resnet50',
+            n_classes=200,
+            images_per_class=30,
+            image_size=(300, 500),
+            jpeg_quality=90,
+            seed=0,
+            **kwargs,
+            ):
+
+        super(DATA, self).__init__()
+        self.train = train
+        key = signature(n_classes, images_per_class, list(image_size), jpeg_quality, seed)
+        self.root = os.path.join(tempfile.gettempdir(), 'vq_dml_synthetic', key) if root is None else root
+        self.n_classes = n_classes // 2
+
+        image_dict = self.generate(n_classes, images_per_class, image_size, jpeg_quality, seed)
+        keys = sorted(list(image_dict.keys()))
+        train, test = keys[:len(keys) // 2], keys[len(keys) // 2:]
+
+        if self.train:
+            self.dataset = BaseDataset({key: image_dict[key] for key in train}, arch, **kwargs)
+            print(f'DATASET:\ntype: Synthetic\nSetup: Train\n#Classes: {len(train)}\n#Images: {len(self.dataset)}')
+        else:
+            self.dataset = BaseDataset({key: image_dict[key] for key in test}, arch, is_validation=True, **kwargs)
+            print(f'DATASET:\ntype: Synthetic\nSetup: Val\n#Classes: {len(test)}\n#Images: {len(self.dataset)}\n')
+
+    def generate(self, n_classes, images_per_class, image_size, jpeg_quality, seed):
+        ### Write all images of both splits, existing files (from earlier or concurrent instantiations) are kept
+        image_sourcepath = os.path.join(self.root, 'images')
+        rng = np.random.default_rng(seed)
+        class_colors = rng.integers(0, 256, size=(n_classes, 3))
+        sizes = rng.integers(image_size[0], image_size[1] + 1, size=(n_classes, images_per_class, 2))
+
+        image_dict = {}
+        for key in range(n_classes):
+            class_path = os.path.join(image_sourcepath, f'{key:04d}')
+            os.makedirs(class_path, exist_ok=True)
+            image_dict[key] = []
+            for i in range(images_per_class):
+                path = os.path.join(class_path, f'{i:05d}.jpg')
+                image_dict[key].append(path)
+                if os.path.exists(path):
+                    continue
+                w, h = sizes[key, i]
+                img_rng = np.random.default_rng([seed, key, i])
+                img = class_colors[key] + img_rng.normal(0, 40, size=(h, w, 3))
+                tmp_path = path + '.{}.tmp'.format(os.getpid())
+                Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(tmp_path, format='JPEG', quality=jpeg_quality)
+                os.replace(tmp_path, path)
+        return image_dict
+
+    def __getitem__(self, idx):
+        return self.dataset.__getitem__(idx)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+
+
+"""==================================================================================================="""
+################## BATCHED LOADER FOR DATASETS RESIDENT IN MEMORY ##################################
+class TensorBatchLoader:
+    """
+    Serves batches of a dataset that is held in memory as one uint8 image array by gathering the sampled indices
+    directly, without dataloader workers and per-sample transforms. Batches are (uint8 images, labels, indices), the
+    normalization and (batched) augmentation happen on the training device, see DML_Model.on_after_batch_transfer.
+
+    Args:
+        images (uint8 tensor or numpy array): All images of the dataset, (N x C x H x W) or (N x H x W x C), e.g. a
+            memory mapped decoded cache.
+        labels (tensor or numpy array): Label of each image.
+        batch_size (int): Number of samples per batch, ignored if <batch_sampler> is given.
+        batch_sampler (iterable, optional): Yields lists of indices per batch, e.g. a datasampler.
+        shuffle (bool, optional): Shuffle the indices every epoch, only used without <batch_sampler>.
+        drop_last (bool, optional): Drop the last incomplete batch, only used without <batch_sampler>.
+        channels_last (bool, optional): <images> are stored as (N x H x W x C).
+        pin_memory (bool, optional): Return batches in page-locked memory.
+    """
+    def __init__(self, images, labels, batch_size, batch_sampler=None, shuffle=False, drop_last=False, channels_last=False, pin_memory=False):
+        self.images        = images
+        self.labels        = torch.as_tensor(np.asarray(labels), dtype=torch.long)
+        self.batch_size    = batch_size
+        self.batch_sampler = batch_sampler
+        self.sampler       = batch_sampler
+        self.shuffle       = shuffle
+        self.drop_last     = drop_last
+        self.channels_last = channels_last
+        self.pin_memory    = pin_memory and torch.cuda.is_available()
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        n = len(self.labels)
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def index_batches(self):
+        if self.batch_sampler is not None:
+            yield from self.batch_sampler
+            return
+        order = torch.randperm(len(self.labels)) if self.shuffle else torch.arange(len(self.labels))
+        for i in range(len(self)):
+            yield order[i*self.batch_size:(i+1)*self.batch_size]
+
+    def gather(self, idx):
+        if isinstance(self.images, torch.Tensor):
+            images = self.images[idx]
+        else:
+            images = torch.from_numpy(self.images[idx.numpy()])
+        if self.channels_last:
+            images = images.permute(0, 3, 1, 2)
+        return images.contiguous()
+
+    def __iter__(self):
+        for idx in self.index_batches():
+            idx = torch.as_tensor(np.asarray(idx), dtype=torch.long)
+            images, labels = self.gather(idx), self.labels[idx]
+            if self.pin_memory:
+                images, labels, idx = images.pin_memory(), labels.pin_memory(), idx.pin_memory()
+            yield images, labels, idx
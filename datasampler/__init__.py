@@ -1,10 +1,16 @@
 import datasampler.class_random_sampler
 import datasampler.random_sampler
+import datasampler.hard_class_sampler
+import datasampler.super_class_sampler
 
 
 
-def select(name, image_dict, image_list=None, **kwargs):
-    if 'class' in name:
+def select(name, class_offsets, class_indices, super_offsets=None, super_indices=None, **kwargs):
+    if 'super_class' in name:
+        sampler_lib = super_class_sampler
+    elif 'hard_class' in name:
+        sampler_lib = hard_class_sampler
+    elif 'class' in name:
         sampler_lib = class_random_sampler
     elif 'full' in name:
         raise Exception('Minibatch sampler <{}> not supported, yet!'.format(name))
@@ -12,6 +18,11 @@ def select(name, image_dict, image_list=None, **kwargs):
     else:
         raise Exception('Minibatch sampler <{}> not available!'.format(name))
 
-    sampler = sampler_lib.Sampler(image_dict=image_dict,image_list=image_list, **kwargs)
+    if getattr(sampler_lib, 'REQUIRES_SUPER_CLASSES', False):
+        if super_offsets is None:
+            raise Exception('Minibatch sampler <{}> requires a dataset with super-classes!'.format(name))
+        kwargs.update(super_offsets=super_offsets, super_indices=super_indices)
+
+    sampler = sampler_lib.Sampler(class_offsets=class_offsets, class_indices=class_indices, **kwargs)
 
     return sampler
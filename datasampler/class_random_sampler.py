@@ -1,7 +1,7 @@
+import os
 import numpy as np
 import torch, torch.nn as nn, torch.nn.functional as F
 from tqdm import tqdm
-import random
 import torch.distributed as dist
 
 
@@ -12,8 +12,13 @@ REQUIRES_STORAGE = False
 class Sampler(torch.utils.data.sampler.Sampler):
     """
     Plugs into PyTorch Batchsampler Package.
+
+    Every epoch is planned from a generator seeded with (seed, epoch), identically on all ranks. Each step draws
+    num_replicas x classes_per_batch distinct classes and hands every rank a disjoint slice of them, so DDP ranks never
+    train on the same samples in a step. set_epoch has to be called before each epoch, see utils.callbacks.SamplerEpochCallback.
+    The seed defaults to the one of seed_everything (PL_GLOBAL_SEED).
     """
-    def __init__(self, image_dict, image_list, batch_size, samples_per_class=2, drop_last=False, num_replicas=None, rank=None):
+    def __init__(self, class_offsets, class_indices, batch_size, samples_per_class=2, drop_last=False, num_replicas=None, rank=None, seed=None):
 
         if num_replicas is None:
             if not dist.is_available():
@@ -38,36 +43,64 @@ class Sampler(torch.utils.data.sampler.Sampler):
         self.drop_last = drop_last
 
         #####
-        self.image_dict = image_dict
-        self.image_list = image_list
+        self.class_offsets = class_offsets
+        self.class_indices = class_indices
 
         #####
-        self.train_classes = list(self.image_dict.keys())
+        self.n_classes = len(self.class_offsets) - 1
+        self.class_counts = np.diff(self.class_offsets)
+        self.seed = seed if seed is not None else int(os.environ.get('PL_GLOBAL_SEED', 0))
 
         ####
         self.batch_size = batch_size
         self.samples_per_class = samples_per_class
-        self.sampler_length_total = len(image_list) // batch_size
+        self.sampler_length_total = len(class_indices) // batch_size
         self.sampler_length = self.sampler_length_total // self.num_replicas
         assert self.batch_size % self.samples_per_class == 0, '#Samples per class must divide batchsize!'
+        self.classes_per_batch = self.batch_size // self.samples_per_class
+
+        ### Classes with fewer than samples_per_class samples would repeat samples, use them only if there are too few others
+        self.draw_classes = np.where(self.class_counts >= self.samples_per_class)[0]
+        if len(self.draw_classes) < self.classes_per_batch:
+            self.draw_classes = np.arange(self.n_classes)
+        assert len(self.draw_classes) >= self.classes_per_batch, 'Fewer classes than batchsize//samples_per_class!'
+        self.rank_disjoint = len(self.draw_classes) >= self.classes_per_batch * self.num_replicas
+        if not self.rank_disjoint:
+            print(f"Data sampler: too few classes for disjoint classes across {self.num_replicas} ranks, ranks draw their classes independently.")
 
         self.name = 'class_random_sampler'
         self.requires_storage = False
 
         print(f"\nData sampler [{self.name}] initialized with rank=[{self.rank}/{self.num_replicas}] and sampler length=[{self.sampler_length}/{self.sampler_length_total}].\n")
 
-    def __iter__(self):
-        for _ in range(self.sampler_length):
-            subset = []
-            ### Random Subset from Random classes
-            train_draws = self.batch_size//self.samples_per_class
+    def plan_epoch(self, epoch):
+        """Index batches of this rank for a whole epoch, (sampler_length x batch_size). Each batch holds classes_per_batch
+        distinct classes with samples_per_class distinct samples each."""
+        n_batches, n_ranks, n_cls = self.sampler_length, self.num_replicas, self.classes_per_batch
+        rng = np.random.default_rng([self.seed, epoch])
+
+        ### Distinct classes per step across all ranks (or per batch), sliced to this rank
+        if self.rank_disjoint:
+            classes = sample_without_replacement(rng, len(self.draw_classes), n_ranks * n_cls, n_batches)
+            classes = rng.permuted(classes, axis=1)[:, self.rank*n_cls:(self.rank+1)*n_cls]
+        else:
+            classes = sample_without_replacement(rng, len(self.draw_classes), n_cls, n_batches * n_ranks)
+            classes = classes.reshape(n_batches, n_ranks, n_cls)[:, self.rank]
+        classes = self.draw_classes[classes]
+
+        ### Distinct positions within each drawn class, from a rank specific stream
+        rng = np.random.default_rng([self.seed, epoch, self.rank])
+        counts = self.class_counts[classes].reshape(-1)
+        positions = sample_without_replacement(rng, counts, self.samples_per_class)
+        small = counts < self.samples_per_class
+        if small.any():
+            positions[small] = (rng.random((small.sum(), self.samples_per_class)) * counts[small, None]).astype(np.int64)
+
+        batches = self.class_indices[self.class_offsets[classes].reshape(-1, 1) + positions]
+        return batches.reshape(n_batches, self.batch_size)
 
-            for _ in range(train_draws):
-                class_key = random.choice(self.train_classes)
-                class_ix_list = [random.choice(self.image_dict[class_key])[-1] for _ in range(self.samples_per_class)]
-                subset.extend(class_ix_list)
-
-            yield subset
+    def __iter__(self):
+        yield from self.plan_epoch(self.epoch)
 
     def __len__(self):
         return self.sampler_length
@@ -83,3 +116,19 @@ class Sampler(torch.utils.data.sampler.Sampler):
             epoch (int): Epoch number.
         """
         self.epoch = epoch
+
+
+def sample_without_replacement(rng, n, k, n_rows=None):
+    """
+    Vectorized Floyd's algorithm: k distinct integers from [0, n) per row, with n either a scalar (and <n_rows> rows)
+    or an array of per-row population sizes >= k. Costs O(rows x k^2) instead of O(rows x n) for a full permutation.
+    The set of each row is uniform, its order is not (entry i is at most n-k+i), so shuffle rows before slicing them.
+    """
+    n = np.broadcast_to(np.asarray(n, dtype=np.int64), (n_rows,) if n_rows is not None else np.shape(n))
+    out = np.empty((len(n), k), dtype=np.int64)
+    for i, j in enumerate(range(k - 1, -1, -1)):
+        ### Draw from [0, n-j), take n-j-1 instead if the draw was taken already
+        t = (rng.random(len(n)) * (n - j)).astype(np.int64)
+        taken = (out[:, :i] == t[:, None]).any(axis=1)
+        out[:, i] = np.where(taken, n - j - 1, t)
+    return out
@@ -0,0 +1,183 @@
+import os
+import queue
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+from datasampler.class_random_sampler import sample_without_replacement
+
+
+"""======================================================"""
+REQUIRES_STORAGE = False
+
+###
+class Sampler(torch.utils.data.sampler.Sampler):
+    """
+    Plugs into PyTorch Batchsampler Package.
+
+    Builds batches from clusters of mutually similar (confusable) classes instead of uniformly drawn classes. A fraction
+    <hard_ratio> of the classes of each batch comes from clusters, each a random seed class plus cluster_size-1 classes
+    drawn from its <n_neighbours> most similar classes, the rest is drawn uniformly. Until the first class similarities
+    are available all classes are drawn uniformly, as in class_random_sampler.
+
+    Class similarities are computed in a background thread from class vectors (proxies or class-mean embeddings) that
+    utils.callbacks.HardClassSamplerCallback hands over every <refresh_every> steps, so sampling never waits for it
+    during an epoch. The latest similarities are swapped in by set_epoch, which waits for pending computations, so
+    all DDP ranks switch at the same point. As in class_random_sampler, every step is planned for all ranks from a
+    stream seeded with (seed, epoch): seeds, cluster members and fill classes are disjoint across ranks.
+
+    Args:
+        class_offsets, class_indices: CSR-style class index of the dataset, see data.basic_dml_dataset.BaseDataset.
+        batch_size (int): Number of samples per batch.
+        samples_per_class (int, optional): Number of samples per class.
+        cluster_size (int, optional): Number of classes per cluster.
+        n_neighbours (int, optional): Number of most similar classes the cluster members are drawn from.
+        hard_ratio (float, optional): Fraction of the classes of a batch drawn from clusters.
+        refresh_every (int, optional): Number of training steps between updates of the class vectors.
+        similarity (string, optional): Source of the class vectors, 'proxies', 'embeddings' (class-mean embeddings of
+            recent batches) or 'auto' (proxies of proxy-based criteria, embeddings otherwise).
+    """
+    def __init__(self, class_offsets, class_indices, batch_size, samples_per_class=2, cluster_size=4, n_neighbours=16,
+                 hard_ratio=0.5, refresh_every=100, similarity='auto', num_replicas=None, rank=None, seed=None):
+
+        if num_replicas is None:
+            try:
+                num_replicas = dist.get_world_size()
+            except:
+                num_replicas = 1
+        if rank is None:
+            try:
+                rank = dist.get_rank()
+            except:
+                rank = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.seed = seed if seed is not None else int(os.environ.get('PL_GLOBAL_SEED', 0))
+
+        #####
+        self.class_offsets = class_offsets
+        self.class_indices = class_indices
+        self.n_classes = len(self.class_offsets) - 1
+        self.class_counts = np.diff(self.class_offsets)
+
+        ####
+        self.batch_size = batch_size
+        self.samples_per_class = samples_per_class
+        self.sampler_length_total = len(class_indices) // batch_size
+        self.sampler_length = self.sampler_length_total // self.num_replicas
+        assert self.batch_size % self.samples_per_class == 0, '#Samples per class must divide batchsize!'
+        self.classes_per_batch = self.batch_size // self.samples_per_class
+
+        self.draw_classes = np.where(self.class_counts >= self.samples_per_class)[0]
+        if len(self.draw_classes) < self.classes_per_batch:
+            self.draw_classes = np.arange(self.n_classes)
+        self.rank_disjoint = len(self.draw_classes) >= self.classes_per_batch * self.num_replicas
+        if not self.rank_disjoint:
+            print(f"Data sampler: too few classes for disjoint classes across {self.num_replicas} ranks, ranks draw their classes independently.")
+
+        ####
+        self.cluster_size  = cluster_size
+        self.n_neighbours  = min(n_neighbours, len(self.draw_classes) - 1)
+        self.hard_ratio    = hard_ratio
+        self.refresh_every = refresh_every
+        self.similarity    = similarity
+
+        ### Nearest classes (n_draw_classes x n_neighbours, positions in draw_classes) used for sampling, and the latest
+        ### ones computed by the refresh thread, swapped in by set_epoch
+        self.neighbours, self.next_neighbours = None, None
+        self.n_refreshs = 0
+        self.class_queue, self.refresh_thread = queue.Queue(maxsize=1), None
+
+        self.name = 'hard_class_sampler'
+        self.requires_storage = False
+
+        print(f"\nData sampler [{self.name}] initialized with rank=[{self.rank}/{self.num_replicas}] and sampler length=[{self.sampler_length}/{self.sampler_length_total}].\n")
+
+    def update_class_vectors(self, class_vectors):
+        """Hands (n_classes x dim) class vectors over to the refresh thread without blocking, replaces pending ones."""
+        if self.n_neighbours < 1:
+            return
+        if self.refresh_thread is None:
+            self.refresh_thread = threading.Thread(target=self.refresh_loop, daemon=True)
+            self.refresh_thread.start()
+        try:
+            self.class_queue.get_nowait()
+            self.class_queue.task_done()
+        except queue.Empty:
+            pass
+        self.class_queue.put_nowait(class_vectors)
+
+    def refresh_loop(self):
+        while True:
+            class_vectors = self.class_queue.get()
+            self.next_neighbours = nearest_classes(class_vectors[self.draw_classes], self.n_neighbours)
+            self.n_refreshs += 1
+            self.class_queue.task_done()
+
+    def step_classes(self, rng, n_ranks):
+        """Positions in draw_classes of the classes of one step of <n_ranks> ranks, disjoint across ranks."""
+        n_cls, neighbours = self.classes_per_batch, self.neighbours
+        n_hard = int(round(self.hard_ratio * n_cls)) if neighbours is not None and self.n_neighbours > 0 else 0
+        taken = np.zeros(len(self.draw_classes), dtype=bool)
+        rank_classes = [np.zeros(0, dtype=np.int64) for _ in range(n_ranks)]
+
+        ### Clusters of all ranks, classes taken by a previous rank are skipped
+        if n_hard > 0:
+            cluster_size = min(self.cluster_size, self.n_neighbours + 1)
+            n_seeds = int(np.ceil(n_hard / cluster_size))
+            seeds = rng.permutation(sample_without_replacement(rng, len(self.draw_classes), n_seeds * n_ranks, 1)[0])
+            members = sample_without_replacement(rng, self.n_neighbours, cluster_size - 1, n_seeds * n_ranks)
+            clusters = np.concatenate([seeds[:, None], neighbours[seeds[:, None], members]], axis=1).reshape(n_ranks, -1)
+            for r in range(n_ranks):
+                _, first = np.unique(clusters[r], return_index=True)
+                classes = clusters[r][np.sort(first)]
+                rank_classes[r] = classes[~taken[classes]][:n_hard]
+                taken[rank_classes[r]] = True
+
+        ### Fill up with uniformly drawn classes that no cluster has taken, shuffled and sliced across ranks
+        n_taken = int(taken.sum())
+        candidates = sample_without_replacement(rng, len(self.draw_classes), min(n_cls * n_ranks + n_taken, len(self.draw_classes)), 1)[0]
+        candidates = rng.permutation(candidates)
+        candidates = candidates[~taken[candidates]]
+        start = 0
+        for r in range(n_ranks):
+            n_fill = n_cls - len(rank_classes[r])
+            rank_classes[r] = np.concatenate([rank_classes[r], candidates[start:start+n_fill]])
+            start += n_fill
+        return rank_classes
+
+    def __iter__(self):
+        rng_shared = np.random.default_rng([self.seed, self.epoch])
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        for _ in range(self.sampler_length):
+            if self.rank_disjoint:
+                classes = self.step_classes(rng_shared, self.num_replicas)[self.rank]
+            else:
+                classes = self.step_classes(rng, 1)[0]
+            classes = self.draw_classes[classes]
+            counts = self.class_counts[classes]
+            positions = sample_without_replacement(rng, np.maximum(counts, self.samples_per_class), self.samples_per_class) % counts[:, None]
+            yield self.class_indices[self.class_offsets[classes][:, None] + positions].reshape(-1)
+
+    def __len__(self):
+        return self.sampler_length
+
+    def set_epoch(self, epoch: int) -> None:
+        ### Wait for the class vectors handed over so far, so that all ranks use the same neighbours in this epoch
+        if self.refresh_thread is not None:
+            self.class_queue.join()
+            self.neighbours = self.next_neighbours
+        self.epoch = epoch
+
+
+def nearest_classes(class_vectors, k, chunk_size=1024):
+    """Indices of the <k> most cosine-similar other classes per class, computed in chunks to bound memory."""
+    class_vectors = np.asarray(class_vectors, dtype=np.float32)
+    class_vectors = class_vectors / np.maximum(np.linalg.norm(class_vectors, axis=1, keepdims=True), 1e-8)
+    neighbours = np.empty((len(class_vectors), k), dtype=np.int64)
+    for start in range(0, len(class_vectors), chunk_size):
+        sims = class_vectors[start:start+chunk_size] @ class_vectors.T
+        sims[np.arange(len(sims)), np.arange(start, start+len(sims))] = -np.inf
+        neighbours[start:start+chunk_size] = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    return neighbours
@@ -13,28 +13,33 @@ class Sampler(torch.utils.data.sampler.Sampler):
     """
     Plugs into PyTorch Batchsampler Package.
     """
-    def __init__(self, opt, image_dict, image_list=None):
-        self.image_dict         = image_dict
-        self.image_list         = image_list
-
-        self.batch_size         = opt.bs
-        self.samples_per_class  = opt.samples_per_class
-        self.sampler_length     = len(image_list)//opt.bs
+    def __init__(self, class_offsets, class_indices, batch_size, samples_per_class=2):
+        self.class_offsets      = class_offsets
+        self.class_indices      = class_indices
+        self.n_classes          = len(class_offsets) - 1
+
+        self.batch_size         = batch_size
+        self.samples_per_class  = samples_per_class
+        self.sampler_length     = len(class_indices)//batch_size
         assert self.batch_size % self.samples_per_class == 0, '#Samples per class must divide batchsize!'
 
         self.name             = 'random_sampler'
         self.requires_storage = False
 
+    def draw_from_class(self, class_ix):
+        start, end = self.class_offsets[class_ix], self.class_offsets[class_ix+1]
+        return int(self.class_indices[start+np.random.choice(end-start)])
+
     def __iter__(self):
         for _ in range(self.sampler_length):
-            subset = []
+            subset, subset_classes = [], []
             ### Random Subset from Random classes
             for _ in range(self.batch_size-1):
-                class_key  = random.choice(list(self.image_dict.keys()))
-                sample_idx = np.random.choice(len(self.image_dict[class_key]))
-                subset.append(self.image_dict[class_key][sample_idx][-1])
+                class_ix = random.randrange(self.n_classes)
+                subset.append(self.draw_from_class(class_ix))
+                subset_classes.append(class_ix)
             #
-            subset.append(random.choice(self.image_dict[self.image_list[random.choice(subset)][-1]])[-1])
+            subset.append(self.draw_from_class(random.choice(subset_classes)))
             yield subset
 
     def __len__(self):
@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+from datasampler.class_random_sampler import sample_without_replacement
+
+
+"""======================================================"""
+REQUIRES_STORAGE = False
+REQUIRES_SUPER_CLASSES = True
+
+###
+class Sampler(torch.utils.data.sampler.Sampler):
+    """
+    Plugs into PyTorch Batchsampler Package.
+
+    Builds batches from groups of classes that share a super-class (e.g. the SOP super-categories), so a batch holds
+    many negatives of the same category. A fraction <super_ratio> of the classes of each batch comes from groups of
+    <classes_per_super> classes of one super-class, the rest is drawn uniformly across all super-classes. Super-classes
+    are picked proportionally to their number of classes, so every class is drawn equally often in expectation.
+
+    Classes are planned from a generator seeded with (seed, epoch), identically on all ranks, and every rank gets its
+    own groups and fill classes, so the classes of a step are disjoint across DDP ranks (as in class_random_sampler).
+
+    Args:
+        class_offsets, class_indices: CSR-style class index of the dataset, see data.basic_dml_dataset.BaseDataset.
+        super_offsets, super_indices: CSR-style super-class index, see BaseDataset.set_super_classes.
+        batch_size (int): Number of samples per batch.
+        samples_per_class (int, optional): Number of samples per class.
+        classes_per_super (int, optional): Number of classes per super-class group.
+        super_ratio (float, optional): Fraction of the classes of a batch drawn in super-class groups, 0 reproduces
+            class_random_sampler.
+    """
+    def __init__(self, class_offsets, class_indices, super_offsets, super_indices, batch_size, samples_per_class=2,
+                 classes_per_super=8, super_ratio=0.5, num_replicas=None, rank=None, seed=None):
+
+        if num_replicas is None:
+            try:
+                num_replicas = dist.get_world_size()
+            except:
+                num_replicas = 1
+        if rank is None:
+            try:
+                rank = dist.get_rank()
+            except:
+                rank = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.seed = seed if seed is not None else int(os.environ.get('PL_GLOBAL_SEED', 0))
+
+        #####
+        self.class_offsets = class_offsets
+        self.class_indices = class_indices
+        self.n_classes = len(self.class_offsets) - 1
+        self.class_counts = np.diff(self.class_offsets)
+
+        ####
+        self.batch_size = batch_size
+        self.samples_per_class = samples_per_class
+        self.sampler_length_total = len(class_indices) // batch_size
+        self.sampler_length = self.sampler_length_total // self.num_replicas
+        assert self.batch_size % self.samples_per_class == 0, '#Samples per class must divide batchsize!'
+        self.classes_per_batch = self.batch_size // self.samples_per_class
+
+        ### Classes with fewer than samples_per_class samples would repeat samples, use them only if there are too few others
+        self.draw_classes = np.where(self.class_counts >= self.samples_per_class)[0]
+        if len(self.draw_classes) < self.classes_per_batch * self.num_replicas:
+            self.draw_classes = np.arange(self.n_classes)
+        assert len(self.draw_classes) >= self.classes_per_batch * self.num_replicas, 'Not enough classes for disjoint batches across ranks!'
+
+        ####
+        ### Super-class groups only hold drawable classes
+        drawable  = np.zeros(self.n_classes, dtype=bool)
+        drawable[self.draw_classes] = True
+        super_ids = np.repeat(np.arange(len(super_offsets) - 1), np.diff(super_offsets))
+        keep      = drawable[super_indices]
+        self.super_indices     = np.asarray(super_indices)[keep]
+        self.super_offsets     = np.concatenate([[0], np.cumsum(np.bincount(super_ids[keep], minlength=len(super_offsets) - 1))])
+        self.super_sizes       = np.diff(self.super_offsets)
+        self.super_weights     = self.super_sizes / self.super_sizes.sum()
+        self.classes_per_super = classes_per_super
+        self.super_ratio       = super_ratio
+        self.n_groups          = int(np.ceil(round(self.super_ratio * self.classes_per_batch) / self.classes_per_super))
+
+        self.name = 'super_class_sampler'
+        self.requires_storage = False
+
+        print(f"\nData sampler [{self.name}] initialized with rank=[{self.rank}/{self.num_replicas}] and sampler length=[{self.sampler_length}/{self.sampler_length_total}].\n")
+
+    def step_classes(self, rng):
+        """Classes of one step for all ranks, (num_replicas x classes_per_batch) with all entries distinct."""
+        n_cls, n_ranks = self.classes_per_batch, self.num_replicas
+        n_grouped = int(round(self.super_ratio * n_cls))
+        taken = np.zeros(self.n_classes, dtype=bool)
+        rank_classes = [[] for _ in range(n_ranks)]
+
+        ### Super-class groups, a super-class may be picked several times as long as it has untaken classes
+        supers = rng.choice(len(self.super_sizes), size=self.n_groups * n_ranks, p=self.super_weights)
+        for g, s in enumerate(supers):
+            members = self.super_indices[self.super_offsets[s]:self.super_offsets[s+1]]
+            n_taken = int(taken[members].sum())
+            k = min(self.classes_per_super, n_grouped - len(rank_classes[g // self.n_groups]), len(members) - n_taken)
+            if k <= 0:
+                continue
+            candidates = members[rng.permutation(sample_without_replacement(rng, len(members), k + n_taken, 1)[0])]
+            group = candidates[~taken[candidates]][:k]
+            taken[group] = True
+            rank_classes[g // self.n_groups].extend(group)
+
+        ### Fill up uniformly with untaken classes, also covering groups cut short by small super-classes, shuffled before the
+        ### split across ranks (sample_without_replacement rows are not in random order)
+        n_fill = [n_cls - len(classes) for classes in rank_classes]
+        n_taken = int(taken.sum())
+        candidates = sample_without_replacement(rng, len(self.draw_classes), min(sum(n_fill) + n_taken, len(self.draw_classes)), 1)[0]
+        candidates = self.draw_classes[rng.permutation(candidates)]
+        candidates = candidates[~taken[candidates]]
+        fill = np.split(candidates[:sum(n_fill)], np.cumsum(n_fill)[:-1])
+        return np.stack([np.concatenate([np.array(classes, dtype=np.int64), f]) for classes, f in zip(rank_classes, fill)])
+
+    def __iter__(self):
+        rng_shared = np.random.default_rng([self.seed, self.epoch])
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        for _ in range(self.sampler_length):
+            classes = self.step_classes(rng_shared)[self.rank]
+            counts = self.class_counts[classes]
+            ### Distinct samples per class, classes smaller than samples_per_class only occur if there are too few others
+            positions = sample_without_replacement(rng, np.maximum(counts, self.samples_per_class), self.samples_per_class)
+            small = counts < self.samples_per_class
+            if small.any():
+                positions[small] = (rng.random((small.sum(), self.samples_per_class)) * counts[small, None]).astype(np.int64)
+            yield self.class_indices[self.class_offsets[classes][:, None] + positions].reshape(-1)
+
+    def __len__(self):
+        return self.sampler_length
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
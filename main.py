@@ -5,7 +5,7 @@ from pytorch_lightning import seed_everything
 from pytorch_lightning.trainer import Trainer
 from pytorch_lightning.loggers import WandbLogger
 from utils.auxiliaries import instantiate_from_config, nondefault_trainer_args
-from utils.callbacks import SetupCallback, ProgressBarCallback
+from utils.callbacks import SetupCallback, ProgressBarCallback, SamplerEpochCallback, HardClassSamplerCallback
 from pytorch_lightning.profiler import SimpleProfiler, AdvancedProfiler
 
 
@@ -229,6 +229,9 @@ if __name__ == "__main__":
 
         # Initialize model from config
         model = instantiate_from_config(config.model)
+        train_dataset = data.datasets['train'].dataset
+        model.set_input_pipeline(train_dataset.norm_mean, train_dataset.norm_std, train_dataset.flip_channels,
+                                 train_dataset.batch_transform, train_dataset.n_views)
 
         # Setup modelcheckpoint callback
         lightning_config.modelcheckpoint['params']['dirpath'] = ckptdir
@@ -243,7 +246,7 @@ if __name__ == "__main__":
             logging_callbacks = [instantiate_from_config(lightning_config.callbacks[k]) for k in lightning_config.callbacks]
         else:
             logging_callbacks = []
-        trainer_kwargs["callbacks"] = [setup_callback, *logging_callbacks, bar]
+        trainer_kwargs["callbacks"] = [setup_callback, SamplerEpochCallback(), HardClassSamplerCallback(), *logging_callbacks, bar]
         if not opt.debug:
             trainer_kwargs["callbacks"] += [checkpoint_callback]
 
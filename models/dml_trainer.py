@@ -1,9 +1,11 @@
+import time
 import numpy as np
 import torch
 import pytorch_lightning as pl
 from omegaconf import OmegaConf
 from utils.auxiliaries import instantiate_from_config
 from criteria import add_criterion_optim_params
+from data.basic_dml_dataset import normalize_batch
 
 
 class DML_Model(pl.LightningModule):
@@ -32,6 +34,17 @@ class DML_Model(pl.LightningModule):
         ### Init metric computer
         self.metric_computer = instantiate_from_config(config["Evaluation"])
 
+        ## Input normalization for datasets returning uint8 batches, see set_input_normalization
+        self.flip_channels = False
+        self.batch_transform = None
+        self.n_views = 1
+        self.register_buffer("norm_mean", torch.zeros(1, 3, 1, 1), persistent=False)
+        self.register_buffer("norm_std", torch.ones(1, 3, 1, 1), persistent=False)
+
+        ## Embeddings of the last training batch (e.g. for utils.callbacks.HardClassSamplerCallback), start of training
+        self.train_embeds = None
+        self.fit_start_time = None
+
         if ckpt_path is not None:
             print("Loading model from {}".format(ckpt_path))
             self.init_from_ckpt(ckpt_path, ignore_keys=ignore_keys)
@@ -47,6 +60,51 @@ class DML_Model(pl.LightningModule):
                     del sd[k]
         self.load_state_dict(sd, strict=False)
 
+    def set_input_pipeline(self, mean, std, flip_channels=False, batch_transform=None, n_views=1):
+        """
+        Consumer side of the data pipeline, see data.basic_dml_dataset.BaseDataset.
+        Args:
+            mean, std: Normalization constants applied to uint8 batches (see data.basic_dml_dataset.normalization_params).
+            flip_channels: Flip RGB to BGR after normalization (bninception).
+            batch_transform: Batched training augmentation (see data.batch_augmentation) for datasets that only decode and resize.
+            n_views: Number of augmented views per decoded training image.
+        """
+        self.norm_mean = torch.tensor(mean, dtype=torch.float, device=self.norm_mean.device).view(1, -1, 1, 1)
+        self.norm_std = torch.tensor(std, dtype=torch.float, device=self.norm_std.device).view(1, -1, 1, 1)
+        self.flip_channels = flip_channels
+        self.batch_transform = batch_transform
+        self.n_views = n_views
+
+    def f_norm(self, inputs):
+        ## Normalize uint8 batches on the training device instead of inside the dataloader workers
+        return normalize_batch(inputs, self.norm_mean, self.norm_std, self.flip_channels)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        inputs, labels, *others = batch
+        is_uint8 = inputs.dtype == torch.uint8
+        augment = is_uint8 and self.batch_transform is not None and self.trainer.training
+
+        ## Multi-view batches: flatten (BS x V x C x H x W) into the batch, or create V batched augmentations per image.
+        ## Views of one image are consecutive and share its label.
+        if inputs.dim() == 5:
+            n_views = inputs.shape[1]
+            inputs = inputs.flatten(0, 1)
+        else:
+            n_views = self.n_views if augment else 1
+            inputs = inputs.repeat_interleave(n_views, dim=0) if n_views > 1 else inputs
+        if n_views > 1:
+            labels = labels.repeat_interleave(n_views, dim=0)
+            others = [x.repeat_interleave(n_views, dim=0) for x in others]
+
+        if augment:
+            inputs = self.batch_transform(inputs)
+        if is_uint8:
+            inputs = self.f_norm(inputs)
+        return [inputs, labels, *others]
+
+    def on_fit_start(self):
+        self.fit_start_time = time.time()
+
     def forward(self, x):
         out = self.model(x)
         x = out['embeds'] # {'embeds': z, 'avg_features': y, 'features': x, 'extra_embeds': prepool_y}
@@ -58,7 +116,8 @@ class DML_Model(pl.LightningModule):
         labels = batch[1]
         output = self.model(inputs)
 
-        loss = self.loss(output['embeds'], labels, global_step=self.global_step, split="train") ## Change inputs to loss
+        self.train_embeds = output['embeds'].detach()
+        loss = self.loss(output['embeds'], labels, global_step=self.global_step, split="train", n_views=self.n_views) ## Change inputs to loss
         self.log("Loss", loss, prog_bar=True, logger=True, on_step=False, on_epoch=True) ## Add to progressbar
 
         # compute gradient magnitude
@@ -70,6 +129,26 @@ class DML_Model(pl.LightningModule):
 
         return {"loss": loss, "av_grad_mag": mean_gradient_magnitude}
 
+    def on_before_optimizer_step(self, optimizer, optimizer_idx):
+        ## Criteria with partial proxies update the proxy rows used since the last optimizer step themselves
+        ## (criteria.partial_proxies), once per optimizer step also with gradient accumulation. Their gradients are not
+        ## in the optimizer GradScaler unscales, the scale is handed over as a tensor to avoid a host sync.
+        if getattr(self.loss, 'proxy_bank', None) is not None:
+            scaler = getattr(self.trainer.precision_plugin, 'scaler', None)
+            grad_scale = scaler._get_scale_async() if scaler is not None and scaler.is_enabled() else 1.0
+            self.loss.proxy_bank.step(grad_scale=grad_scale, lr_factor=self.lr_factor())
+
+    def lr_factor(self):
+        """Factor the lr scheduler currently applies to the base learning rates (the same for all param groups)."""
+        scheduler = self.lr_schedulers()
+        scheduler = scheduler[0] if isinstance(scheduler, list) else scheduler
+        if scheduler is None:
+            return 1.0
+        for lr, base_lr in zip(scheduler.get_last_lr(), scheduler.base_lrs):
+            if base_lr > 0:
+                return lr / base_lr
+        return 1.0
+
     def training_epoch_end(self, outputs):
         grad_mag_avs = np.mean([x["av_grad_mag"] for x in outputs])
 
@@ -99,8 +178,10 @@ class DML_Model(pl.LightningModule):
         # perform validation
         computed_metrics = self.metric_computer.compute_standard(embeds, labels, self.device)
 
-        # log validation results
+        # log validation results, the wall time since the start of training gives time-to-target recall
         log_data = {"epoch": self.current_epoch}
+        if self.fit_start_time is not None:
+            log_data["val/wall_time"] = time.time() - self.fit_start_time
         for k, v in computed_metrics.items():
             log_data[f"val/{k}"] = v
 
@@ -0,0 +1,24 @@
+export GPU_TRAINING=0,1,2,3
+echo "GPUs: ${GPU_TRAINING}"
+export EXP_PATH='/export/data/tmilbich/PycharmProjects/dml_pl/experiments/training_models'
+echo "EXP_PATH: ${EXP_PATH}"
+export BETTER_EXCEPTIONS=1
+
+### SUPER-CLASS SAMPLING ON SOP
+# Uniform class sampling vs. batches built from SOP super-categories (datasampler.super_class_sampler). Compare the
+# runs of the group by plotting val/e_recall@1 over val/wall_time, i.e. recall reached per training time.
+
+# ... uniform classes (reference)
+python main.py 'model.params.config.Architecture.params.embed_dim=128' 'lightning.logger.params.group=superclass_sop' 'lightning.trainer.max_epochs=100' \
+               'data.params.train.target=data.SOP.DATA' 'data.params.validation.target=data.SOP.DATA' \
+               'data.params.train.data_sampler.params.name=class_random' \
+              --savename superclass_uniform_marginloss_sop --exp_path ${EXP_PATH} --gpus ${GPU_TRAINING} --base configs/marginloss.yaml
+
+# ... super-class groups, with increasing fraction of same-category classes per batch
+for RATIO in 0.25 0.5 0.75; do
+python main.py 'model.params.config.Architecture.params.embed_dim=128' 'lightning.logger.params.group=superclass_sop' 'lightning.trainer.max_epochs=100' \
+               'data.params.train.target=data.SOP.DATA' 'data.params.validation.target=data.SOP.DATA' \
+               'data.params.train.data_sampler.params.name=super_class' \
+               "data.params.train.data_sampler.params.super_ratio=${RATIO}" 'data.params.train.data_sampler.params.classes_per_super=8' \
+              --savename superclass_ratio${RATIO}_marginloss_sop --exp_path ${EXP_PATH} --gpus ${GPU_TRAINING} --base configs/marginloss.yaml
+done
@@ -1,4 +1,5 @@
 import os
+import torch
 from omegaconf import OmegaConf
 from pytorch_lightning.callbacks import Callback, EarlyStopping
 from pytorch_lightning.callbacks.progress import TQDMProgressBar
@@ -52,6 +53,69 @@ class SetupCallback(Callback):
     #         checkpoint_callbacks = [c for c in trainer.callbacks if isinstance(c, ModelCheckpoint)]
     #         [c.on_validation_end(trainer, trainer.get_model()) for c in checkpoint_callbacks]
 
+class SamplerEpochCallback(Callback):
+    """Calls set_epoch(current_epoch) on the batch sampler of the train dataloader (and on streaming datasets) before
+    every epoch, so that the datasamplers plan a new epoch with the same seed on all ranks."""
+    def on_train_epoch_start(self, trainer, pl_module):
+        if trainer.train_dataloader is None:
+            return
+        loader = trainer.train_dataloader.loaders
+        dataset = getattr(loader, 'dataset', None)
+        for obj in [getattr(loader, 'batch_sampler', None), getattr(dataset, 'dataset', None)]:
+            if callable(getattr(obj, 'set_epoch', None)):
+                obj.set_epoch(trainer.current_epoch)
+
+
+class HardClassSamplerCallback(Callback):
+    """
+    Hands class vectors to train datasamplers that use class similarities (datasampler.hard_class_sampler) every
+    sampler.refresh_every steps: the proxies of proxy-based criteria, or the class-mean embeddings of the training
+    batches since the last update (classes not seen in between keep their previous mean). The sampler uses the
+    resulting similarities from the next epoch on, SamplerEpochCallback (set_epoch) waits for them on every rank.
+    """
+    def __init__(self):
+        self.sums, self.counts, self.means = None, None, None
+        self.n_steps = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        sampler = getattr(trainer.train_dataloader.loaders, 'batch_sampler', None) if trainer.train_dataloader is not None else None
+        if not callable(getattr(sampler, 'update_class_vectors', None)):
+            return
+
+        proxy_bank = getattr(pl_module.loss, 'proxy_bank', None)
+        if proxy_bank is not None and len(proxy_bank.row_shape) == 1:
+            proxies = proxy_bank.weight
+        else:
+            proxies = getattr(pl_module.loss, 'proxies', None)
+        use_proxies = sampler.similarity in ['auto', 'proxies'] and isinstance(proxies, torch.Tensor)
+        if sampler.similarity == 'proxies' and not use_proxies:
+            raise Exception(f'Criterion [{pl_module.loss.name}] has no proxies to compute class similarities from.')
+
+        class_labels = torch.as_tensor(trainer.datamodule.datasets['train'].dataset.avail_classes, dtype=torch.long)
+        if not use_proxies:
+            embeds, labels = pl_module.train_embeds, batch[1].long()
+            if self.sums is None:
+                self.sums = embeds.new_zeros(int(class_labels.max()) + 1, embeds.shape[-1])
+                self.counts = embeds.new_zeros(len(self.sums))
+                self.means = embeds.new_zeros(self.sums.shape)
+            self.sums.index_add_(0, labels, embeds.float())
+            self.counts.index_add_(0, labels, torch.ones_like(labels, dtype=self.counts.dtype))
+
+        self.n_steps += 1
+        if self.n_steps % sampler.refresh_every != 0:
+            return
+
+        if use_proxies:
+            class_vectors = proxies.detach()
+        else:
+            sums, counts = trainer.strategy.reduce(self.sums, reduce_op='sum'), trainer.strategy.reduce(self.counts, reduce_op='sum')
+            seen = counts > 0
+            self.means[seen] = sums[seen] / counts[seen].unsqueeze(-1)
+            self.sums.zero_(), self.counts.zero_()
+            class_vectors = self.means
+        sampler.update_class_vectors(class_vectors[class_labels.to(class_vectors.device)].float().cpu().numpy())
+
+
 def EarlyStoppingPL(**args):
     # return EarlyStopping(monitor="val/accuracy", min_delta=0.0001, verbose=False)
     return EarlyStopping(**args, verbose=False)